@@ -0,0 +1,215 @@
+import asyncio
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_utils
+import iam_key_rotator
+import s3_explorer
+import security_group_scanner
+
+# Optional asyncio layer over the scanners. boto3 is blocking, so each call runs on a bounded thread pool through
+# run_in_executor and a semaphore limits how many calls are in flight at once. Sessions still come from the aws_utils
+# session factories and clients from the shared aws_utils client cache, so the coroutines make exactly the same API
+# calls as the threaded helpers and return the same objects. Nothing here is imported by the menus or the CLI, it's
+# for callers that already run an event loop.
+
+# Number of boto3 calls that run at the same time
+DEFAULT_MAX_CONCURRENCY = 32
+
+
+# Runs blocking calls on a thread pool with at most max_concurrency of them running at the same time. A runner can be
+# shared by several coroutines so they share the same limit, close it (or use it as an async context manager) when
+# done to shut the threads down.
+class AsyncRunner:
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    # Run func(*args, **kwargs) on the thread pool once a slot is free and return its result
+    async def call(self, func, *args, **kwargs):
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    # Iterate a blocking iterator (such as a botocore page iterator) one item per call so each page is fetched on
+    # the thread pool
+    async def iterate(self, iterator):
+        iterator = iter(iterator)
+        done = object()
+
+        while True:
+            item = await self.call(next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    # Shut the thread pool down without blocking the event loop on calls that were abandoned after a timeout
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Holds the runner a coroutine was given, or a temporary one that is closed when the coroutine finishes
+class _RunnerScope:
+    def __init__(self, runner):
+        self.runner = runner
+        self.owned = runner is None
+
+    def __enter__(self):
+        if self.owned:
+            self.runner = AsyncRunner()
+        return self.runner
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.owned:
+            self.runner.close()
+
+
+# Async version of security_group_scanner.get_security_groups
+async def get_security_groups(session, runner=None):
+    with _RunnerScope(runner) as runner:
+        client = await runner.call(aws_utils.get_client, session, "ec2")
+        pages = await runner.call(aws_utils.paginate_pages, client, "describe_security_groups")
+
+        security_groups = []
+        async for page in runner.iterate(pages):
+            security_groups.extend(security_group_scanner.parse_security_group(group)
+                                   for group in page.get("SecurityGroups", []))
+
+        return security_groups
+
+
+# Async version of security_group_scanner.scan_regions, every region is scanned at the same time and the runner
+# bounds how many calls are in flight. Returns ({region: [SecurityGroup]}, {region: error}) in the requested region
+# order. on_region_complete receives each RegionScanResult as it finishes.
+async def scan_regions(session_factory, regions, runner=None,
+                       region_timeout=security_group_scanner.DEFAULT_REGION_TIMEOUT_SECONDS, on_region_complete=None):
+    regions = list(regions)
+    completed = {}
+    errors = {}
+
+    with _RunnerScope(runner) as runner:
+        async def scan_region(region):
+            start = time.monotonic()
+            security_groups = None
+            error = None
+
+            async def scan():
+                session = await runner.call(session_factory, region)
+                return await get_security_groups(session, runner)
+
+            try:
+                security_groups = await asyncio.wait_for(scan(), region_timeout)
+            except asyncio.TimeoutError:
+                error = TimeoutError(f"Task timed out after {region_timeout} seconds")
+            except Exception as e:
+                error = e
+
+            region_result = security_group_scanner.RegionScanResult(region, security_groups=security_groups,
+                                                                    error=error,
+                                                                    elapsed_seconds=time.monotonic() - start)
+            if error is None:
+                completed[region] = security_groups
+            else:
+                errors[region] = error
+
+            if on_region_complete:
+                on_region_complete(region_result)
+
+        await asyncio.gather(*(scan_region(region) for region in regions))
+
+    # Rebuild the results in the requested region order so the reports are stable between runs
+    sg_results = {region: completed[region] for region in regions if region in completed}
+
+    return sg_results, errors
+
+
+# Look up the MFA, keys, groups and tags for a user at the same time
+async def populate_user_details(session, user, runner, rate_limiter):
+    user.MFAEnabled, user.AccessKeys, user.IAMGroups, user.Tags = await asyncio.gather(
+        runner.call(iam_key_rotator.mfa_enabled_for_user, session, user.UserName, rate_limiter),
+        runner.call(iam_key_rotator.get_access_keys_for_user, session, user.UserName, rate_limiter),
+        runner.call(iam_key_rotator.get_user_groups, session, user.UserName, rate_limiter),
+        runner.call(iam_key_rotator.get_user_tags, session, user.UserName, rate_limiter=rate_limiter),
+    )
+
+    # If the user has tags then add the tag to the matching access key description
+    iam_key_rotator.apply_key_descriptions(user)
+
+    return user
+
+
+# Async version of iam_key_rotator.get_iam_users. When get_details is true the detail lookups for a page of users
+# start as soon as the page arrives. The listing and the lookups go through the rate limiter so IAM throttling slows
+# them down instead of failing the report
+async def get_iam_users(session, get_details=False, runner=None, rate_limiter=None):
+    users = []
+    pending_details = []
+
+    if rate_limiter is None:
+        rate_limiter = aws_utils.get_rate_limiter(session)
+
+    with _RunnerScope(runner) as runner:
+        client = await runner.call(aws_utils.get_client, session, "iam", rate_limiter=rate_limiter)
+        pages = await runner.call(aws_utils.paginate_pages, client, "list_users")
+
+        try:
+            async for page in runner.iterate(pages):
+                for user in page.get("Users", []):
+                    temp_user = iam_key_rotator.parse_iam_user(user)
+
+                    if get_details:
+                        pending_details.append(asyncio.ensure_future(
+                            populate_user_details(session, temp_user, runner, rate_limiter)))
+
+                    users.append(temp_user)
+
+            # Wait for all the detail lookups to finish, this re-raises the first error that was hit
+            await asyncio.gather(*pending_details)
+        finally:
+            for pending in pending_details:
+                pending.cancel()
+
+    return users
+
+
+# Async version of s3_explorer.iter_objects_and_folders, yields (files, folders) one page at a time
+async def iter_objects_and_folders(session, bucket_name, prefix=None, page_size=1000, runner=None):
+    with _RunnerScope(runner) as runner:
+        client = await runner.call(aws_utils.get_client, session, "s3")
+        paginator = client.get_paginator("list_objects_v2")
+
+        params = s3_explorer.build_listing_params(bucket_name, prefix, recurse=False)
+        params["PaginationConfig"] = {"PageSize": page_size}
+
+        async for page in runner.iterate(paginator.paginate(**params)):
+            yield s3_explorer.split_listing_page(page)
+
+
+# Async version of s3_explorer.iter_sorted_objects_and_folders
+async def iter_sorted_objects_and_folders(session, bucket_name, prefix=None, page_size=1000, runner=None):
+    async for files, folders in iter_objects_and_folders(session, bucket_name, prefix, page_size=page_size,
+                                                         runner=runner):
+        for key in heapq.merge(files, folders):
+            yield key
+
+
+# Async version of s3_explorer.list_all_objects, yields the object dicts (Key, Size, ...) of every file
+async def list_all_objects(session, bucket_name, prefix=None, recurse=True, runner=None):
+    with _RunnerScope(runner) as runner:
+        client = await runner.call(aws_utils.get_client, session, "s3")
+        paginator = client.get_paginator("list_objects_v2")
+
+        params = s3_explorer.build_listing_params(bucket_name, prefix, recurse=recurse)
+
+        async for page in runner.iterate(paginator.paginate(**params)):
+            for item in page.get("Contents", []):
+                if not item["Key"].endswith("/"):
+                    yield item
@@ -1,6 +1,95 @@
+import json
+import os
+import threading
+import time
+
 import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import CredentialProvider, CredentialResolver, RefreshableCredentials
 from enum import Enum
 
+# Size of the HTTP connection pool for cached clients, large enough for the toolkit's thread pools to share a client
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+
+# Error codes AWS services return when a caller is being throttled
+THROTTLING_ERROR_CODES = ("Throttling", "ThrottlingException", "ThrottledException", "RequestLimitExceeded",
+                          "TooManyRequestsException", "RequestThrottled", "SlowDown")
+
+# SSM path where AWS publishes the global infrastructure metadata for each region
+REGIONS_SSM_PATH = "/aws/service/global-infrastructure/regions"
+
+# Where the region long names are cached on disk and how long the cached names are trusted
+REGION_NAME_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".ttk", "region_names.json")
+REGION_NAME_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Long names of the AWS regions, used when the names can't be loaded from SSM or the disk cache
+FALLBACK_REGION_NAMES = {
+    "af-south-1": "Africa (Cape Town)",
+    "ap-east-1": "Asia Pacific (Hong Kong)",
+    "ap-east-2": "Asia Pacific (Taipei)",
+    "ap-northeast-1": "Asia Pacific (Tokyo)",
+    "ap-northeast-2": "Asia Pacific (Seoul)",
+    "ap-northeast-3": "Asia Pacific (Osaka)",
+    "ap-south-1": "Asia Pacific (Mumbai)",
+    "ap-south-2": "Asia Pacific (Hyderabad)",
+    "ap-southeast-1": "Asia Pacific (Singapore)",
+    "ap-southeast-2": "Asia Pacific (Sydney)",
+    "ap-southeast-3": "Asia Pacific (Jakarta)",
+    "ap-southeast-4": "Asia Pacific (Melbourne)",
+    "ap-southeast-5": "Asia Pacific (Malaysia)",
+    "ap-southeast-7": "Asia Pacific (Thailand)",
+    "ca-central-1": "Canada (Central)",
+    "ca-west-1": "Canada West (Calgary)",
+    "cn-north-1": "China (Beijing)",
+    "cn-northwest-1": "China (Ningxia)",
+    "eu-central-1": "Europe (Frankfurt)",
+    "eu-central-2": "Europe (Zurich)",
+    "eu-north-1": "Europe (Stockholm)",
+    "eu-south-1": "Europe (Milan)",
+    "eu-south-2": "Europe (Spain)",
+    "eu-west-1": "Europe (Ireland)",
+    "eu-west-2": "Europe (London)",
+    "eu-west-3": "Europe (Paris)",
+    "il-central-1": "Israel (Tel Aviv)",
+    "me-central-1": "Middle East (UAE)",
+    "me-south-1": "Middle East (Bahrain)",
+    "mx-central-1": "Mexico (Central)",
+    "sa-east-1": "South America (Sao Paulo)",
+    "us-east-1": "US East (N. Virginia)",
+    "us-east-2": "US East (Ohio)",
+    "us-gov-east-1": "AWS GovCloud (US-East)",
+    "us-gov-west-1": "AWS GovCloud (US-West)",
+    "us-west-1": "US West (N. California)",
+    "us-west-2": "US West (Oregon)",
+}
+
+# Largest page size each paginated list call accepts. paginate uses these when no page size is given so large accounts
+# are listed in as few round trips as possible instead of the service defaults (100 for IAM)
+MAX_PAGE_SIZES = {
+    ("ec2", "describe_security_groups"): 1000,
+    ("iam", "list_users"): 1000,
+    ("iam", "list_groups"): 1000,
+    ("iam", "list_groups_for_user"): 1000,
+    ("iam", "list_user_tags"): 1000,
+}
+
+# In memory copy of the region long names, loaded once per run
+_region_names = None
+_region_names_lock = threading.Lock()
+
+# Cache of boto clients keyed by (credentials identity, region, service)
+_client_cache = {}
+_client_cache_lock = threading.RLock()
+
+# Rate limiters handed out by get_rate_limiter keyed by credentials identity, guarded by _client_cache_lock
+_rate_limiters = {}
+
+# Cache of account metadata that can't change during a session (caller identity, regions) keyed by
+# (credentials identity, item). A new session or assumed role has a different identity so it never sees stale values.
+_metadata_cache = {}
+_metadata_cache_lock = threading.Lock()
+
 
 class AwsCredentials:
     def __init__(self, access_key_id, secret_access_key, session_token=None):
@@ -9,6 +98,138 @@ class AwsCredentials:
         self.SessionToken = session_token
 
 
+# Assumes a role once and hands out sessions that share the temporary credentials. The credentials are cached along
+# with their expiry and botocore refreshes them (with a single STS call) shortly before they expire, so any number of
+# per-region sessions only cost one assume_role call per credential lifetime.
+class AssumeRoleCredentialProvider:
+    def __init__(self, session, role_arn, session_name, duration_seconds=None):
+        self.session = session
+        self.role_arn = role_arn
+        self.session_name = session_name
+        self.duration_seconds = duration_seconds
+        self.expiration = None
+        self._credentials = None
+        self._lock = threading.Lock()
+
+    # Call STS and return the credentials in the metadata format botocore uses for refreshable credentials
+    def _fetch_credentials(self):
+        params = {"RoleArn": self.role_arn, "RoleSessionName": self.session_name}
+
+        if self.duration_seconds:
+            params.update({"DurationSeconds": self.duration_seconds})
+
+        response = get_client(self.session, 'sts').assume_role(**params)
+        response_creds = response.get("Credentials")
+        self.expiration = response_creds.get("Expiration")
+
+        return {
+            "access_key": response_creds.get("AccessKeyId"),
+            "secret_key": response_creds.get("SecretAccessKey"),
+            "token": response_creds.get("SessionToken"),
+            "expiry_time": self.expiration.isoformat(),
+        }
+
+    # Get the shared refreshable credentials, assuming the role the first time they're requested
+    def get_refreshable_credentials(self):
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = RefreshableCredentials.create_from_metadata(
+                    metadata=self._fetch_credentials(),
+                    refresh_using=self._fetch_credentials,
+                    method="sts-assume-role")
+
+        return self._credentials
+
+    # Get a snapshot of the current temporary credentials, refreshing them first if they're about to expire
+    def get_credentials(self):
+        frozen_creds = self.get_refreshable_credentials().get_frozen_credentials()
+        return AwsCredentials(frozen_creds.access_key, frozen_creds.secret_key, frozen_creds.token)
+
+    # Create a session for the region that uses the shared role credentials
+    def create_session(self, region_name=None):
+        return _create_session_from_credentials(self.get_refreshable_credentials(), region_name=region_name)
+
+
+# Client side rate limiter that can be shared by worker threads. Calls are paced by a token bucket that refills at the
+# allowed rate and holds up to burst calls, so a handful of calls after an idle spell go straight through while a long
+# run of calls is held to the rate. The allowed rate is cut back every time AWS throttles a call and slowly climbs back
+# up while calls keep succeeding (additive increase, multiplicative decrease). The limiter is applied to individual API
+# calls by attaching it to a client (see get_client), so every page of a paginated call and every retry waits its
+# turn, and a throttled call is retried on its own by botocore instead of replaying the calls before it.
+class AdaptiveRateLimiter:
+    def __init__(self, rate=10.0, min_rate=1.0, max_rate=50.0, backoff_factor=0.5, recovery_step=0.5,
+                 max_attempts=8, burst=10):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.backoff_factor = backoff_factor
+        self.recovery_step = recovery_step
+        self.max_attempts = max_attempts
+        self.burst = burst
+        self.throttle_count = 0
+        self.clients = {}
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Add the tokens earned at the current rate since the last refill, callers must hold the lock
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    # Block until the caller is allowed to make the next call. The token is taken straight away, so with an empty
+    # bucket the count goes negative and each waiting caller sleeps until its own token has been earned
+    def acquire(self):
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            delay = max(0.0, -self._tokens / self.rate)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_success(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.recovery_step)
+
+    # Slow down and empty the bucket so the next calls are spaced out at the reduced rate
+    def on_throttle(self):
+        with self._lock:
+            self._refill()
+            self.throttle_count += 1
+            self.rate = max(self.min_rate, self.rate * self.backoff_factor)
+            self._tokens = min(self._tokens, 0.0) - 1
+
+    # Client config for clients the limiter is attached to, botocore retries throttled calls with its own backoff
+    def client_config(self):
+        return Config(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+                      retries={"mode": "standard", "max_attempts": self.max_attempts})
+
+    # Hook the limiter into a client so it runs before every HTTP request the client sends, retries included
+    def attach(self, client):
+        client.meta.events.register("before-send", self._before_send, unique_id=f"rate-limiter-send-{id(self)}")
+        client.meta.events.register("needs-retry", self._needs_retry, unique_id=f"rate-limiter-retry-{id(self)}")
+        return client
+
+    def _before_send(self, **kwargs):
+        self.acquire()
+
+    def _needs_retry(self, response=None, **kwargs):
+        if response is None:
+            return None
+
+        error_code = response[1].get("Error", {}).get("Code")
+        if error_code in THROTTLING_ERROR_CODES:
+            self.on_throttle()
+        elif error_code is None:
+            self.on_success()
+
+        # Leave the retry decision to botocore
+        return None
+
+
 class AccountStatusFilters(Enum):
     ENABLED = 1
     DISABLED = 2
@@ -44,34 +265,165 @@ def create_aws_session(region_name=None, profile_name=None, aws_credentials=None
     # Build the session
     return boto3.session.Session(**params)
 
+# Credential provider that hands out an existing botocore credentials object instead of resolving new ones
+class _ExistingCredentialProvider(CredentialProvider):
+    METHOD = "existing-credentials"
+
+    def __init__(self, credentials):
+        super().__init__()
+        self.credentials = credentials
+
+    def load(self):
+        return self.credentials
+
+
+# Build a session that reuses an existing botocore credentials object, refreshable credentials stay shared so
+# they're only refreshed once for every session built from them
+def _create_session_from_credentials(credentials, region_name=None, profile_name=None):
+    botocore_session = botocore.session.get_session()
+
+    # boto3 reports a session without a profile as "default", which is only an error if it's set explicitly
+    if profile_name and profile_name != "default":
+        botocore_session.set_config_variable("profile", profile_name)
+
+    # Replace the default credential chain with one that only returns the existing credentials
+    botocore_session.register_component("credential_provider",
+                                        CredentialResolver(providers=[_ExistingCredentialProvider(credentials)]))
+
+    return boto3.session.Session(botocore_session=botocore_session, region_name=region_name or "us-east-1")
+
+
+# Create a copy of the session in a different region. The credentials of the existing session are reused (not
+# resolved or assumed again) so this doesn't make any calls to AWS.
 def change_session_region(session, new_region_name):
-    creds = AwsCredentials(session.get_credentials().access_key, session.get_credentials().secret_key,
-                           session.get_credentials().token)
+    return _create_session_from_credentials(session.get_credentials(), region_name=new_region_name,
+                                            profile_name=session.profile_name)
 
-    if session.profile_name:
-        return create_aws_session(region_name=new_region_name, profile_name=session.profile_name)
-    else:
-        return create_aws_session(region_name=new_region_name, aws_credentials=creds)
 
+# Build a key that identifies the credentials behind a session. Refreshable credentials (SSO, assumed roles) rotate
+# their access key, so they are identified by the credentials object itself, which the clients hold on to
+def _credential_identity(session):
+    credentials = session.get_credentials()
+
+    if credentials is None:
+        return None, session.profile_name
+    if isinstance(credentials, RefreshableCredentials):
+        return "refreshable", id(credentials)
+
+    return "static", credentials.access_key
+
+
+# Get a boto client for the session, reusing an existing client if one has already been built for the same
+# credentials, region and service. Clients are thread safe so a cached client can be shared across worker threads.
+# When a rate limiter is provided the client comes from the limiter's own cache and has the limiter attached, so the
+# limiter never slows down callers that share the plain cached client.
+def get_client(session, service_name, region_name=None, rate_limiter=None):
+    region_name = region_name or session.region_name
+    cache = _client_cache if rate_limiter is None else rate_limiter.clients
+
+    # Sessions aren't thread safe so resolve the credentials and build the client while holding the lock
+    with _client_cache_lock:
+        cache_key = (_credential_identity(session), region_name, service_name)
+        client = cache.get(cache_key)
 
-# Using an existing session, assume a role and return a new session
+        if client is None:
+            if rate_limiter is None:
+                client = session.client(service_name=service_name, region_name=region_name,
+                                        config=Config(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS))
+            else:
+                client = rate_limiter.attach(session.client(service_name=service_name, region_name=region_name,
+                                                            config=rate_limiter.client_config()))
+            cache[cache_key] = client
+
+    return client
+
+
+# Get the shared rate limiter for the session's credentials. Callers that don't bring their own limiter use this one so
+# they reuse its cached clients and the rate it has learned instead of starting over on every call. Throttling is per
+# account, so sessions with different credentials get their own limiter.
+def get_rate_limiter(session):
+    with _client_cache_lock:
+        cache_key = _credential_identity(session)
+        rate_limiter = _rate_limiters.get(cache_key)
+
+        if rate_limiter is None:
+            rate_limiter = AdaptiveRateLimiter()
+            _rate_limiters[cache_key] = rate_limiter
+
+    return rate_limiter
+
+
+# Drop every cached client, this should be called whenever the active credentials are changed or cleared
+def clear_client_cache():
+    with _client_cache_lock:
+        _client_cache.clear()
+        _rate_limiters.clear()
+
+
+def clear_metadata_cache():
+    with _metadata_cache_lock:
+        _metadata_cache.clear()
+
+
+# Drop all the cached clients and account metadata
+def clear_session_caches():
+    clear_client_cache()
+    clear_metadata_cache()
+
+
+# Return an iterator over the pages of a paginated client operation. page_size sets MaxResults/MaxItems on each call
+# (defaulting to the largest size in MAX_PAGE_SIZES) and max_items stops after that many items in total. Any other
+# keyword arguments are passed to the operation.
+def paginate_pages(client, operation_name, page_size=None, max_items=None, **params):
+    if page_size is None:
+        page_size = MAX_PAGE_SIZES.get((client.meta.service_model.service_name, operation_name))
+
+    pagination_config = {}
+    if page_size:
+        pagination_config["PageSize"] = page_size
+    if max_items:
+        pagination_config["MaxItems"] = max_items
+
+    paginator = client.get_paginator(operation_name)
+    return iter(paginator.paginate(PaginationConfig=pagination_config, **params))
+
+
+# Yield every item under result_key from all the pages of a paginated client operation. This uses the botocore
+# paginator so the NextToken/Marker handling lives in one place, see paginate_pages for the page size options. Items
+# are yielded as each page arrives so callers can start working before the listing finishes.
+def paginate(client, operation_name, result_key, page_size=None, max_items=None, **params):
+    for page in paginate_pages(client, operation_name, page_size=page_size, max_items=max_items, **params):
+        yield from page.get(result_key, [])
+
+
+# Return the cached value of a metadata item for the session's credentials, calling loader to get it the first time
+def _get_session_metadata(session, item, loader):
+    with _client_cache_lock:
+        credentials = session.get_credentials()
+        cache_key = (_credential_identity(session), item)
+
+    with _metadata_cache_lock:
+        if cache_key in _metadata_cache:
+            return _metadata_cache[cache_key][1]
+
+    value = loader()
+
+    # Keep a reference to the credentials with the value so their identity can't be reused by new credentials
+    with _metadata_cache_lock:
+        _metadata_cache[cache_key] = (credentials, value)
+
+    return value
+
+
+# Using an existing session, assume a role and return a new session. The role credentials are refreshed
+# automatically before they expire and are shared by any session created from it with change_session_region.
 def assume_role(session, role_arn, session_name, region_name=None):
-    client = session.client('sts')
-    response = client.assume_role(
-        RoleArn=role_arn,
-        RoleSessionName=session_name
-    )
-    response_creds = response.get("Credentials")
-    ca_creds = AwsCredentials(response_creds.get("AccessKeyId"), response_creds.get("SecretAccessKey"),
-                              response_creds.get("SessionToken"))
-    role_session = create_aws_session(region_name=region_name, profile_name=None, aws_credentials=ca_creds)
-    return role_session
+    provider = AssumeRoleCredentialProvider(session, role_arn, session_name)
+    return provider.create_session(region_name=region_name)
 
 
 # Get all the regions and their status in the calling account
 def get_regions(session, region_status_filter=AccountStatusFilters.ALL):
-    regions = []
-
     enabled_status = ["ENABLED", "ENABLING", "ENABLED_BY_DEFAULT"]
     disabled_status = ["DISABLED", "DISABLING"]
     all_status = enabled_status + disabled_status
@@ -86,23 +438,108 @@ def get_regions(session, region_status_filter=AccountStatusFilters.ALL):
     else:
         region_filter = all_status
 
-    client = session.client(service_name="account")
-    paginator = client.get_paginator("list_regions")
+    def list_regions():
+        regions = []
+
+        client = get_client(session, "account")
+        paginator = client.get_paginator("list_regions")
+
+        # Loop though all the pages and get the regions
+        for page in paginator.paginate(RegionOptStatusContains=region_filter):
+            for item in page.get("Regions"):
+                regions.append(item.get("RegionName"))
+
+        return regions
+
+    # The regions are only listed once per session, return a copy so callers can't change the cached list
+    return list(_get_session_metadata(session, ("regions", region_status_filter), list_regions))
+
+# Fetch the long name of every region from SSM. The region codes come from one paginated sweep of the regions path
+# and the long names are then read 10 at a time (the get_parameters limit), rather than one call per region.
+def fetch_region_friendly_names(session):
+    client = get_client(session, "ssm")
+    paginator = client.get_paginator("get_parameters_by_path")
+
+    region_codes = []
+    for page in paginator.paginate(Path=REGIONS_SSM_PATH):
+        for parameter in page.get("Parameters", []):
+            region_codes.append(parameter.get("Value"))
+
+    region_names = {}
+    for index in range(0, len(region_codes), 10):
+        names = [f"{REGIONS_SSM_PATH}/{code}/longName" for code in region_codes[index:index + 10]]
+        for parameter in client.get_parameters(Names=names).get("Parameters", []):
+            region_names[parameter.get("Name").split("/")[-2]] = parameter.get("Value")
+
+    return region_names
+
+
+# Read the region names from the disk cache, returns None if there isn't a cache or it's older than the ttl
+def _read_region_name_cache(cache_path, ttl_seconds):
+    if not os.path.isfile(cache_path):
+        return None
+
+    try:
+        with open(cache_path, 'r') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
 
-    # Loop though all the pages and get the regions
-    for page in paginator.paginate(RegionOptStatusContains=region_filter):
-        for item in page.get("Regions"):
-            regions.append(item.get("RegionName"))
+    if ttl_seconds is not None and time.time() - cache.get("fetched_at", 0) > ttl_seconds:
+        return None
+
+    return cache.get("regions")
+
+
+def _write_region_name_cache(cache_path, region_names):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w') as file:
+            json.dump({"fetched_at": time.time(), "regions": region_names}, file)
+    except OSError:
+        # The disk cache is only an optimization, carry on without it if it can't be written
+        pass
+
+
+# Load the region long names into memory. They come from the disk cache while it's fresh, otherwise from SSM (and
+# are written back to the cache). If SSM can't be reached a stale cache is used and then the built in table.
+def load_region_friendly_names(session, cache_path=REGION_NAME_CACHE_PATH, ttl_seconds=REGION_NAME_CACHE_TTL_SECONDS,
+                               refresh=False):
+    global _region_names
+
+    with _region_names_lock:
+        if _region_names is not None and not refresh:
+            return _region_names
+
+        region_names = None if refresh else _read_region_name_cache(cache_path, ttl_seconds)
+
+        if region_names is None:
+            try:
+                region_names = fetch_region_friendly_names(session)
+                _write_region_name_cache(cache_path, region_names)
+            except Exception:
+                region_names = _read_region_name_cache(cache_path, None) or {}
+
+        _region_names = {**FALLBACK_REGION_NAMES, **region_names}
+        return _region_names
 
-    return regions
 
 def get_region_friendly_name(session, region_name):
-    client = session.client(service_name="ssm")
-    response = client.get_parameter(Name=f"/aws/service/global-infrastructure/regions/{region_name}/longName")
-    return response.get("Parameter").get("Value")
+    return load_region_friendly_names(session).get(region_name, region_name)
+
+# Get the caller identity (Account, Arn and UserId) of the session, this is only looked up once per session
+def get_caller_identity(session):
+    def lookup_caller_identity():
+        client = get_client(session, "sts")
+        response = client.get_caller_identity()
+        return {"Account": response.get("Account"), "Arn": response.get("Arn"), "UserId": response.get("UserId")}
+
+    return dict(_get_session_metadata(session, "caller_identity", lookup_caller_identity))
 
 def get_current_account_id(session):
-    client = session.client(service_name="sts")
-    response = client.get_caller_identity()
-    return response.get("Account")
+    return get_caller_identity(session).get("Account")
+
+# Get the partition (aws, aws-cn, aws-us-gov) the session's account is in
+def get_partition(session):
+    return get_caller_identity(session).get("Arn").split(":")[1]
 
@@ -0,0 +1,264 @@
+import json
+import math
+import os
+import threading
+from datetime import datetime, timezone
+
+import aws_utils
+import iam_key_rotator
+import utils
+
+# Batch access key rotation. The users to rotate are selected from one bulk IAM inventory (all users, or by name,
+# group, tag or key age) and turned into a rotation plan that can be reviewed before anything is changed. The plan is
+# then run on a pool of worker threads sharing one rate limiter, each user is rolled back on its own if any of its
+# steps fail, and every new key ends up in a single consolidated JSON file along with how long the new keys took to
+# propagate. Each new key is also appended to a key log on disk the moment its user finishes, so a crash part way
+# through a batch never loses a secret that can't be retrieved from AWS again.
+
+# Number of users rotated at the same time
+DEFAULT_ROTATION_WORKERS = 8
+
+
+class RotationPlan:
+    def __init__(self, account_id=None, selection=None):
+        self.account_id = account_id
+        self.selection = selection or {}
+        self.created = utils.datetime_now_string()
+        self.rotations = []
+        self.skipped = []
+
+    def count(self, status):
+        return sum(1 for rotation in self.rotations if rotation.Status == status)
+
+    @property
+    def failed(self):
+        return [rotation for rotation in self.rotations if rotation.Status not in ("planned", "rotated")]
+
+    # Summary of how long the new keys took to be accepted by STS, the percentiles use the nearest rank
+    def propagation_summary(self):
+        latencies = sorted(rotation.Verification.PropagationSeconds for rotation in self.rotations
+                           if rotation.Verification is not None and rotation.Verification.Verified)
+        attempts = [rotation.Verification.Attempts for rotation in self.rotations if rotation.Verification is not None]
+
+        summary = {"verified": len(latencies), "unverified": len(attempts) - len(latencies),
+                   "attempts": sum(attempts)}
+        if latencies:
+            summary.update({
+                "minSeconds": latencies[0],
+                "meanSeconds": sum(latencies) / len(latencies),
+                "p50Seconds": latencies[math.ceil(0.5 * len(latencies)) - 1],
+                "p95Seconds": latencies[math.ceil(0.95 * len(latencies)) - 1],
+                "maxSeconds": latencies[-1],
+            })
+        return summary
+
+    def to_dict(self, include_secrets=True):
+        return {
+            "accountId": self.account_id,
+            "created": self.created,
+            "selection": self.selection,
+            "summary": {status: self.count(status)
+                        for status in ("planned", "rotated", "rolled_back", "rollback_failed", "failed")},
+            "propagation": self.propagation_summary(),
+            "rotations": [rotation.to_dict(include_secret=include_secrets) for rotation in self.rotations],
+            "skipped": self.skipped,
+        }
+
+
+# Append-only JSON lines file next to the rotation output that holds the new key of each user as soon as the user's
+# rotation finishes. Every line is flushed and fsynced before the worker moves on, and the consolidated output is
+# built from this file at the end. The log is created when the batch starts and refuses to replace an existing one,
+# which could hold the keys of an interrupted batch.
+class RotationKeyLog:
+    def __init__(self, output_filename):
+        self.output_filename = output_filename
+        self.filename = f"{output_filename}.partial"
+        self._lock = threading.Lock()
+
+        try:
+            with open(self.filename, 'x'):
+                pass
+        except FileExistsError:
+            raise Exception(f"{self.filename} already exists, it may hold the new keys of an interrupted rotation")
+
+    def append(self, rotation):
+        line = utils.stringify_json(rotation.to_dict(include_secret=True), indent=0)
+
+        with self._lock:
+            with open(self.filename, 'a') as file:
+                file.write(line + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    # The logged rotations by user name, a line cut short by a crash is skipped
+    def read(self):
+        rotations = {}
+
+        with open(self.filename) as file:
+            for line in file:
+                try:
+                    rotation = json.loads(line)
+                except ValueError:
+                    continue
+                rotations[rotation["UserName"]] = rotation
+
+        return rotations
+
+    def remove(self):
+        os.remove(self.filename)
+
+
+# Parse a tag filter given as Key or Key=Value
+def parse_tag_filter(tag):
+    if tag is None:
+        return None, None
+
+    key, separator, value = tag.partition("=")
+    return key, value if separator else None
+
+
+# Age in days of a user's oldest active access key, None if the user has no active keys
+def oldest_active_key_age_days(user, now=None):
+    now = now or datetime.now(timezone.utc)
+    ages = [(now - key.CreationDate).total_seconds() / 86400 for key in user.AccessKeys
+            if key.Status == "Active" and key.CreationDate is not None]
+    return max(ages) if ages else None
+
+
+# Filter the users down to the ones to rotate. Every filter that's provided has to match, with no filters every user
+# is selected. tag is Key or Key=Value, min_key_age_days selects users with an active key at least that many days old
+def select_users(users, usernames=None, group=None, tag=None, min_key_age_days=None, now=None):
+    tag_key, tag_value = parse_tag_filter(tag)
+    usernames = set(usernames) if usernames else None
+
+    selected = []
+    for user in users:
+        if usernames is not None and user.UserName not in usernames:
+            continue
+
+        if group is not None and not any(g.GroupName == group for g in user.IAMGroups):
+            continue
+
+        if tag_key is not None and not any(t.key == tag_key and (tag_value is None or t.value == tag_value)
+                                           for t in user.Tags or []):
+            continue
+
+        if min_key_age_days is not None:
+            age = oldest_active_key_age_days(user, now)
+            if age is None or age < min_key_age_days:
+                continue
+
+        selected.append(user)
+
+    return selected
+
+
+# Build the rotation plan for the selected users from a single bulk inventory. users can be passed in to reuse an
+# inventory that was already loaded. Users without access keys are skipped (the batch never hands out keys to users
+# that didn't have any) along with users whose keys can't be rotated.
+def build_rotation_plan(session, usernames=None, group=None, tag=None, min_key_age_days=None, users=None):
+    if users is None:
+        users = iam_key_rotator.get_iam_users_inventory(session)
+
+    selection = {"userNames": usernames, "group": group, "tag": tag, "minKeyAgeDays": min_key_age_days}
+    plan = RotationPlan(aws_utils.get_current_account_id(session), {k: v for k, v in selection.items() if v})
+
+    for user in select_users(users, usernames=usernames, group=group, tag=tag, min_key_age_days=min_key_age_days):
+        if len(user.AccessKeys) == 0:
+            plan.skipped.append({"UserName": user.UserName, "Reason": "The user has no access keys"})
+            continue
+
+        try:
+            plan.rotations.append(iam_key_rotator.plan_key_rotation(user))
+        except Exception as e:
+            plan.skipped.append({"UserName": user.UserName, "Reason": str(e)})
+
+    # Report usernames that were asked for but don't exist instead of silently dropping them
+    if usernames:
+        found = {user.UserName for user in users}
+        plan.skipped.extend({"UserName": username, "Reason": "The user was not found"}
+                            for username in usernames if username not in found)
+
+    return plan
+
+
+# Run every rotation in the plan on a pool of worker threads that share one rate limiter. A user that fails is rolled
+# back and recorded on its rotation without stopping the others. With a key_log each new key is saved to it by the
+# worker as soon as the rotation returns, and a rotation whose key can't be saved is rolled back so the user keeps
+# their old keys. on_user_complete receives each KeyRotation as it finishes. Returns the plan.
+def run_rotation_plan(session, plan, max_workers=DEFAULT_ROTATION_WORKERS, rate_limiter=None, on_user_complete=None,
+                      key_log=None):
+    rate_limiter = rate_limiter or aws_utils.get_rate_limiter(session)
+
+    def save_new_key(rotation):
+        try:
+            key_log.append(rotation)
+        except Exception as e:
+            if rotation.Status == "rotated":
+                rotation.Error = e
+                iam_key_rotator.rollback_key_rotation(session, rotation, rate_limiter)
+
+    def rotate(rotation):
+        try:
+            return iam_key_rotator.apply_key_rotation(session, rotation, rate_limiter)
+        finally:
+            # A rotation whose rollback failed can still hold a working new key, so it's saved as well
+            if key_log is not None and rotation.NewAccessKey is not None:
+                save_new_key(rotation)
+
+    for task in utils.run_concurrently(rotate, plan.rotations, max_workers=max_workers):
+        # apply_key_rotation records its own errors, this only catches a rotation that never got to run
+        if task.error is not None and task.item.Error is None:
+            task.item.Error = task.error
+            task.item.Status = "failed"
+
+        if on_user_complete:
+            on_user_complete(task.item)
+
+    return plan
+
+
+# Default name of the consolidated rotation output
+def rotation_output_filename(plan):
+    return f"{utils.datetime_now_string('%Y-%m-%dT%H-%M-%S')}--{plan.account_id}--BatchKeyRotation.json"
+
+
+# Write the plan and the new keys of every rotated user to a single json file, the secrets come from the key log. The
+# file is fsynced before the key log is removed so the secrets are always on disk in one of them. Returns the filename
+def write_rotation_output(plan, key_log):
+    logged = key_log.read()
+    output = plan.to_dict(include_secrets=False)
+
+    for rotation in output["rotations"]:
+        new_key = rotation["NewAccessKey"]
+        logged_key = (logged.get(rotation["UserName"]) or {}).get("NewAccessKey")
+        if new_key is not None and logged_key is not None and logged_key["AccessKeyID"] == new_key["AccessKeyID"]:
+            new_key["SecretAccessKey"] = logged_key["SecretAccessKey"]
+
+    with open(key_log.output_filename, 'w') as file:
+        file.write(utils.stringify_json(output))
+        file.flush()
+        os.fsync(file.fileno())
+
+    key_log.remove()
+    return key_log.output_filename
+
+
+# Build the plan text shown before a batch rotation is confirmed
+def format_rotation_plan(plan):
+    r = utils.ReportBuilder()
+    r.write(f"Users to rotate: {len(plan.rotations)}")
+
+    for rotation in plan.rotations:
+        r.write(f"* {rotation.UserName}", 1)
+        if rotation.DeleteKeyIDs:
+            r.write(f"- Delete: {', '.join(rotation.DeleteKeyIDs)}", 2)
+        if rotation.DeactivateKeyIDs:
+            r.write(f"- Deactivate: {', '.join(rotation.DeactivateKeyIDs)}", 2)
+
+    if plan.skipped:
+        r.write(f"Skipped: {len(plan.skipped)}")
+        for skipped in plan.skipped:
+            r.write(f"- {skipped['UserName']}: {skipped['Reason']}", 1)
+
+    return str(r)
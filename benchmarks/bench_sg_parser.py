@@ -0,0 +1,235 @@
+import os
+import random
+import sys
+import time
+
+# Import the modules from the repository root when run as python benchmarks/bench_sg_parser.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from security_group_scanner import IpPermission, IpPermissionsEgress, IpRange, Ipv6Range, PrefixListId, SecurityGroup, \
+    Tag, UserIdGroupPair, parse_security_group
+
+# Micro-benchmark for the security group response parser. Builds a synthetic describe_security_groups response and
+# compares parse_security_group against the original parser from before the ingress/egress loops were shared.
+#
+# Usage: python benchmarks/bench_sg_parser.py [number of rules] [repeats]
+
+DEFAULT_RULE_COUNT = 10000
+DEFAULT_REPEATS = 5
+RULES_PER_GROUP = 10
+
+
+# The per-group body of get_security_groups before parse_security_group existed, copied verbatim from the original
+# module (separate copy-pasted ingress and egress loops) and kept as the baseline. It runs on the current model classes
+def baseline_parse_security_group(group):
+    # Create security group object and parse data from response
+    sg = SecurityGroup()
+    sg.description = group.get("Description")
+    sg.groupName = group.get("GroupName")
+    sg.ownerId = group.get("OwnerId")
+    sg.groupId = group.get("GroupId")
+    sg.vpcId = group.get("VpcId")
+
+    if group.get("IpPermissions"):
+        # Parse IpPermissions for the current item
+        for permission in group.get("IpPermissions"):
+            ipp = IpPermission()
+            ipp.fromPort = permission.get("FromPort")
+            ipp.ipProtocol = permission.get("IpProtocol")
+            ipp.toPort = permission.get("ToPort")
+
+            # Parse IP Ranges
+            if permission.get("IpRanges"):
+                for ip_range in permission.get("IpRanges"):
+                    ipr = IpRange()
+                    ipr.cidrIp = ip_range.get("CidrIp")
+                    ipr.description = ip_range.get("Description")
+                    ipp.ipRanges.append(ipr)
+
+            # Parse IPv6 Ranges
+            if permission.get("Ipv6Ranges"):
+                for ip6_range in permission.get("Ipv6Ranges"):
+                    ip6r = Ipv6Range()
+                    ip6r.cidrIpv6 = ip6_range.get("CidrIpv6")
+                    ip6r.description = ip6_range.get("Description")
+                    ipp.ipv6Ranges.append(ip6r)
+
+            # Parse PrefixList Ids
+            if permission.get("PrefixListIds"):
+                for prefix_list in permission.get("PrefixListIds"):
+                    plid = PrefixListId()
+                    plid.prefixListId = prefix_list.get("PrefixListId")
+                    plid.description = prefix_list.get("Description")
+                    ipp.prefixListIds.append(plid)
+
+            # Pares UserId Group Pairs
+            if permission.get("UserIdGroupPairs"):
+                for group_pair in permission.get("UserIdGroupPairs"):
+                    uigp = UserIdGroupPair()
+                    uigp.description = group_pair.get("Description")
+                    uigp.groupId = group_pair.get("GroupId")
+                    uigp.groupName = group_pair.get("GroupName")
+                    uigp.peeringStatus = group_pair.get("PeeringStatus")
+                    uigp.userId = group_pair.get("UserId")
+                    uigp.vpcId = group_pair.get("VpcId")
+                    uigp.vpcPeeringConnectionId = group_pair.get("VpcPeeringConnectionId")
+                    ipp.userIdGroupPairs.append(uigp)
+
+            # Add to the security group
+            sg.ipPermissions.append(ipp)
+
+    if group.get("IpPermissionsEgress"):
+        # Parse IpPermissionsEgress for the current item
+        for permission in group.get("IpPermissionsEgress"):
+            ippe = IpPermissionsEgress()
+            ippe.fromPort = permission.get("FromPort")
+            ippe.ipProtocol = permission.get("IpProtocol")
+            ippe.toPort = permission.get("ToPort")
+
+            # Parse IP Ranges
+            if permission.get("IpRanges"):
+                for ip_range in permission.get("IpRanges"):
+                    ipr = IpRange()
+                    ipr.cidrIp = ip_range.get("CidrIp")
+                    ipr.description = ip_range.get("Description")
+                    ippe.ipRanges.append(ipr)
+
+            # Parse IPv6 Ranges
+            if permission.get("Ipv6Ranges"):
+                for ip6_range in permission.get("Ipv6Ranges"):
+                    ip6r = Ipv6Range()
+                    ip6r.cidrIpv6 = ip6_range.get("CidrIpv6")
+                    ip6r.description = ip6_range.get("Description")
+                    ippe.ipv6Ranges.append(ip6r)
+
+            # Parse PrefixList Ids
+            if permission.get("PrefixListIds"):
+                for prefix_list in permission.get("PrefixListIds"):
+                    plid = PrefixListId()
+                    plid.prefixListId = prefix_list.get("PrefixListId")
+                    plid.description = prefix_list.get("Description")
+                    ippe.prefixListIds.append(plid)
+
+            # Pares UserId Group Pairs
+            if permission.get("UserIdGroupPairs"):
+                for group_pair in permission.get("UserIdGroupPairs"):
+                    uigp = UserIdGroupPair()
+                    uigp.description = group_pair.get("Description")
+                    uigp.groupId = group_pair.get("GroupId")
+                    uigp.groupName = group_pair.get("GroupName")
+                    uigp.peeringStatus = group_pair.get("PeeringStatus")
+                    uigp.userId = group_pair.get("UserId")
+                    uigp.vpcId = group_pair.get("VpcId")
+                    uigp.vpcPeeringConnectionId = group_pair.get("VpcPeeringConnectionId")
+                    ippe.userIdGroupPairs.append(uigp)
+
+            sg.ipPermissionsEgress.append(ippe)
+
+    # Parse the tags
+    if group.get("Tags"):
+        for tag in group.get("Tags"):
+            t = Tag()
+            t.key = tag.get("Key")
+            t.value = tag.get("Value")
+            sg.tags.append(t)
+
+    return sg
+
+
+# Build a single synthetic permission with a mix of the record types seen in real accounts
+def build_permission(rng, index):
+    port = rng.choice((22, 80, 443, 3306, 5432, 8080))
+    permission = {
+        "FromPort": port,
+        "IpProtocol": "tcp",
+        "ToPort": port,
+        "IpRanges": [{"CidrIp": f"10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.0/24", "Description": f"rule {index}"}
+                     for _ in range(rng.randint(0, 3))],
+        "Ipv6Ranges": [],
+        "PrefixListIds": [],
+        "UserIdGroupPairs": [],
+    }
+
+    if rng.random() < 0.3:
+        permission["Ipv6Ranges"].append({"CidrIpv6": "::/0"})
+    if rng.random() < 0.1:
+        permission["PrefixListIds"].append({"PrefixListId": f"pl-{index:08x}", "Description": "prefix list"})
+    if rng.random() < 0.4:
+        permission["UserIdGroupPairs"].append({"GroupId": f"sg-{rng.randint(0, 1 << 32):08x}",
+                                               "UserId": "123456789012"})
+
+    return permission
+
+
+# Build a list of security groups holding rule_count ingress and egress rules in total
+def build_groups(rule_count, seed=0):
+    rng = random.Random(seed)
+    groups = []
+
+    for group_index in range(0, rule_count, RULES_PER_GROUP):
+        rules = min(RULES_PER_GROUP, rule_count - group_index)
+        ingress = rules // 2 + rules % 2
+
+        groups.append({
+            "Description": f"group {group_index}",
+            "GroupName": f"group-{group_index}",
+            "OwnerId": "123456789012",
+            "GroupId": f"sg-{group_index:08x}",
+            "VpcId": f"vpc-{group_index % 7:08x}",
+            "IpPermissions": [build_permission(rng, group_index + i) for i in range(ingress)],
+            "IpPermissionsEgress": [build_permission(rng, group_index + i) for i in range(rules - ingress)],
+            "Tags": [{"Key": "Name", "Value": f"group-{group_index}"}],
+        })
+
+    return groups
+
+
+# Return the time in seconds of one run of parser over groups
+def time_parser(parser, groups):
+    start = time.perf_counter()
+    for group in groups:
+        parser(group)
+    return time.perf_counter() - start
+
+
+# Return the best time in seconds of repeats runs of each parser. The parsers take turns on every repeat so a noisy
+# machine slows them both down instead of skewing the comparison
+def time_parsers(parsers, groups, repeats):
+    results = {}
+
+    for _ in range(repeats):
+        for name, parser in parsers:
+            elapsed = time_parser(parser, groups)
+            if name not in results or elapsed < results[name]:
+                results[name] = elapsed
+
+    return results
+
+
+def main(argv):
+    rule_count = int(argv[0]) if len(argv) > 0 else DEFAULT_RULE_COUNT
+    repeats = int(argv[1]) if len(argv) > 1 else DEFAULT_REPEATS
+
+    groups = build_groups(rule_count)
+
+    # Both parsers have to produce the same output or the numbers don't mean anything
+    for group in groups:
+        if baseline_parse_security_group(group).to_dict() != parse_security_group(group).to_dict():
+            print(f"Parser output differs for {group.get('GroupId')}")
+            return 1
+
+    print(f"Parsing {len(groups)} security groups with {rule_count} rules, best of {repeats} runs")
+
+    results = time_parsers((("baseline", baseline_parse_security_group), ("current", parse_security_group)),
+                           groups, repeats)
+    for name, elapsed in results.items():
+        per_10k = elapsed * 10000 / rule_count
+        print(f"{name:>9}: {rule_count / elapsed:>12,.0f} rules/sec, {per_10k * 1000:.2f} ms per 10k rules")
+
+    print(f"Speedup: {results['baseline'] / results['current']:.2f}x")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,401 @@
+import argparse
+import sys
+
+import aws_utils
+import batch_key_rotator
+import iam_key_rotator
+import org_scanner
+import s3_explorer
+import security_group_scanner
+import sg_drift
+import utils
+
+# Headless entry point for the toolkit. Every command authenticates from the command line options, runs a single flow
+# without any menus or screen clearing and writes its result as JSON to stdout (or --output). Progress messages go to
+# stderr so the JSON can be piped straight into other tools. The exit code is 0 on success, 1 if any part of the
+# command failed (a region, user or file) and 2 for invalid arguments.
+
+DEFAULT_ROLE_SESSION_NAME = "AWSTinkererToolkit"
+
+REGION_STATUS_FILTERS = {
+    "all": aws_utils.AccountStatusFilters.ALL,
+    "enabled": aws_utils.AccountStatusFilters.ENABLED,
+    "disabled": aws_utils.AccountStatusFilters.DISABLED,
+}
+
+
+def _log(message):
+    print(message, file=sys.stderr)
+
+
+def _quiet(message):
+    pass
+
+
+def _comma_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+# Build the session from the auth options, keys take priority over a profile and a role is assumed on top of either
+def create_session(args):
+    if args.access_key_id:
+        session = aws_utils.create_aws_session(region_name=args.region, aws_credentials=aws_utils.AwsCredentials(
+            args.access_key_id, args.secret_access_key, args.session_token))
+    else:
+        session = aws_utils.create_aws_session(region_name=args.region, profile_name=args.profile)
+
+    if args.role_arn:
+        session = aws_utils.assume_role(session, args.role_arn, args.role_session_name, region_name=args.region)
+
+    return session
+
+
+# The regions a command should run in, either the --regions list or every enabled region in the account
+def _get_regions(session, args):
+    if args.regions:
+        return args.regions
+    return aws_utils.get_regions(session, region_status_filter=aws_utils.AccountStatusFilters.ENABLED)
+
+
+def _region_session_factory(session):
+    return lambda region: aws_utils.change_session_region(session, region)
+
+
+def run_regions(session, args):
+    regions = aws_utils.get_regions(session, region_status_filter=REGION_STATUS_FILTERS[args.status])
+    if args.names:
+        aws_utils.load_region_friendly_names(session)
+        regions = [{"region": region, "name": aws_utils.get_region_friendly_name(session, region)}
+                   for region in regions]
+    return {"regions": regions}, 0
+
+
+def run_sg_scan(session, args):
+    def report_region(region_result):
+        if region_result.error is None:
+            args.reporter(f"{region_result.region} Scan Complete ({region_result.elapsed_seconds:.1f}s)")
+        else:
+            args.reporter(f"{region_result.region} Scan Failed: {region_result.error}")
+
+    sg_results, errors = security_group_scanner.scan_regions(
+        _region_session_factory(session), _get_regions(session, args), max_workers=args.workers,
+        region_timeout=args.timeout, on_region_complete=report_region)
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            security_group_scanner.format_report(session, sg_results, stream=report_file)
+
+    result = {"accountId": aws_utils.get_current_account_id(session), "regions": sg_results,
+              "errors": {region: str(error) for region, error in errors.items()}}
+    return result, 1 if errors else 0
+
+
+def run_sg_drift(session, args):
+    def report_region(region_drift):
+        if region_drift.error is not None:
+            args.reporter(f"{region_drift.region} Scan Failed: {region_drift.error}")
+        else:
+            args.reporter(f"{region_drift.region} {len(region_drift.changes)} Changed "
+                          f"({region_drift.elapsed_seconds:.1f}s)")
+
+    account_id = aws_utils.get_current_account_id(session)
+    snapshot = sg_drift.SecurityGroupSnapshot(account_id, snapshot_dir=args.snapshot_dir).load()
+    drift = sg_drift.scan_drift(_region_session_factory(session), _get_regions(session, args), snapshot,
+                                max_workers=args.workers, region_timeout=args.timeout,
+                                on_region_complete=report_region)
+
+    if not args.no_save:
+        snapshot.save()
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            sg_drift.format_drift_report(drift, stream=report_file)
+
+    # A failed region always exits with 1, drift only does with --fail-on-drift so scheduled checks can alert on it
+    failed = any(region.error is not None for region in drift.regions)
+    return drift.to_dict(), 1 if failed or (drift.has_drift and args.fail_on_drift) else 0
+
+
+def run_iam_report(session, args):
+    users = iam_key_rotator.get_iam_users_inventory(session)
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            iam_key_rotator.format_users_report(session, users, stream=report_file)
+
+    return {"accountId": aws_utils.get_current_account_id(session), "users": users}, 0
+
+
+def run_rotate_keys(session, args):
+    results = []
+    for username in args.usernames:
+        try:
+            access_key = iam_key_rotator.rotate_access_keys(session, username)
+            results.append({"userName": username, "rotated": True, "accessKeyId": access_key.AccessKeyID})
+            args.reporter(f"{username} Rotated")
+        except Exception as e:
+            results.append({"userName": username, "rotated": False, "error": str(e)})
+            args.reporter(f"{username} Failed: {e}")
+
+    return {"results": results}, 0 if all(result["rotated"] for result in results) else 1
+
+
+def run_rotate_keys_batch(session, args):
+    plan = batch_key_rotator.build_rotation_plan(session, usernames=args.users, group=args.group, tag=args.tag,
+                                                 min_key_age_days=args.min_key_age_days)
+    args.reporter(f"{len(plan.rotations)} Users To Rotate, {len(plan.skipped)} Skipped")
+
+    if args.dry_run:
+        return plan.to_dict(include_secrets=False), 0
+
+    def report_user(rotation):
+        if rotation.Status == "rotated":
+            args.reporter(f"{rotation.UserName} Rotated ({rotation.ElapsedSeconds:.1f}s, key accepted after "
+                          f"{rotation.Verification.PropagationSeconds:.1f}s)")
+        else:
+            args.reporter(f"{rotation.UserName} Failed ({rotation.Status}): {rotation.Error}")
+
+    # The new secrets only go to the key log and then the key file, never to stdout
+    key_log = batch_key_rotator.RotationKeyLog(args.key_file or batch_key_rotator.rotation_output_filename(plan))
+    args.reporter(f"Saving New Keys To {key_log.filename} As Each User Finishes")
+    batch_key_rotator.run_rotation_plan(session, plan, max_workers=args.workers, on_user_complete=report_user,
+                                        key_log=key_log)
+
+    key_file = batch_key_rotator.write_rotation_output(plan, key_log)
+    args.reporter(f"New Keys Written To {key_file}")
+
+    return {**plan.to_dict(include_secrets=False), "keyFile": key_file}, 1 if plan.failed else 0
+
+
+# The accounts an org command runs in, either the --accounts list or every active account in the organization
+def _get_accounts(session, args):
+    if args.accounts:
+        return args.accounts
+    return org_scanner.list_organization_accounts(session)
+
+
+def _accounts_result(accounts):
+    result = {"accounts": list(accounts.values()),
+              "failedAccounts": [account.account_id for account in accounts.values() if not account.succeeded]}
+    return result, 0 if not result["failedAccounts"] else 1
+
+
+def run_org_sg_scan(session, args):
+    def report_job(account_id, region, task):
+        if task.error is None:
+            args.reporter(f"{account_id} {region} Scan Complete ({task.elapsed_seconds:.1f}s)")
+        else:
+            args.reporter(f"{account_id} {region} Scan Failed: {task.error}")
+
+    accounts = org_scanner.scan_organization_security_groups(
+        session, _get_accounts(session, args), args.role, regions=args.regions, session_name=args.org_session_name,
+        max_workers=args.workers, region_timeout=args.timeout, on_job_complete=report_job)
+
+    for account in accounts.values():
+        if account.error is not None:
+            args.reporter(f"{account.account_id} Failed: {account.error}")
+
+    return _accounts_result(accounts)
+
+
+def run_org_iam_report(session, args):
+    def report_account(account):
+        if account.error is None:
+            args.reporter(f"{account.account_id} Report Complete")
+
+    accounts = org_scanner.get_organization_iam_users(session, _get_accounts(session, args), args.role,
+                                                      session_name=args.org_session_name, max_workers=args.workers,
+                                                      on_account_complete=report_account)
+
+    for account in accounts.values():
+        if account.error is not None:
+            args.reporter(f"{account.account_id} Failed: {account.error}")
+
+    return _accounts_result(accounts)
+
+
+def _transfer_result(progress, **details):
+    return {**details, "transfer": progress}, 1 if progress.failed else 0
+
+
+def run_s3_download(session, args):
+    progress = s3_explorer.download_prefix(session, args.bucket, args.prefix, args.local_path,
+                                           recurse=not args.no_recurse, max_workers=args.workers,
+                                           reporter=args.reporter)
+    return _transfer_result(progress, bucket=args.bucket, prefix=args.prefix, localPath=args.local_path)
+
+
+def run_s3_sync(session, args):
+    progress = s3_explorer.sync_s3_folder(session, args.bucket, args.prefix, args.local_path,
+                                          max_workers=args.workers, reporter=args.reporter)
+    return _transfer_result(progress, bucket=args.bucket, prefix=args.prefix, localPath=args.local_path)
+
+
+def run_s3_upload(session, args):
+    progress = s3_explorer.upload_directory(session, args.bucket, args.local_path, s3_prefix=args.prefix,
+                                            max_workers=args.workers, checksum_algorithm=args.checksum,
+                                            reporter=args.reporter)
+    return _transfer_result(progress, bucket=args.bucket, prefix=args.prefix, localPath=args.local_path)
+
+
+def build_parser():
+    # Options shared by every command, kept on a parent parser so they can be given after the command name
+    common = argparse.ArgumentParser(add_help=False)
+    auth = common.add_argument_group("authentication")
+    auth.add_argument("--profile", help="AWS profile name (default credential chain when not set)")
+    auth.add_argument("--region", help="Region for the session (default us-east-1)")
+    auth.add_argument("--access-key-id", help="Access key ID, use with --secret-access-key")
+    auth.add_argument("--secret-access-key", help="Secret access key")
+    auth.add_argument("--session-token", help="Session token for temporary keys")
+    auth.add_argument("--role-arn", help="Role to assume after authenticating")
+    auth.add_argument("--role-session-name", default=DEFAULT_ROLE_SESSION_NAME, help="Session name for --role-arn")
+
+    output = common.add_argument_group("output")
+    output.add_argument("--output", help="Write the JSON result to this file instead of stdout")
+    output.add_argument("--indent", type=int, default=4, help="JSON indent, 0 for a single line (default 4)")
+    output.add_argument("--quiet", action="store_true", help="Don't print progress messages to stderr")
+
+    # Options for the commands that scan every region
+    scan = argparse.ArgumentParser(add_help=False)
+    scan.add_argument("--regions", type=_comma_list, help="Comma separated regions (default all enabled regions)")
+    scan.add_argument("--workers", type=int, default=security_group_scanner.DEFAULT_SCAN_WORKERS,
+                      help="Regions scanned at the same time")
+    scan.add_argument("--timeout", type=int, default=security_group_scanner.DEFAULT_REGION_TIMEOUT_SECONDS,
+                      help="Seconds before a region scan is reported as timed out")
+
+    # Options for the commands that fan out across the accounts of an organization
+    org = argparse.ArgumentParser(add_help=False)
+    org_accounts = org.add_mutually_exclusive_group(required=True)
+    org_accounts.add_argument("--accounts", type=_comma_list, help="Comma separated 12 digit account ids")
+    org_accounts.add_argument("--org", action="store_true",
+                              help="Every active account in the organization (run from the management account)")
+    org.add_argument("--role", required=True,
+                     help="Role name, or a role ARN template containing {account_id}, to assume in each account")
+    org.add_argument("--org-session-name", default=org_scanner.DEFAULT_ORG_SESSION_NAME,
+                     help="Session name used when assuming the role in each account")
+
+    transfer = argparse.ArgumentParser(add_help=False)
+    transfer.add_argument("--workers", type=int, default=s3_explorer.DEFAULT_TRANSFER_WORKERS,
+                          help="Files transferred at the same time")
+
+    parser = argparse.ArgumentParser(prog="ttk", description="AWS Tinkerer's Toolkit. Run without a command for the "
+                                                             "interactive menus.")
+    commands = parser.add_subparsers(dest="command", required=True, metavar="command")
+
+    command = commands.add_parser("regions", parents=[common], help="List the account's regions")
+    command.add_argument("--status", choices=sorted(REGION_STATUS_FILTERS), default="all")
+    command.add_argument("--names", action="store_true", help="Include the region long names")
+    command.set_defaults(func=run_regions)
+
+    command = commands.add_parser("sg-scan", parents=[common, scan], help="Scan security groups in every region")
+    command.add_argument("--report", help="Also write the text report to this file")
+    command.set_defaults(func=run_sg_scan)
+
+    command = commands.add_parser("sg-drift", parents=[common, scan],
+                                  help="Compare security groups with the last snapshot")
+    command.add_argument("--snapshot-dir", default=sg_drift.SNAPSHOT_DIR)
+    command.add_argument("--no-save", action="store_true", help="Don't replace the snapshot with this scan")
+    command.add_argument("--fail-on-drift", action="store_true", help="Exit with 1 when anything changed")
+    command.add_argument("--report", help="Also write the text drift report to this file")
+    command.set_defaults(func=run_sg_drift)
+
+    command = commands.add_parser("iam-report", parents=[common], help="Report on every IAM user")
+    command.add_argument("--report", help="Also write the text report to this file")
+    command.set_defaults(func=run_iam_report)
+
+    command = commands.add_parser("org-sg-scan", parents=[common, scan, org],
+                                  help="Scan security groups in every region of every account")
+    command.set_defaults(func=run_org_sg_scan, workers=org_scanner.DEFAULT_ORG_WORKERS)
+
+    command = commands.add_parser("org-iam-report", parents=[common, org], help="Report on the IAM users of every account")
+    command.add_argument("--workers", type=int, default=org_scanner.DEFAULT_ORG_WORKERS,
+                         help="Accounts reported on at the same time")
+    command.set_defaults(func=run_org_iam_report)
+
+    command = commands.add_parser("rotate-keys", parents=[common], help="Rotate the access keys of IAM users")
+    command.add_argument("usernames", nargs="+")
+    command.set_defaults(func=run_rotate_keys)
+
+    command = commands.add_parser("rotate-keys-batch", parents=[common],
+                                  help="Rotate the access keys of a set of IAM users concurrently")
+    selection = command.add_argument_group("user selection", "every filter given has to match")
+    selection.add_argument("--all", action="store_true", help="Every user with access keys")
+    selection.add_argument("--users", type=_comma_list, help="Comma separated user names")
+    selection.add_argument("--group", help="Users in this IAM group")
+    selection.add_argument("--tag", help="Users with this tag, given as Key or Key=Value")
+    selection.add_argument("--min-key-age-days", type=int, help="Users with an active key at least this old")
+    command.add_argument("--workers", type=int, default=batch_key_rotator.DEFAULT_ROTATION_WORKERS,
+                         help="Users rotated at the same time")
+    command.add_argument("--dry-run", action="store_true", help="Only print the rotation plan")
+    command.add_argument("--key-file", help="File the new keys are written to (default a timestamped file), each key "
+                                            "is saved to <key file>.partial as soon as its user finishes")
+    command.set_defaults(func=run_rotate_keys_batch)
+
+    command = commands.add_parser("s3-download", parents=[common, transfer], help="Download everything under a prefix")
+    command.add_argument("bucket")
+    command.add_argument("prefix")
+    command.add_argument("local_path")
+    command.add_argument("--no-recurse", action="store_true", help="Only download the objects directly in prefix")
+    command.set_defaults(func=run_s3_download)
+
+    command = commands.add_parser("s3-sync", parents=[common, transfer],
+                                  help="Download only new or changed objects under a prefix")
+    command.add_argument("bucket")
+    command.add_argument("prefix")
+    command.add_argument("local_path")
+    command.set_defaults(func=run_s3_sync)
+
+    command = commands.add_parser("s3-upload", parents=[common, transfer], help="Upload a local folder to a bucket")
+    command.add_argument("local_path")
+    command.add_argument("bucket")
+    command.add_argument("--prefix", help="Key prefix to upload under")
+    command.add_argument("--checksum", choices=s3_explorer.SUPPORTED_CHECKSUM_ALGORITHMS,
+                         help="Checksum algorithm for the uploads")
+    command.set_defaults(func=run_s3_upload)
+
+    return parser
+
+
+# Check the options argparse can't check on its own, parser.error exits with 2 like any other invalid argument
+def validate_args(parser, args):
+    if bool(args.access_key_id) != bool(args.secret_access_key):
+        parser.error("--access-key-id and --secret-access-key must be provided together")
+
+    if args.command == "rotate-keys-batch" and not (args.all or args.users or args.group or args.tag or
+                                                    args.min_key_age_days is not None):
+        parser.error("Select the users to rotate with --all, --users, --group, --tag or --min-key-age-days")
+
+    if getattr(args, "accounts", None):
+        try:
+            args.accounts = org_scanner.validate_account_ids(args.accounts)
+        except ValueError as e:
+            parser.error(str(e))
+
+
+def write_output(result, args):
+    text = utils.stringify_json(result, indent=args.indent)
+    if args.output:
+        utils.write_file(args.output, text + "\n")
+    else:
+        print(text)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    validate_args(parser, args)
+    args.reporter = _quiet if args.quiet else _log
+
+    try:
+        session = create_session(args)
+        result, exit_code = args.func(session, args)
+    except Exception as e:
+        write_output({"error": str(e), "errorType": type(e).__name__}, args)
+        return 1
+
+    write_output(result, args)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,33 @@ import aws_utils
 import menu_builder
 import utils
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import csv
+import io
 import json
+import random
+import time
+
+# Number of seconds to wait between checks while AWS generates the IAM credential report
+CREDENTIAL_REPORT_POLL_SECONDS = 2
+
+# Maximum number of seconds to wait for the IAM credential report to be generated
+CREDENTIAL_REPORT_TIMEOUT_SECONDS = 300
+
+# Default number of users whose details are looked up at the same time
+DEFAULT_DETAIL_WORKERS = 8
+
+# Maximum number of seconds to wait for a new access key to start working, IAM is eventually consistent so a new key
+# can be rejected for a few seconds after it's created
+KEY_VERIFICATION_TIMEOUT_SECONDS = 120
+
+# First and longest delay in seconds between the checks while waiting for a new access key to start working
+KEY_VERIFICATION_INITIAL_DELAY_SECONDS = 0.5
+KEY_VERIFICATION_MAX_DELAY_SECONDS = 8
+
+# Errors STS returns while a new access key hasn't propagated yet, any other error fails the verification straight away
+KEY_PROPAGATION_ERROR_CODES = ("InvalidClientTokenId", "SignatureDoesNotMatch", "AuthFailure")
 
 class IAMUser:
     def __init__(self):
@@ -49,14 +75,8 @@ class IAMGroup:
         self.ARN = None
         self.CreateDate = None
 
-def get_iam_user_details(session, username):
-
-    client = session.client('iam')
-    response = client.get_user(UserName=username)
-
-    # Loop through each user in the response and collect the values
-    user = response.get("User")
-
+# Build an IAMUser from a user returned by get_user or list_users
+def parse_iam_user(user):
     temp_user = IAMUser()
     temp_user.AccountID = user.get("Arn").split(":")[4]
     temp_user.UserName = user.get("UserName")
@@ -64,22 +84,57 @@ def get_iam_user_details(session, username):
     temp_user.UserID = user.get("UserId")
     temp_user.CreationDate = user.get("CreateDate")
     temp_user.PasswordLastUsed = user.get("PasswordLastUsed")
-    temp_user.MFAEnabled = mfa_enabled_for_user(session, temp_user.UserName)
-    temp_user.AccessKeys = get_access_keys_for_user(session, temp_user.UserName)
-    temp_user.IAMGroups = get_user_groups(session, temp_user.UserName)
-    temp_user.Tags = get_user_tags(session, temp_user.UserName, tags=[])
-
-    # If the user has tags then loop through the access keys and add the tag to the key description
-    if len(temp_user.AccessKeys) > 0:
-        for key in temp_user.AccessKeys:
-            if temp_user.Tags is not None:
-                for tag in temp_user.Tags:
-                    if tag.key == key.AccessKeyID:
-                        key.KeyDescription = tag.value
+    return temp_user
+
+def get_iam_user_details(session, username, rate_limiter=None):
+    if rate_limiter is None:
+        rate_limiter = aws_utils.get_rate_limiter(session)
+
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
+    response = client.get_user(UserName=username)
+
+    temp_user = parse_iam_user(response.get("User"))
+
+    # Run the MFA, keys, groups and tags lookups at the same time
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        mfa_enabled = executor.submit(mfa_enabled_for_user, session, temp_user.UserName, rate_limiter)
+        access_keys = executor.submit(get_access_keys_for_user, session, temp_user.UserName, rate_limiter)
+        iam_groups = executor.submit(get_user_groups, session, temp_user.UserName, rate_limiter)
+        tags = executor.submit(get_user_tags, session, temp_user.UserName, rate_limiter=rate_limiter)
+
+        temp_user.MFAEnabled = mfa_enabled.result()
+        temp_user.AccessKeys = access_keys.result()
+        temp_user.IAMGroups = iam_groups.result()
+        temp_user.Tags = tags.result()
+
+    # If the user has tags then add the tag to the matching access key description
+    apply_key_descriptions(temp_user)
 
     # Return the user object
     return temp_user
 
+# Look up the MFA, keys, groups and tags for a user that was returned by list_users
+def populate_user_details(session, user, rate_limiter):
+    user.MFAEnabled = mfa_enabled_for_user(session, user.UserName, rate_limiter)
+    user.AccessKeys = get_access_keys_for_user(session, user.UserName, rate_limiter)
+    user.IAMGroups = get_user_groups(session, user.UserName, rate_limiter)
+    user.Tags = get_user_tags(session, user.UserName, rate_limiter=rate_limiter)
+
+    # If the user has tags then add the tag to the matching access key description
+    apply_key_descriptions(user)
+
+    return user
+
+# The key rotator tags users with the access key id as the tag key, use those tags as the key descriptions
+def apply_key_descriptions(user):
+    if user.Tags is None or len(user.AccessKeys) == 0:
+        return
+
+    descriptions = {tag.key: tag.value for tag in user.Tags}
+    for key in user.AccessKeys:
+        if key.AccessKeyID in descriptions:
+            key.KeyDescription = descriptions[key.AccessKeyID]
+
 def format_user_details(user):
     r = utils.ReportBuilder()
     r.write("Account ID: " + user.AccountID)
@@ -157,93 +212,223 @@ def comparitor_iam_users(user, search_text):
     else:
         return None
 
-# Function to retrieve the users tags
-def get_user_tags(session, username, tags=[], marker=None):
-    # Create the list of parameters to be passed into the boto call
-    params = {"UserName": username}
-
-    # If a marker is provided then add it to the list of params to pass into the boto call
-    if marker:
-        params.update({"Marker": marker})
-
-    # Create the boto client and execute the list_user_tags function with the list of parameters
-    client = session.client('iam')
-    response = client.list_user_tags(**params)
-
-    # Get the marker from the response
-    marker = response.get("Marker")
+# Function to retrieve the users tags, any tags found are added to the tags list if one is provided
+def get_user_tags(session, username, tags=None, rate_limiter=None):
+    if tags is None:
+        tags = []
 
-    # Loop though all the tags and search for the specified tag, if found return it
-    for tag in response.get("Tags"):
+    # Create the boto client and page through all of the user's tags
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
+    for tag in aws_utils.paginate(client, "list_user_tags", "Tags", UserName=username):
         t = Tag()
         t.key = tag.get('Key')
-        t. value = tag.get('Value')
+        t.value = tag.get('Value')
         tags.append(t)
 
-    # If marker has a value then recursively call this function to move to the next set of records, otherwise return null
-    if marker:
-        get_user_tags(session, username, tags, marker)
-
     return tags
 
-def get_iam_users(session,get_details=False):
+# Get all the IAM users. When get_details is true the per user lookups run on a pool of worker threads while the
+# remaining pages of users are still being listed, and the calls are rate limited so IAM throttling slows the workers
+# down instead of failing the report
+def get_iam_users(session,get_details=False, max_workers=DEFAULT_DETAIL_WORKERS, rate_limiter=None):
     users = []
-    marker = None
 
-    client = session.client('iam')
+    if rate_limiter is None:
+        rate_limiter = aws_utils.get_rate_limiter(session)
 
-    while True:
+    # The listing shares the rate limiter with the detail lookups
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
 
-        # If there is a token to continue getting records use it, otherwise retrieve the first set of records
-        if marker:
-            response = client.list_users(Marker=marker)
-        else:
-            response = client.list_users()
-
-        # Loop through each user in the response and collect the values
-        for user in response.get("Users"):
-            temp_user = IAMUser()
-            temp_user.AccountID = user.get("Arn").split(":")[4]
-            temp_user.UserName = user.get("UserName")
-            temp_user.ARN = user.get("Arn")
-            temp_user.UserID = user.get("UserId")
-            temp_user.CreationDate = user.get("CreateDate")
-            temp_user.PasswordLastUsed = user.get("PasswordLastUsed")
+    executor = None
+    pending_details = []
+    if get_details:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
 
+    try:
+        # Loop through each user as the pages are listed and collect the values
+        for user in aws_utils.paginate(client, "list_users", "Users"):
+            temp_user = parse_iam_user(user)
+
+            # Queue up the detail lookups so they run while the next page is being listed
             if get_details:
-                temp_user.MFAEnabled = mfa_enabled_for_user(session, temp_user.UserName)
-                temp_user.AccessKeys = get_access_keys_for_user(session, temp_user.UserName)
-                temp_user.IAMGroups = get_user_groups(session, temp_user.UserName)
-                temp_user.Tags = get_user_tags(session, temp_user.UserName, tags=[])
-
-                # If the user has tags then loop through the access keys and add the tag to the key description
-                if len(temp_user.AccessKeys) > 0:
-                    for key in temp_user.AccessKeys:
-                        if temp_user.Tags is not None:
-                            for tag in temp_user.Tags:
-                                if tag.key == key.AccessKeyID:
-                                    key.KeyDescription = tag.value
+                pending_details.append(executor.submit(populate_user_details, session, temp_user, rate_limiter))
 
             # Add the user to the list
             users.append(temp_user)
 
-        # Check if the response contains a next token, if it does then use it to get the next page of results,
-        # if not exit the infinite loop
-        if response.get("Marker"):
-            marker = response.get("Marker")
-        else:
-            break
+        # Wait for all the detail lookups to finish, this re-raises the first error that was hit
+        for future in pending_details:
+            future.result()
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
 
     # Return the list of users
     return users
 
+# Parse a date from the credential report, values like N/A, no_information and not_supported are returned as None
+def _parse_credential_report_date(value):
+    if value is None or value in ("N/A", "no_information", "not_supported"):
+        return None
+
+    return datetime.fromisoformat(value)
+
+
+# Generate the IAM credential report and return its rows keyed by user name along with the time the report was
+# generated. AWS reuses a report for up to 4 hours, so anything created after that time isn't in it
+def get_credential_report(session, rate_limiter=None):
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
+    deadline = time.monotonic() + CREDENTIAL_REPORT_TIMEOUT_SECONDS
+
+    # Ask AWS to generate the report and wait until it's ready (a recently generated report is reused by AWS)
+    while client.generate_credential_report().get("State") != "COMPLETE":
+        if time.monotonic() > deadline:
+            raise Exception("Timed out waiting for the IAM credential report to be generated")
+        time.sleep(CREDENTIAL_REPORT_POLL_SECONDS)
+
+    response = client.get_credential_report()
+    content = response.get("Content")
+    if isinstance(content, bytes):
+        content = content.decode("utf-8")
+
+    report = {}
+    for row in csv.DictReader(io.StringIO(content)):
+        # Skip the root account, it isn't an IAM user
+        if row.get("user") == "<root_account>":
+            continue
+        report[row.get("user")] = row
+
+    return report, response.get("GeneratedTime")
+
+
+# Build the full IAM user inventory (the same objects as get_iam_users(get_details=True)) from the account
+# authorization details and the credential report instead of making 5+ calls per user. The users, groups, tags, MFA
+# status and the last used details of active keys all come from those bulk calls. IAM has no bulk call that returns
+# access key ids and the report doesn't show inactive keys, so list_access_keys is still called per user, along with
+# get_access_key_last_used for keys the report doesn't cover and list_mfa_devices for users created after the report.
+# Those per user calls run on a pool of worker threads through the rate limiter.
+def get_iam_users_inventory(session, max_workers=DEFAULT_DETAIL_WORKERS, rate_limiter=None):
+    users = []
+    groups = {}
+    user_details = []
+
+    if rate_limiter is None:
+        rate_limiter = aws_utils.get_rate_limiter(session)
+
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
+
+    # Collect the users and groups in a single paginated sweep
+    for page in aws_utils.paginate_pages(client, "get_account_authorization_details", Filter=['User', 'Group']):
+        user_details.extend(page.get("UserDetailList", []))
+
+        for group in page.get("GroupDetailList", []):
+            temp_group = IAMGroup()
+            temp_group.Path = group.get("Path")
+            temp_group.GroupName = group.get("GroupName")
+            temp_group.GroupID = group.get("GroupId")
+            temp_group.ARN = group.get("Arn")
+            temp_group.CreateDate = group.get("CreateDate")
+            groups[temp_group.GroupName] = temp_group
+
+    credential_report, report_generated = get_credential_report(session, rate_limiter)
+
+    report_rows = []
+    for user in user_details:
+        report_row = credential_report.get(user.get("UserName"), {})
+
+        # Only trust the report for users that already existed when it was generated
+        if not report_row or report_generated is None or user.get("CreateDate") > report_generated:
+            report_row = {}
+
+        temp_user = IAMUser()
+        temp_user.AccountID = user.get("Arn").split(":")[4]
+        temp_user.UserName = user.get("UserName")
+        temp_user.ARN = user.get("Arn")
+        temp_user.UserID = user.get("UserId")
+        temp_user.CreationDate = user.get("CreateDate")
+        temp_user.PasswordLastUsed = _parse_credential_report_date(report_row.get("password_last_used"))
+        if report_row:
+            temp_user.MFAEnabled = report_row.get("mfa_active") == "true"
+        temp_user.IAMGroups = [groups[name] for name in user.get("GroupList", []) if name in groups]
+
+        temp_user.Tags = []
+        for tag in user.get("Tags", []):
+            t = Tag()
+            t.key = tag.get('Key')
+            t.value = tag.get('Value')
+            temp_user.Tags.append(t)
+
+        users.append(temp_user)
+        report_rows.append((temp_user, report_row))
+
+    # Look up what the bulk calls couldn't provide for each user
+    def populate_user_keys(item):
+        temp_user, report_row = item
+
+        if not report_row:
+            temp_user.MFAEnabled = mfa_enabled_for_user(session, temp_user.UserName, rate_limiter)
+        temp_user.AccessKeys = _get_access_keys_from_report(client, temp_user.UserName, report_row)
+
+        # If the user has tags then add the tag to the matching access key description
+        apply_key_descriptions(temp_user)
+
+    for task in utils.run_concurrently(populate_user_keys, report_rows, max_workers=max_workers):
+        if task.error is not None:
+            raise task.error
+
+    return users
+
+
+# Build the access keys for a user using the last used information from the credential report. The report only
+# covers active keys that existed when it was generated, any other key has its last used information looked up.
+def _get_access_keys_from_report(client, username, report_row):
+    access_keys = []
+
+    key_slots = [slot for slot in ("access_key_1", "access_key_2")
+                 if _parse_credential_report_date(report_row.get(f"{slot}_last_rotated")) is not None]
+
+    for key in aws_utils.paginate(client, "list_access_keys", "AccessKeyMetadata", UserName=username):
+        temp_key = IAMUserAccessKey()
+        temp_key.AccessKeyID = key.get("AccessKeyId")
+        temp_key.Status = key.get("Status")
+        temp_key.CreationDate = key.get("CreateDate")
+
+        # Match the key to its report slot by creation date
+        slot = None
+        for key_slot in key_slots:
+            rotated = _parse_credential_report_date(report_row.get(f"{key_slot}_last_rotated"))
+            if abs((rotated - temp_key.CreationDate).total_seconds()) < 1:
+                slot = key_slot
+                break
+
+        if slot is not None:
+            temp_key.LastUsedDate = _parse_credential_report_date(report_row.get(f"{slot}_last_used_date"))
+            temp_key.LastUsedRegion = report_row.get(f"{slot}_last_used_region")
+            temp_key.LastUsedServiceName = report_row.get(f"{slot}_last_used_service")
+        else:
+            _set_key_last_used(client, temp_key)
+
+        access_keys.append(temp_key)
+
+    return sorted(access_keys, key=lambda k: k.CreationDate)
+
+
+# Look up when an access key was last used
+def _set_key_last_used(client, access_key):
+    key_last_used = client.get_access_key_last_used(AccessKeyId=access_key.AccessKeyID)
+    if key_last_used.get("AccessKeyLastUsed") is not None:
+        access_key.LastUsedDate = key_last_used.get("AccessKeyLastUsed").get("LastUsedDate")
+        access_key.LastUsedRegion = key_last_used.get("AccessKeyLastUsed").get("Region")
+        access_key.LastUsedServiceName = key_last_used.get("AccessKeyLastUsed").get("ServiceName")
+
+
 # Check if the user has MFA enabled
-def mfa_enabled_for_user(session, username):
+def mfa_enabled_for_user(session, username, rate_limiter=None):
     # Set mfa enabled flag to false by default
     mfa_enabled = False
 
     # Create the boto client and execute the list_mfa_devices command for the specified user
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
     response = client.list_mfa_devices(UserName=username)
 
     # Check to see if there is an MFA device associated to the user
@@ -254,12 +439,12 @@ def mfa_enabled_for_user(session, username):
 
 
 # Function to get the access keys for the specified user
-def get_access_keys_for_user(session, username):
+def get_access_keys_for_user(session, username, rate_limiter=None):
     # Initialize an array to collect the access keys for the specified user
     access_keys = []
 
     # Create the boto client and execute the list_access_keys function for the provided user
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
     response = client.list_access_keys(UserName=username)
 
     # Check if there is an AccessKeyMetadata section in the response
@@ -272,11 +457,7 @@ def get_access_keys_for_user(session, username):
             temp_key.Status = key.get("Status")
             temp_key.CreationDate = key.get("CreateDate")
 
-            key_last_used = client.get_access_key_last_used(AccessKeyId=temp_key.AccessKeyID)
-            if key_last_used.get("AccessKeyLastUsed") is not None:
-                temp_key.LastUsedDate = key_last_used.get("AccessKeyLastUsed").get("LastUsedDate")
-                temp_key.LastUsedRegion = key_last_used.get("AccessKeyLastUsed").get("Region")
-                temp_key.LastUsedServiceName = key_last_used.get("AccessKeyLastUsed").get("ServiceName")
+            _set_key_last_used(client, temp_key)
 
             # Add the AccessKey object to the list
             access_keys.append(temp_key)
@@ -285,36 +466,38 @@ def get_access_keys_for_user(session, username):
     return access_keys
 
 
-def update_access_key(session, username, access_key_id, set_status_inactive):
+def update_access_key(session, username, access_key_id, set_status_inactive, rate_limiter=None):
     # Create the list of parameters to be passed into the boto call
     params = {"UserName": username, "AccessKeyId": access_key_id}
 
-    # Check if the status should be set to inactive, if true set the status to inactive and add it to the parameters dictionary
+    # Set the status to inactive, or back to active when set_status_inactive is false
     if set_status_inactive:
         params.update({"Status": 'Inactive'})
+    else:
+        params.update({"Status": 'Active'})
 
     # Create the client and execute the list_users command with the created parameters
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
     client.update_access_key(**params)
 
 
 # Function to delete a specified users access key
-def delete_access_key(session, username, access_key_id):
+def delete_access_key(session, username, access_key_id, rate_limiter=None):
     # Create the list of parameters to be passed into the boto call
     params = {"UserName": username, "AccessKeyId": access_key_id}
 
     # Create the client and execute the delete_access_key command with the created parameters
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
     client.delete_access_key(**params)
 
 
 # Function to create a new access key for a specified user
-def create_access_key(session, username):
+def create_access_key(session, username, rate_limiter=None):
     # Create the list of parameters to be passed into the boto call
     params = {"UserName": username}
 
     # Create the client and execute the delete_access_key command with the created parameters
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
     response = client.create_access_key(**params)
 
     # Pull out the AccessKey section of the response
@@ -330,8 +513,9 @@ def create_access_key(session, username):
     # Return the access key information
     return access_key
 
-def format_users_report(session,users):
-    r = utils.ReportBuilder()
+# Build the report text, if a stream is provided the report is written to it as it's built and None is returned
+def format_users_report(session,users, stream=None):
+    r = utils.ReportBuilder(stream)
     header_name = "AWS Security Group Report"
     header = menu_builder.build_header(header_name, 20)
     divider = menu_builder.build_divider(header_name, padding=20)
@@ -381,116 +565,237 @@ def format_users_report(session,users):
 
         r.newline()
 
-    return str(r)
+    return None if stream else str(r)
+
+# Description the rotator tags new access keys with, the key id is used as the tag key
+def rotation_tag_value():
+    return f"Key Rotation By Tinkerer Toolkit: {utils.datetime_now_string()}"
+
+
+# One user's key rotation: which existing keys get deleted and deactivated, the key that was created and how far the
+# rotation got, so a failed rotation can be rolled back and reported
+class KeyRotation:
+    def __init__(self, username, account_id=None):
+        self.UserName = username
+        self.AccountID = account_id
+        self.DeleteKeyIDs = []
+        self.DeactivateKeyIDs = []
+        self.NewAccessKey = None
+        self.DeletedKeyIDs = []
+        self.DeactivatedKeyIDs = []
+        self.Status = "planned"
+        self.Error = None
+        self.RollbackError = None
+        self.Verification = None
+        self.ElapsedSeconds = None
+
+    def to_dict(self, include_secret=True):
+        new_key = None
+        if self.NewAccessKey is not None:
+            new_key = {"AccessKeyID": self.NewAccessKey.AccessKeyID, "Status": self.NewAccessKey.Status,
+                       "CreationDate": self.NewAccessKey.CreationDate}
+            if include_secret:
+                new_key["SecretAccessKey"] = self.NewAccessKey.SecretAccessKey
+
+        return {
+            "UserName": self.UserName,
+            "AccountID": self.AccountID,
+            "Status": self.Status,
+            "DeleteKeyIDs": self.DeleteKeyIDs,
+            "DeactivateKeyIDs": self.DeactivateKeyIDs,
+            "DeletedKeyIDs": self.DeletedKeyIDs,
+            "DeactivatedKeyIDs": self.DeactivatedKeyIDs,
+            "NewAccessKey": new_key,
+            "Error": None if self.Error is None else str(self.Error),
+            "RollbackError": None if self.RollbackError is None else str(self.RollbackError),
+            "Verification": self.Verification,
+            "ElapsedSeconds": self.ElapsedSeconds,
+        }
+
+
+# Work out the rotation for a user from their current access keys. A user can only have 2 keys, so with 2 keys the
+# oldest is deleted to make room for the new key and the newer one is deactivated, with 1 key it's deactivated and
+# with none a key is just created
+def plan_key_rotation(user):
+    rotation = KeyRotation(user.UserName, user.AccountID)
+    access_keys = sorted(user.AccessKeys, key=lambda k: k.CreationDate)
+
+    if len(access_keys) == 1:
+        rotation.DeactivateKeyIDs.append(access_keys[0].AccessKeyID)
+    elif len(access_keys) == 2:
+        rotation.DeleteKeyIDs.append(access_keys[0].AccessKeyID)
+        rotation.DeactivateKeyIDs.append(access_keys[1].AccessKeyID)
+    elif len(access_keys) > 2:
+        raise Exception("The user has more than 2 access keys, this is not supported")
 
-def rotate_access_keys(session, username):
+    return rotation
+
+
+# The result of polling a new access key until it works
+class KeyVerification:
+    def __init__(self, access_key_id):
+        self.AccessKeyID = access_key_id
+        self.Verified = False
+        self.Attempts = 0
+        self.PropagationSeconds = None
+        self.Arn = None
+
+    def to_dict(self):
+        return {
+            "AccessKeyID": self.AccessKeyID,
+            "Verified": self.Verified,
+            "Attempts": self.Attempts,
+            "PropagationSeconds": self.PropagationSeconds,
+            "Arn": self.Arn,
+        }
+
+
+# Poll sts get_caller_identity with the new access key until it's accepted, backing off exponentially (with jitter)
+# up to timeout seconds. The check fails straight away if the key works but belongs to someone other than username.
+# Returns a KeyVerification with the number of attempts and how long the key took to propagate, pass one in to keep
+# the attempts when the verification fails.
+def verify_access_key(access_key, username=None, region_name=None, timeout=KEY_VERIFICATION_TIMEOUT_SECONDS,
+                      verification=None):
+    verification = verification or KeyVerification(access_key.AccessKeyID)
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = KEY_VERIFICATION_INITIAL_DELAY_SECONDS
+
+    temp_keys = aws_utils.AwsCredentials(access_key.AccessKeyID, access_key.SecretAccessKey)
+    test_session = aws_utils.create_aws_session(region_name=region_name, aws_credentials=temp_keys)
+
+    # The client is built straight from the session so a key that's being tested never ends up in the client cache
+    client = test_session.client("sts")
 
-    # 1. Get the user details
-    user = get_iam_user_details(session, username)
+    while True:
+        verification.Attempts += 1
+        try:
+            identity = client.get_caller_identity()
+            break
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in KEY_PROPAGATION_ERROR_CODES:
+                raise
 
-    # 2. Get the access keys for the user
-    access_keys = user.AccessKeys
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception(f"The new access key was not accepted after {timeout} seconds "
+                            f"({verification.Attempts} attempts)")
 
-    # 3. Check to see if the user has any access keys -- if not then create a new access key
-    if len(access_keys) == 0:
-        iam_access_key = create_access_key(session, username)
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(KEY_VERIFICATION_MAX_DELAY_SECONDS, delay * 2)
 
-        # Tag the new key with a description
-        tag_user(session, username, iam_access_key.AccessKeyID, f"Key Rotation By Tinkerer Toolkit: {utils.datetime_now_string()}")
+    verification.PropagationSeconds = time.monotonic() - start
+    verification.Arn = identity.get("Arn")
 
-    # 4. If there is only 1 then create a new key and inactivate the old key
-    elif len(access_keys) == 1:
-        # Get the old access key id
-        old_access_key_id = access_keys[0].AccessKeyID
-        # create a new access key
-        iam_access_key = create_access_key(session, username)
+    if username is not None and not verification.Arn.endswith(f"/{username}"):
+        raise Exception(f"The new access key belongs to {verification.Arn}, not {username}")
 
-        # build a new session with the new access key and test that it works
-        temp_keys = aws_utils.AwsCredentials(iam_access_key.AccessKeyID, iam_access_key.SecretAccessKey)
-        test_session = aws_utils.create_aws_session(aws_credentials=temp_keys)
+    verification.Verified = True
+    return verification
 
-        if test_session is None:
-            raise Exception("Unable to create a new session with the new access key")
 
-        # Tag the new key with a description
-        tag_user(session, username, iam_access_key.AccessKeyID, f"Key Rotation By Tinkerer Toolkit: {utils.datetime_now_string()}")
+# Carry out a planned rotation. If any step fails the rotation is rolled back and the error is re-raised. The calls go
+# through rate_limiter when one is provided so batch rotations back off when IAM throttles them.
+def apply_key_rotation(session, rotation, rate_limiter=None):
+    username = rotation.UserName
+    start = time.monotonic()
+
+    try:
+        # Make room for the new key, a deleted key can't be brought back by a rollback
+        for access_key_id in rotation.DeleteKeyIDs:
+            delete_access_key(session, username, access_key_id, rate_limiter=rate_limiter)
+            rotation.DeletedKeyIDs.append(access_key_id)
+            delete_user_tag(session, username, access_key_id, rate_limiter=rate_limiter)
 
-        # inactivate the old access key
-        update_access_key(session, username, old_access_key_id, True)
+        rotation.NewAccessKey = create_access_key(session, username, rate_limiter=rate_limiter)
 
+        # The old keys are only deactivated once the new key has been seen working
+        rotation.Verification = KeyVerification(rotation.NewAccessKey.AccessKeyID)
+        verify_access_key(rotation.NewAccessKey, username, region_name=session.region_name,
+                          verification=rotation.Verification)
 
-    # 5. If the user has access keys then check if they are both active -- if not then throw an error
-    elif len(access_keys) == 2:
-        key_1 = access_keys[0]
-        key_2 = access_keys[1]
+        # Tag the new key with a description
+        tag_user(session, username, rotation.NewAccessKey.AccessKeyID, rotation_tag_value(),
+                 rate_limiter=rate_limiter)
 
-        if key_1.CreationDate < key_2.CreationDate:
-            old_access_key_id = key_1.AccessKeyID
-            latest_existing_access_key = key_2.AccessKeyID
-        else:
-            old_access_key_id = key_2.AccessKeyID
-            latest_existing_access_key = key_1.AccessKeyID
+        for access_key_id in rotation.DeactivateKeyIDs:
+            update_access_key(session, username, access_key_id, True, rate_limiter=rate_limiter)
+            rotation.DeactivatedKeyIDs.append(access_key_id)
+    except Exception as e:
+        rotation.Error = e
+        rollback_key_rotation(session, rotation, rate_limiter)
+        raise
+    finally:
+        rotation.ElapsedSeconds = time.monotonic() - start
 
-        # Delete the old access key
-        delete_access_key(session, username, old_access_key_id)
+    rotation.Status = "rotated"
+    return rotation
 
-        # Delete the old access key tag
-        delete_user_tag(session, username, old_access_key_id)
 
-        # create a new access key
-        iam_access_key = create_access_key(session, username)
+# Undo a failed rotation: reactivate the keys that were deactivated and delete the new key and its tag. Keys that
+# were already deleted can't be restored. The status is set to rolled_back, or rollback_failed if any step failed.
+def rollback_key_rotation(session, rotation, rate_limiter=None):
+    username = rotation.UserName
 
-        # build a new session with the new access key and test that it works
-        temp_keys = aws_utils.AwsCredentials(iam_access_key.AccessKeyID, iam_access_key.SecretAccessKey)
-        test_session = aws_utils.create_aws_session(aws_credentials=temp_keys)
+    try:
+        for access_key_id in reversed(list(rotation.DeactivatedKeyIDs)):
+            update_access_key(session, username, access_key_id, False, rate_limiter=rate_limiter)
+            rotation.DeactivatedKeyIDs.remove(access_key_id)
 
-        if test_session is None:
-            raise Exception("Unable to create a new session with the new access key")
+        if rotation.NewAccessKey is not None:
+            delete_access_key(session, username, rotation.NewAccessKey.AccessKeyID, rate_limiter=rate_limiter)
+            delete_user_tag(session, username, rotation.NewAccessKey.AccessKeyID, rate_limiter=rate_limiter)
+            rotation.NewAccessKey = None
+    except Exception as e:
+        rotation.RollbackError = e
+        rotation.Status = "rollback_failed"
+        return rotation
 
-        # Tag the new key with a description
-        tag_user(session, username, iam_access_key.AccessKeyID, f"Key Rotation By Tinkerer Toolkit: {utils.datetime_now_string()}")
+    rotation.Status = "rolled_back"
+    return rotation
 
-        # inactivate the old access key
-        update_access_key(session, username, latest_existing_access_key, True)
-        tag_user(session, username, iam_access_key.AccessKeyID,
-                 f"Key Rotation By Tinkerer Toolkit: {utils.datetime_now_string()}")
 
-    else:
-        raise Exception("The user has more than 2 access keys, this is not supported")
+def rotate_access_keys(session, username):
 
-    # 7. Write the new key info to a json file
+    # 1. Get the user details
+    user = get_iam_user_details(session, username)
+
+    # 2. Work out which keys to delete and deactivate, then create and test the new key and retire the old ones
+    rotation = apply_key_rotation(session, plan_key_rotation(user))
+    iam_access_key = rotation.NewAccessKey
+
+    # 3. Write the new key info to a json file
     iam_key_filename = f"{utils.datetime_now_string("%Y-%m-%dT%H-%M-%S")}--{str(user.AccountID)}--{user.UserName}--AccessKeyInfo.json"
     utils.write_json_file(iam_key_filename, iam_access_key)
 
-    return
+    return iam_access_key
 
-def tag_user(session, username, key, value):
+def tag_user(session, username, key, value, rate_limiter=None):
     # Create the client and execute the tag_user command with the created parameters
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
     client.tag_user(UserName=username, Tags=[{"Key": key, "Value": value}])
 
-def delete_user_tag(session, username, key):
+def delete_user_tag(session, username, key, rate_limiter=None):
     # Create the client and execute the tag_user command with the created parameters
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
     client.untag_user(UserName=username, TagKeys=[key])
 
 def list_iam_groups(session):
-    client = session.client('iam')
-    response = client.list_groups()
+    client = aws_utils.get_client(session, 'iam')
 
     groups = []
-    for group in response.get("Groups"):
+    for group in aws_utils.paginate(client, "list_groups", "Groups"):
         groups.append(group.get("GroupName"))
 
     return groups
 
 def add_user_to_group(session, username, group_name):
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam')
     client.add_user_to_group(UserName=username, GroupName=group_name)
 
 
 def ensure_quarantine_group(session):
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam')
 
     group_name = 'quarantine'
     managed_policy_arn = 'arn:aws:iam::aws:policy/AWSDenyAll'
@@ -527,42 +832,26 @@ def quarantine_user(session, username):
     add_user_to_group(session, username, group_name)
 
 def remove_user_from_group(session, username,group_name):
-    client = session.client('iam')
+    client = aws_utils.get_client(session, 'iam')
     # Remove user from group
     client.remove_user_from_group(GroupName=group_name, UserName=username)
 
-def get_user_groups(session,username):
+def get_user_groups(session,username, rate_limiter=None):
     user_groups = []
-    marker = None
-
-    client = session.client('iam')
 
-    while True:
-
-        # If there is a token to continue getting records use it, otherwise retrieve the first set of records
-        if marker:
-            response = client.list_groups_for_user(UserName=username,Marker=marker)
-        else:
-            response = client.list_groups_for_user(UserName=username)
-
-        # Loop through each user in the response and collect the values
-        for group in response.get("Groups"):
-            temp_group = IAMGroup()
-            temp_group.Path = group.get("Path")
-            temp_group.GroupName = group.get("GroupName")
-            temp_group.GroupID = group.get("GroupId")
-            temp_group.ARN = group.get("Arn")
-            temp_group.CreateDate = group.get("CreateDate")
+    client = aws_utils.get_client(session, 'iam', rate_limiter=rate_limiter)
 
-            # Add the user to the list
-            user_groups.append(temp_group)
+    # Loop through each group the user is a member of and collect the values
+    for group in aws_utils.paginate(client, "list_groups_for_user", "Groups", UserName=username):
+        temp_group = IAMGroup()
+        temp_group.Path = group.get("Path")
+        temp_group.GroupName = group.get("GroupName")
+        temp_group.GroupID = group.get("GroupId")
+        temp_group.ARN = group.get("Arn")
+        temp_group.CreateDate = group.get("CreateDate")
 
-        # Check if the response contains a next token, if it does then use it to get the next page of results,
-        # if not exit the infinite loop
-        if response.get("Marker"):
-            marker = response.get("Marker")
-        else:
-            break
+        # Add the group to the list
+        user_groups.append(temp_group)
 
-    # Return the list of users
+    # Return the list of groups
     return user_groups
\ No newline at end of file
@@ -17,6 +17,56 @@ class FormItem:
         self.response = None
 
 
+# List like wrapper around an iterator that only pulls items from the iterator when they are needed, this lets a
+# menu show the first page of a long listing while the rest of it hasn't been loaded yet
+class LazyList:
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._items = []
+        self.exhausted = False
+
+    # Pull items from the iterator until at least count items are loaded, None loads everything
+    def _load(self, count=None):
+        while not self.exhausted and (count is None or len(self._items) < count):
+            try:
+                self._items.append(next(self._iterator))
+            except StopIteration:
+                self.exhausted = True
+
+    def loaded_count(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.stop is None or index.stop < 0 or (index.start is not None and index.start < 0):
+                self._load()
+            else:
+                self._load(index.stop)
+        elif index < 0:
+            self._load()
+        else:
+            self._load(index + 1)
+
+        return self._items[index]
+
+    def __len__(self):
+        self._load()
+        return len(self._items)
+
+    def __bool__(self):
+        self._load(1)
+        return len(self._items) > 0
+
+    def __iter__(self):
+        index = 0
+        while True:
+            self._load(index + 1)
+            if index >= len(self._items):
+                return
+            yield self._items[index]
+            index += 1
+
+
 # Create a Pageinator class for paging through search results
 class Paginator:
     def __init__(self, items, page_size=10):
@@ -31,32 +81,50 @@ class Paginator:
 
     def next_page(self):
         self.current_page += 1
-        if self.current_page * self.page_size >= len(self.items):
+        if len(self.get_current_page()) == 0:
             self.current_page = 0  # Wrap around to the first page
         return self.get_page(self.current_page)
 
+    # Going back from the first page wraps around to the last page, unless the items aren't fully loaded yet because
+    # finding the last page of a LazyList would load the whole listing
     def previous_page(self):
         self.current_page -= 1
         if self.current_page < 0:
-            self.current_page = (len(self.items) - 1) // self.page_size  # Wrap around to the last page
+            if self.is_complete():
+                self.current_page = max(0, (len(self.items) - 1) // self.page_size)  # Wrap around to the last page
+            else:
+                self.current_page = 0
         return self.get_page(self.current_page)
 
     def get_current_page(self):
         return self.get_page(self.current_page)
 
+    # Checked by loading the next page so a LazyList doesn't have to be loaded in full
     def has_next_page(self):
-        return (self.current_page + 1) * self.page_size < len(self.items)
+        return len(self.get_page(self.current_page + 1)) > 0
 
     def has_previous_page(self):
         return self.current_page > 0
 
+    # Check if all the items are known, a LazyList that hasn't been fully loaded yet isn't complete
+    def is_complete(self):
+        return not isinstance(self.items, LazyList) or self.items.exhausted
+
+    # Number of items that are currently known without loading any more
+    def known_item_count(self):
+        if isinstance(self.items, LazyList):
+            return self.items.loaded_count()
+        return len(self.items)
+
     def total_pages(self):
-        return (len(self.items) + self.page_size - 1) // self.page_size
+        pages = (self.known_item_count() + self.page_size - 1) // self.page_size
+        return pages if self.is_complete() else f"{pages}+"
 
     def current_range_string(self):
         start = (self.current_page * self.page_size) + 1
-        end = min((start - 1) + self.page_size, len(self.items))
-        return f"{start}-{end} of {len(self.items)}"
+        end = min((start - 1) + self.page_size, self.known_item_count())
+        total = self.known_item_count() if self.is_complete() else f"{self.known_item_count()}+"
+        return f"{start}-{end} of {total}"
 
 
 def wait_for_input():
@@ -264,7 +332,7 @@ def search_builder(header_name, section_name=None, search_list=None, comparator_
     if search_prompt_text is None:
         search_prompt_text = "Please enter a search term:"
 
-    if search_text is None and len(search_results) == 0:
+    if search_text is None and not search_results:
         clear_screen()
         print(menu)
         search_text = input(search_prompt_text)
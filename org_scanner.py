@@ -0,0 +1,178 @@
+import re
+
+import aws_utils
+import iam_key_rotator
+import regex_patterns
+import security_group_scanner
+import utils
+
+# Org fan-out: assume a role in every account of an AWS Organization (or a provided list of accounts) and run the
+# security group scan or IAM report in all of them at once. Role assumption runs in parallel, and the region x account
+# scan jobs share one bounded pool so a large organization can't start an unbounded number of threads. The results
+# are partitioned by account and an account that fails (role can't be assumed, regions can't be listed) is reported
+# on its own without stopping the others.
+
+# Number of role assumptions and region x account scan jobs that run at the same time
+DEFAULT_ORG_WORKERS = 16
+
+DEFAULT_ORG_SESSION_NAME = "AWSTinkererToolkitOrg"
+
+# Placeholder the role ARN template uses for the account id
+ACCOUNT_ID_PLACEHOLDER = "{account_id}"
+
+
+class AccountResult:
+    def __init__(self, account_id, role_arn=None):
+        self.account_id = account_id
+        self.role_arn = role_arn
+        self.session = None
+        self.regions = []
+        self.results = {}
+        self.errors = {}
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return self.error is None and not self.errors
+
+    def to_dict(self):
+        return {
+            "accountId": self.account_id,
+            "roleArn": self.role_arn,
+            "error": None if self.error is None else str(self.error),
+            "results": self.results,
+            "errors": {key: str(error) for key, error in self.errors.items()},
+        }
+
+
+# Check every account id is a 12 digit AWS account id, raising ValueError with the invalid ones. Duplicates are
+# dropped and the order is kept
+def validate_account_ids(account_ids):
+    account_ids = [str(account_id).strip() for account_id in account_ids]
+    invalid = [account_id for account_id in account_ids
+               if not re.match(regex_patterns.REGEX_AWS_ACCOUNT_ID, account_id)]
+    if invalid:
+        raise ValueError(f"Invalid AWS account ids: {', '.join(invalid)}")
+
+    return list(dict.fromkeys(account_ids))
+
+
+# Build the role ARN for an account. role is either an ARN template containing {account_id}
+# (e.g. arn:aws:iam::{account_id}:role/OrgAudit) or just a role name, which is expanded in the session's partition
+def build_role_arn(role, account_id, partition="aws"):
+    if ACCOUNT_ID_PLACEHOLDER in role:
+        return role.replace(ACCOUNT_ID_PLACEHOLDER, account_id)
+    if role.startswith("arn:"):
+        raise ValueError(f"Role ARN template must contain {ACCOUNT_ID_PLACEHOLDER}: {role}")
+    return f"arn:{partition}:iam::{account_id}:role/{role}"
+
+
+# List the account ids in the organization, this has to be run from the management account or a delegated admin
+def list_organization_accounts(session, active_only=True):
+    client = aws_utils.get_client(session, "organizations")
+
+    account_ids = []
+    for account in aws_utils.paginate(client, "list_accounts", "Accounts"):
+        if active_only and account.get("Status") != "ACTIVE":
+            continue
+        account_ids.append(account.get("Id"))
+
+    return account_ids
+
+
+# Assume the role in every account in parallel. Returns {account id: AccountResult} in the order of account_ids, each
+# with a session for the account or the error that stopped it. When list_regions is true the account's enabled regions
+# are listed with the new session as well.
+def assume_account_roles(session, account_ids, role, session_name=DEFAULT_ORG_SESSION_NAME,
+                         max_workers=DEFAULT_ORG_WORKERS, list_regions=False):
+    account_ids = validate_account_ids(account_ids)
+    partition = aws_utils.get_partition(session)
+    accounts = {account_id: AccountResult(account_id, build_role_arn(role, account_id, partition))
+                for account_id in account_ids}
+
+    def assume(account_id):
+        account = accounts[account_id]
+        provider = aws_utils.AssumeRoleCredentialProvider(session, account.role_arn, session_name)
+
+        # Creating the session assumes the role, so an account whose role can't be assumed fails here once instead
+        # of in every region
+        account_session = provider.create_session(region_name=session.region_name)
+
+        regions = []
+        if list_regions:
+            regions = aws_utils.get_regions(account_session,
+                                            region_status_filter=aws_utils.AccountStatusFilters.ENABLED)
+        return account_session, regions
+
+    for task in utils.run_concurrently(assume, account_ids, max_workers=max_workers):
+        account = accounts[task.item]
+        if task.error is None:
+            account.session, account.regions = task.result
+        else:
+            account.error = task.error
+
+    return accounts
+
+
+# Scan the security groups of every region in every account. regions can be a list used for every account, otherwise
+# each account's enabled regions are scanned. All the region x account jobs run on one pool of max_workers threads.
+# Returns {account id: AccountResult} with results {region: [SecurityGroup]} and errors {region: error}.
+def scan_organization_security_groups(session, account_ids, role, regions=None,
+                                      session_name=DEFAULT_ORG_SESSION_NAME, max_workers=DEFAULT_ORG_WORKERS,
+                                      region_timeout=security_group_scanner.DEFAULT_REGION_TIMEOUT_SECONDS,
+                                      on_job_complete=None):
+    accounts = assume_account_roles(session, account_ids, role, session_name=session_name, max_workers=max_workers,
+                                    list_regions=regions is None)
+
+    jobs = []
+    for account in accounts.values():
+        if account.error is None:
+            if regions is not None:
+                account.regions = list(regions)
+            jobs.extend((account.account_id, region) for region in account.regions)
+
+    def scan(job):
+        account_id, region = job
+        account_session = aws_utils.change_session_region(accounts[account_id].session, region)
+        return security_group_scanner.get_security_groups(account_session)
+
+    completed = {}
+    for task in utils.run_concurrently(scan, jobs, max_workers=max_workers, timeout=region_timeout):
+        account_id, region = task.item
+        if task.error is None:
+            completed[task.item] = task.result
+        else:
+            accounts[account_id].errors[region] = task.error
+
+        if on_job_complete:
+            on_job_complete(account_id, region, task)
+
+    # Put each account's regions back in order so the results are stable between runs
+    for account in accounts.values():
+        account.results = {region: completed[(account.account_id, region)] for region in account.regions
+                           if (account.account_id, region) in completed}
+
+    return accounts
+
+
+# Build the IAM users inventory of every account in parallel. Returns {account id: AccountResult} with results
+# {"users": [IAMUser]} and the account error set if the role or the report failed.
+def get_organization_iam_users(session, account_ids, role, session_name=DEFAULT_ORG_SESSION_NAME,
+                               max_workers=DEFAULT_ORG_WORKERS, on_account_complete=None):
+    accounts = assume_account_roles(session, account_ids, role, session_name=session_name, max_workers=max_workers)
+
+    def report(account_id):
+        return iam_key_rotator.get_iam_users_inventory(accounts[account_id].session)
+
+    assumed = [account.account_id for account in accounts.values() if account.error is None]
+    for task in utils.run_concurrently(report, assumed, max_workers=max_workers):
+        account = accounts[task.item]
+        if task.error is None:
+            account.results = {"users": task.result}
+        else:
+            account.error = task.error
+
+        if on_account_complete:
+            on_account_complete(account)
+
+    return accounts
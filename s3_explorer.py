@@ -1,15 +1,206 @@
+import hashlib
+import heapq
+import json
 import os
+import threading
+import time
 
-import requests
+from boto3.s3.transfer import TransferConfig
 
+import aws_utils
 import menu_builder
 import utils
 
+# Default number of objects that are transferred at the same time
+DEFAULT_TRANSFER_WORKERS = 16
+
+# Default number of threads used to transfer the parts of a single multipart object
+DEFAULT_PART_CONCURRENCY = 4
+
+# Objects at or above this size are transferred in parts
+DEFAULT_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+# Size of each part of a multipart transfer
+DEFAULT_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+# Checksum algorithms S3 can calculate and verify for an upload
+SUPPORTED_CHECKSUM_ALGORITHMS = ("CRC32", "CRC32C", "SHA1", "SHA256")
+
+# Where the folder sync manifests are kept, outside the synced folders so they're never uploaded with them
+SYNC_MANIFEST_DIR = os.path.join(os.path.expanduser("~"), ".ttk", "sync_manifests")
+
+
+# Tracks the aggregate progress of a multi-object transfer, the methods are safe to call from worker threads and
+# add_bytes can be passed straight to boto as the transfer callback
+class TransferProgress:
+    def __init__(self, total_files=0, total_bytes=0, report_interval=2.0, reporter=print):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.completed_files = 0
+        self.skipped_files = 0
+        self.transferred_bytes = 0
+        self.failed = {}
+        self.report_interval = report_interval
+        self.reporter = reporter
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self._last_report = self.start_time
+        self._lock = threading.Lock()
+
+    def add_bytes(self, byte_count):
+        with self._lock:
+            self.transferred_bytes += byte_count
+            now = time.monotonic()
+            report_due = self.reporter and self.report_interval and now - self._last_report >= self.report_interval
+            if report_due:
+                self._last_report = now
+
+        if report_due:
+            self.reporter(self.status_line())
+
+    def file_complete(self):
+        with self._lock:
+            self.completed_files += 1
+
+    def file_skipped(self):
+        with self._lock:
+            self.skipped_files += 1
+
+    def file_failed(self, name, error):
+        with self._lock:
+            self.failed[name] = error
+
+    def finish(self):
+        self.end_time = time.monotonic()
+
+    def elapsed_seconds(self):
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    # Average throughput in bytes per second
+    def throughput(self):
+        elapsed = self.elapsed_seconds()
+        return self.transferred_bytes / elapsed if elapsed > 0 else 0
+
+    def status_line(self):
+        return (f"{self.completed_files}/{self.total_files} files | "
+                f"{utils.foramt_bytes(self.transferred_bytes)} of {utils.foramt_bytes(self.total_bytes)} | "
+                f"{utils.foramt_bytes(int(self.throughput()))}/s")
+
+    def to_dict(self):
+        return {
+            "totalFiles": self.total_files,
+            "completedFiles": self.completed_files,
+            "skippedFiles": self.skipped_files,
+            "failedFiles": {name: str(error) for name, error in self.failed.items()},
+            "totalBytes": self.total_bytes,
+            "transferredBytes": self.transferred_bytes,
+            "elapsedSeconds": self.elapsed_seconds(),
+            "bytesPerSecond": self.throughput(),
+        }
+
+    def summary(self):
+        summary = f"{self.status_line()} | {self.elapsed_seconds():.1f}s"
+        if self.skipped_files:
+            summary += f" | {self.skipped_files} unchanged"
+        if self.failed:
+            summary += f" | {len(self.failed)} failed"
+        return summary
+
+
+# Local record of the objects a folder sync has already downloaded. Every completed download is appended to a journal
+# file straight away so an interrupted sync can resume, and the journal is folded into the manifest when the sync ends.
+# There is one manifest per local folder, bucket and prefix, kept in manifest_dir.
+class SyncManifest:
+    def __init__(self, local_path, bucket_name, prefix, manifest_dir=SYNC_MANIFEST_DIR):
+        self.local_path = os.path.abspath(local_path)
+        self.bucket_name = bucket_name
+        self.prefix = prefix or ""
+
+        sync_id = hashlib.sha256(json.dumps([self.local_path, self.bucket_name, self.prefix]).encode()).hexdigest()
+        self.path = os.path.join(manifest_dir, f"{sync_id}.json")
+        self.journal_path = self.path + ".journal"
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    # Check that a manifest or journal entry was written for the same local folder, bucket and prefix
+    def _matches(self, record):
+        return (record.get("localPath") == self.local_path and record.get("bucket") == self.bucket_name and
+                record.get("prefix") == self.prefix)
+
+    def load(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        if os.path.isfile(self.path):
+            manifest = json.loads(utils.read_file(self.path))
+
+            if self._matches(manifest):
+                self.entries = manifest.get("objects", {})
+
+        # Replay downloads that finished after the manifest was last saved, a partly written last line is ignored
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, 'r') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if self._matches(entry):
+                        self.entries[entry["key"]] = entry["object"]
+
+        return self
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def record(self, obj):
+        entry = {"size": obj.get('Size'), "etag": obj.get('ETag'), "last_modified": str(obj.get('LastModified'))}
+        line = json.dumps({"localPath": self.local_path, "bucket": self.bucket_name, "prefix": self.prefix,
+                           "key": obj['Key'], "object": entry})
+
+        with self._lock:
+            self.entries[obj['Key']] = entry
+            with open(self.journal_path, 'a') as journal:
+                journal.write(line + "\n")
+
+    # Write the full manifest and remove the journal, the manifest is swapped in atomically
+    def save(self):
+        with self._lock:
+            temp_path = self.path + ".tmp"
+            utils.write_file(temp_path, json.dumps({"localPath": self.local_path, "bucket": self.bucket_name,
+                                                    "prefix": self.prefix, "objects": self.entries}))
+            os.replace(temp_path, self.path)
+
+            if os.path.isfile(self.journal_path):
+                os.remove(self.journal_path)
+
+
+# Check whether a remote object needs to be downloaded to bring the local file up to date
+def object_needs_sync(obj, local_file, manifest_entry=None):
+    if not os.path.isfile(local_file) or os.path.getsize(local_file) != obj.get('Size'):
+        return True
+
+    # If the object was downloaded by a previous sync compare it with what was downloaded
+    if manifest_entry is not None:
+        return not (manifest_entry.get("etag") == obj.get('ETag') and
+                    manifest_entry.get("size") == obj.get('Size') and
+                    manifest_entry.get("last_modified") == str(obj.get('LastModified')))
+
+    # Otherwise treat a local file of the same size that is at least as new as the object as current
+    return os.path.getmtime(local_file) < obj['LastModified'].timestamp()
+
+
+# Build the boto transfer config used for uploads and downloads
+def build_transfer_config(multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+                          multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE, max_concurrency=DEFAULT_PART_CONCURRENCY):
+    return TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize,
+                          max_concurrency=max_concurrency, use_threads=max_concurrency > 1)
+
 
 # Get all bucket names
 def list_buckets(session):
     buckets = []
-    client = session.client('s3')
+    client = aws_utils.get_client(session, 's3')
     response = client.list_buckets()
 
     for bucket in response['Buckets']:
@@ -30,44 +221,66 @@ def comparitor_s3_bucket(bucket_name, search_text):
         return None
 
 
-# Get files and folders for a specific folder/prefix in a bucket
-def list_objects_and_folders(session, bucket_name, prefix=None):
+# Yield the files and folders directly under a folder/prefix in a bucket one page at a time as (files, folders)
+# tuples, so callers can start working with the first page without waiting for the whole listing
+def iter_objects_and_folders(session, bucket_name, prefix=None, page_size=1000):
     # Initialize the S3 client
-    client = session.client('s3')
+    client = aws_utils.get_client(session, 's3')
 
     # Create a paginator for the list_objects_v2 operation
     paginator = client.get_paginator('list_objects_v2')
 
     # Use the paginator to iterate through all pages
-    prams = {
-        'Bucket': bucket_name,
-        'Delimiter': '/',
-    }
+    prams = build_listing_params(bucket_name, prefix, recurse=False)
+    prams['PaginationConfig'] = {'PageSize': page_size}
+
+    # Iterate through each page of results
+    for page in paginator.paginate(**prams):
+        yield split_listing_page(page)
+
+
+# Build the list_objects_v2 parameters for a bucket and optional prefix, when recurse is false only the objects
+# directly under the prefix are listed and the sub folders are returned as CommonPrefixes
+def build_listing_params(bucket_name, prefix=None, recurse=True):
+    params = {'Bucket': bucket_name}
 
     # If a prefix is provided, add it to the parameters
     if prefix:
         # Ensure that the prefix ends with a '/'
         if not prefix.endswith('/'):
             prefix += '/'
-        prams['Prefix'] = prefix
+        params['Prefix'] = prefix
 
-    # Initialize sets to store unique objects and folders
-    files = set()
-    folders = set()
+    if not recurse:
+        params['Delimiter'] = '/'
+
+    return params
+
+
+# Split a list_objects_v2 page into the file keys and folder prefixes, skipping folder marker objects
+def split_listing_page(page):
+    files = [item['Key'] for item in page.get('Contents', []) if item['Key'][-1] != '/']
+    folders = [common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', [])]
+    return files, folders
+
+
+# Yield the files and folders directly under a folder/prefix as a single sorted stream. S3 returns the keys and
+# common prefixes of a listing in sorted order across pages, so each page only has to be merged with itself and only
+# one page is held in memory at a time.
+def iter_sorted_objects_and_folders(session, bucket_name, prefix=None, page_size=1000):
+    for files, folders in iter_objects_and_folders(session, bucket_name, prefix, page_size=page_size):
+        yield from heapq.merge(files, folders)
 
-    # Iterate through each page of results
-    for page in paginator.paginate(**prams):
-        if 'Contents' in page:
-            for item in page['Contents']:
-                if item['Key'][-1] != '/':
-                    files.add(item['Key'])
-        if 'CommonPrefixes' in page:
-            for common_prefix in page['CommonPrefixes']:
-                folders.add(common_prefix['Prefix'])
-
-    # Convert the sets to lists and sort them
-    files_list = list(files)
-    folders_list = list(folders)
+
+# Get files and folders for a specific folder/prefix in a bucket
+def list_objects_and_folders(session, bucket_name, prefix=None):
+    files_list = []
+    folders_list = []
+
+    # Collect each page of results
+    for files, folders in iter_objects_and_folders(session, bucket_name, prefix):
+        files_list.extend(files)
+        folders_list.extend(folders)
 
     # Sort the lists
     files_list.sort()
@@ -77,11 +290,19 @@ def list_objects_and_folders(session, bucket_name, prefix=None):
     return files_list, folders_list
 
 
+# Build the name shown in the explorer for a file or folder key
+def object_display_name(s3_key):
+    if s3_key.endswith('/'):
+        return s3_key.split('/')[-2] + "/"
+
+    return s3_key.split('/')[-1]
+
+
 # Create a presdigned URL for an object in a bucket
 # This function creates a S3 presigned download url
 def generate_download_presigned_url(session, bucket_name, s3_key, expiration_seconds):
     # Create the s3 client from the provided session
-    client = session.client('s3')
+    client = aws_utils.get_client(session, 's3')
 
     return client.generate_presigned_url(
         ClientMethod='get_object',
@@ -91,7 +312,7 @@ def generate_download_presigned_url(session, bucket_name, s3_key, expiration_sec
 
 def generate_upload_presigned_url(session, bucket_name, s3_key, expiration_seconds=3600):
     # Create the s3 client from the provided session
-    client = session.client('s3')
+    client = aws_utils.get_client(session, 's3')
 
     if s3_key is None:
         s3_key = "/"
@@ -111,6 +332,127 @@ def generate_upload_presigned_url(session, bucket_name, s3_key, expiration_secon
     return url, fields
 
 
+# Walk every object under the prefix with a flat (non-delimited) listing, when recurse is false only the objects
+# directly in the prefix are returned. Folder marker objects are skipped.
+def list_all_objects(session, bucket_name, prefix=None, recurse=True):
+    client = aws_utils.get_client(session, 's3')
+    paginator = client.get_paginator('list_objects_v2')
+
+    params = build_listing_params(bucket_name, prefix, recurse=recurse)
+
+    for page in paginator.paginate(**params):
+        for item in page.get('Contents', []):
+            if not item['Key'].endswith('/'):
+                yield item
+
+
+# Download a list of objects (as returned by list_all_objects) on a pool of worker threads that share a single client.
+# The folder structure below the prefix is recreated under local_path.
+def download_objects(session, bucket_name, objects, prefix, local_path, max_workers=DEFAULT_TRANSFER_WORKERS,
+                     transfer_config=None, progress=None, on_object_complete=None):
+    client = aws_utils.get_client(session, 's3')
+    transfer_config = transfer_config or build_transfer_config()
+    progress = progress or TransferProgress(total_files=len(objects),
+                                            total_bytes=sum(obj.get('Size', 0) for obj in objects))
+    local_root = os.path.abspath(local_path)
+
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+
+    def download_object(obj):
+        relative_key = obj['Key'][len(prefix):] if prefix else obj['Key']
+        local_file = os.path.abspath(os.path.join(local_root, relative_key))
+
+        # Don't allow a key to write outside of the download folder (e.g. keys containing '..')
+        if os.path.commonpath([local_root, local_file]) != local_root:
+            raise ValueError(f"Refusing to download {obj['Key']} outside of {local_root}")
+
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        client.download_file(bucket_name, obj['Key'], local_file, Config=transfer_config, Callback=progress.add_bytes)
+        return local_file
+
+    for task in utils.run_concurrently(download_object, objects, max_workers=max_workers):
+        if task.error is None:
+            progress.file_complete()
+            if on_object_complete:
+                on_object_complete(task.item, task.result)
+        else:
+            progress.file_failed(task.item['Key'], task.error)
+            if progress.reporter:
+                progress.reporter(f"Failed to download {task.item['Key']}: {task.error}")
+
+    progress.finish()
+    return progress
+
+
+# Download everything under a prefix. The whole prefix is listed up front and the objects are downloaded in parallel,
+# returns the TransferProgress with the aggregate throughput and any failures
+def download_prefix(session, bucket_name, prefix, local_path, recurse=True, max_workers=DEFAULT_TRANSFER_WORKERS,
+                    multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+                    max_concurrency=DEFAULT_PART_CONCURRENCY, reporter=print):
+    objects = list(list_all_objects(session, bucket_name, prefix, recurse=recurse))
+
+    progress = TransferProgress(total_files=len(objects), total_bytes=sum(obj.get('Size', 0) for obj in objects),
+                                reporter=reporter)
+    if reporter:
+        reporter(f"Downloading {progress.total_files} files ({utils.foramt_bytes(progress.total_bytes)})")
+
+    transfer_config = build_transfer_config(multipart_threshold, multipart_chunksize, max_concurrency)
+    return download_objects(session, bucket_name, objects, prefix, local_path, max_workers=max_workers,
+                            transfer_config=transfer_config, progress=progress)
+
+
+# Sync everything under a prefix to a local folder, only objects that are new or have changed (size, ETag or
+# LastModified) since the last sync are downloaded. Progress is kept in a manifest under SYNC_MANIFEST_DIR so a sync
+# that is interrupted picks up where it stopped the next time it runs.
+def sync_s3_folder(session, bucket_name, prefix, local_path, max_workers=DEFAULT_TRANSFER_WORKERS,
+                   multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+                   max_concurrency=DEFAULT_PART_CONCURRENCY, reporter=print):
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+
+    os.makedirs(local_path, exist_ok=True)
+    local_root = os.path.abspath(local_path)
+    manifest = SyncManifest(local_root, bucket_name, prefix).load()
+
+    # Compare every remote object with the local folder and keep the ones that need to be downloaded
+    changed_objects = []
+    unchanged_count = 0
+    for obj in list_all_objects(session, bucket_name, prefix):
+        relative_key = obj['Key'][len(prefix):] if prefix else obj['Key']
+        local_file = os.path.join(local_root, relative_key)
+        manifest_entry = manifest.get(obj['Key'])
+
+        if object_needs_sync(obj, local_file, manifest_entry):
+            changed_objects.append(obj)
+        else:
+            unchanged_count += 1
+            if manifest_entry is None:
+                manifest.record(obj)
+
+    progress = TransferProgress(total_files=len(changed_objects),
+                                total_bytes=sum(obj.get('Size', 0) for obj in changed_objects), reporter=reporter)
+    progress.skipped_files = unchanged_count
+    if reporter:
+        reporter(f"Syncing {progress.total_files} changed files ({utils.foramt_bytes(progress.total_bytes)}), "
+                 f"{unchanged_count} files are up to date")
+
+    # Match the local modified time to the object and record it in the manifest as soon as it's downloaded
+    def object_downloaded(obj, local_file):
+        last_modified = obj['LastModified'].timestamp()
+        os.utime(local_file, (last_modified, last_modified))
+        manifest.record(obj)
+
+    try:
+        transfer_config = build_transfer_config(multipart_threshold, multipart_chunksize, max_concurrency)
+        download_objects(session, bucket_name, changed_objects, prefix, local_root, max_workers=max_workers,
+                         transfer_config=transfer_config, progress=progress, on_object_complete=object_downloaded)
+    finally:
+        manifest.save()
+
+    return progress
+
+
 def download_s3_folder(session, bucket_name, s3_key, local_path, recurse=True):
     # Ensure that the local path exists, ensure it's a directory and make sure it ends with a '/'
     if os.path.exists(local_path):
@@ -120,45 +462,93 @@ def download_s3_folder(session, bucket_name, s3_key, local_path, recurse=True):
         print(f"Directory {local_path} does not exist")
         return None
 
-    # For the provided s3 get all the files and folders
-    files, folders = list_objects_and_folders(session, bucket_name, s3_key)
+    # Download all the files under the folder in parallel and print the totals
+    progress = download_prefix(session, bucket_name, s3_key, local_path, recurse=recurse)
+    print(progress.summary())
+
+    return progress
 
-    # Download all the files in the current folder
-    for file in files:
-        full_path = local_path + file.split('/')[-1]
-        print(f"Downloading {full_path}")
-        download_file(session, bucket_name, file, full_path)
 
-    # If recurse is true then download all the folders, if a folder does not exist create it
-    if recurse:
-        for folder in folders:
-            new_path = local_path + folder.split('/')[-2] + "/"
-            if not os.path.exists(new_path):
-                os.mkdir(new_path)
-                print(f"Created folder {new_path}")
+# Build the extra arguments for an upload, validating the checksum algorithm if one was provided
+def _build_upload_args(checksum_algorithm=None):
+    extra_args = {}
 
-            # Recurse into the folder to get all of it's folder and files then download them
-            download_s3_folder(session, bucket_name, folder, new_path, True)
+    if checksum_algorithm:
+        checksum_algorithm = checksum_algorithm.upper()
+        if checksum_algorithm not in SUPPORTED_CHECKSUM_ALGORITHMS:
+            raise ValueError(f"Invalid checksum algorithm, must be one of {', '.join(SUPPORTED_CHECKSUM_ALGORITHMS)}")
+        extra_args["ChecksumAlgorithm"] = checksum_algorithm
+
+    return extra_args
 
 
 # Upload an object to a bucket
-def upload_file(session, bucket_name, local_file, s3_key):
+def upload_file(session, bucket_name, local_file, s3_key, transfer_config=None, checksum_algorithm=None,
+                callback=None):
     # Initialize the S3 client
-    client = session.client('s3')
+    client = aws_utils.get_client(session, 's3')
 
     if s3_key is None:
         s3_key = "/"
 
     s3_key += local_file.split("/")[-1]
 
-    # Upload the object
-    client.upload_file(local_file, bucket_name, s3_key)
+    # Upload the object, large files are split into parts that are uploaded in parallel
+    client.upload_file(local_file, bucket_name, s3_key, ExtraArgs=_build_upload_args(checksum_algorithm),
+                       Config=transfer_config or build_transfer_config(), Callback=callback)
+
+
+# Upload every file in a local directory tree to a prefix in a bucket. The files are uploaded on a pool of worker
+# threads that share a single client and large files are uploaded as parallel multipart uploads. Returns the
+# TransferProgress with the aggregate throughput and any failures.
+def upload_directory(session, bucket_name, local_dir, s3_prefix=None, max_workers=DEFAULT_TRANSFER_WORKERS,
+                     multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+                     max_concurrency=DEFAULT_PART_CONCURRENCY, checksum_algorithm=None, reporter=print):
+    if not os.path.isdir(local_dir):
+        raise ValueError(f"Directory {local_dir} does not exist")
+
+    if s3_prefix and not s3_prefix.endswith('/'):
+        s3_prefix += '/'
+
+    client = aws_utils.get_client(session, 's3')
+    extra_args = _build_upload_args(checksum_algorithm)
+    transfer_config = build_transfer_config(multipart_threshold, multipart_chunksize, max_concurrency)
+
+    # Collect the files up front so the totals are known before the upload starts
+    uploads = []
+    for root, _, filenames in os.walk(local_dir):
+        for filename in filenames:
+            local_file = os.path.join(root, filename)
+            relative_path = os.path.relpath(local_file, local_dir).replace(os.sep, '/')
+            uploads.append((local_file, (s3_prefix or "") + relative_path))
+
+    progress = TransferProgress(total_files=len(uploads),
+                                total_bytes=sum(os.path.getsize(local_file) for local_file, _ in uploads),
+                                reporter=reporter)
+    if reporter:
+        reporter(f"Uploading {progress.total_files} files ({utils.foramt_bytes(progress.total_bytes)})")
+
+    def upload(item):
+        local_file, s3_key = item
+        client.upload_file(local_file, bucket_name, s3_key, ExtraArgs=extra_args, Config=transfer_config,
+                           Callback=progress.add_bytes)
+
+    for task in utils.run_concurrently(upload, uploads, max_workers=max_workers):
+        if task.error is None:
+            progress.file_complete()
+        else:
+            progress.file_failed(task.item[0], task.error)
+            if reporter:
+                reporter(f"Failed to upload {task.item[0]}: {task.error}")
+
+    progress.finish()
+    return progress
 
 
 # Download an object from a bucket
 def download_file(session, bucket_name, s3_key, local_file):
     # Initialize the S3 client
-    client = session.client('s3')
+    client = aws_utils.get_client(session, 's3')
 
     # Download the object
     client.download_file(bucket_name, s3_key, local_file)
@@ -166,7 +556,7 @@ def download_file(session, bucket_name, s3_key, local_file):
 
 def get_file_info(session, bucket_name, s3_key):
     # Initialize the S3 client
-    client = session.client('s3')
+    client = aws_utils.get_client(session, 's3')
 
     # Get the object metadata
     return client.head_object(Bucket=bucket_name, Key=s3_key)
@@ -193,14 +583,8 @@ def create_curl_upload_command(url, fields, file="<INSERT FILE ABS PATH>"):
 
 # This function uses python to upload the file to S3
 def upload_to_s3(url, fields, file):
-    # Open a read binary to the file you want to upload to the presigned upload url
-    files = {'file': open(file, 'rb')}
-
-    # Submit a post request adding both the fields and file to the post body to the presigned url
-    r = requests.post(url, data=fields, files=files)
-
-    # Check to see if the post request returns a status code of 204, if so then return success otherwise return failure
-    if r.status_code == 204:
+    # Stream the file to the presigned upload url, if the upload succeeds return success otherwise return failure
+    if utils.upload_to_url(url, fields, file):
         return "success"
     else:
-        return "upload failed"
\ No newline at end of file
+        return "upload failed"
@@ -1,7 +1,18 @@
+import socket
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
 import aws_utils
 import menu_builder
 import utils
 
+# Default number of regions that are scanned at the same time
+DEFAULT_SCAN_WORKERS = 8
+
+# Default number of seconds a single region scan can run before it's reported as timed out
+DEFAULT_REGION_TIMEOUT_SECONDS = 300
+
 
 class AuthInfo:
     def __init__(self, auth_type=None, key=None, secret=None, profile_name=None, role_arn=None):
@@ -12,7 +23,13 @@ class AuthInfo:
         self.RoleArn = role_arn
 
 
+# The security group model classes use __slots__ because org wide scans can build hundreds of thousands of them, and
+# each one has an explicit to_dict so the json export doesn't depend on __dict__
+
 class SecurityGroup:
+    __slots__ = ("description", "groupName", "ipPermissions", "ownerId", "groupId", "ipPermissionsEgress", "tags",
+                 "vpcId")
+
     def __init__(self):
         self.description = None
         self.groupName = None
@@ -23,8 +40,22 @@ class SecurityGroup:
         self.tags = []
         self.vpcId = None
 
+    def to_dict(self):
+        return {
+            "description": self.description,
+            "groupName": self.groupName,
+            "ipPermissions": [permission.to_dict() for permission in self.ipPermissions],
+            "ownerId": self.ownerId,
+            "groupId": self.groupId,
+            "ipPermissionsEgress": [permission.to_dict() for permission in self.ipPermissionsEgress],
+            "tags": [tag.to_dict() for tag in self.tags],
+            "vpcId": self.vpcId,
+        }
+
 
 class IpPermission:
+    __slots__ = ("fromPort", "ipProtocol", "ipRanges", "ipv6Ranges", "prefixListIds", "toPort", "userIdGroupPairs")
+
     def __init__(self):
         self.fromPort = None
         self.ipProtocol = None
@@ -34,26 +65,54 @@ class IpPermission:
         self.toPort = None
         self.userIdGroupPairs = []
 
+    def to_dict(self):
+        return {
+            "fromPort": self.fromPort,
+            "ipProtocol": self.ipProtocol,
+            "ipRanges": [ip_range.to_dict() for ip_range in self.ipRanges],
+            "ipv6Ranges": [ip6_range.to_dict() for ip6_range in self.ipv6Ranges],
+            "prefixListIds": [prefix_list.to_dict() for prefix_list in self.prefixListIds],
+            "toPort": self.toPort,
+            "userIdGroupPairs": [group_pair.to_dict() for group_pair in self.userIdGroupPairs],
+        }
+
 
 class IpRange:
+    __slots__ = ("cidrIp", "description")
+
     def __init__(self):
         self.cidrIp = None
         self.description = None
 
+    def to_dict(self):
+        return {"cidrIp": self.cidrIp, "description": self.description}
+
 
 class Ipv6Range:
+    __slots__ = ("cidrIpv6", "description")
+
     def __init__(self):
         self.cidrIpv6 = None
         self.description = None
 
+    def to_dict(self):
+        return {"cidrIpv6": self.cidrIpv6, "description": self.description}
+
 
 class PrefixListId:
+    __slots__ = ("description", "prefixListId")
+
     def __init__(self):
         self.description = None
         self.prefixListId = None
 
+    def to_dict(self):
+        return {"description": self.description, "prefixListId": self.prefixListId}
+
 
 class UserIdGroupPair:
+    __slots__ = ("description", "groupId", "groupName", "peeringStatus", "userId", "vpcId", "vpcPeeringConnectionId")
+
     def __init__(self):
         self.description = None
         self.groupId = None
@@ -63,168 +122,592 @@ class UserIdGroupPair:
         self.vpcId = None
         self.vpcPeeringConnectionId = None
 
+    def to_dict(self):
+        return {
+            "description": self.description,
+            "groupId": self.groupId,
+            "groupName": self.groupName,
+            "peeringStatus": self.peeringStatus,
+            "userId": self.userId,
+            "vpcId": self.vpcId,
+            "vpcPeeringConnectionId": self.vpcPeeringConnectionId,
+        }
 
-class IpPermissionsEgress:
-    def __init__(self):
-        self.fromPort = None
-        self.ipProtocol = None
-        self.ipRanges = []
-        self.ipv6Ranges = []
-        self.prefixListIds = []
-        self.toPort = None
-        self.userIdGroupPairs = []
+
+# Egress rules have the same shape as ingress rules
+class IpPermissionsEgress(IpPermission):
+    __slots__ = ()
 
 
 class Tag:
+    __slots__ = ("key", "value")
+
     def __init__(self):
         self.key = None
         self.value = None
 
-def get_security_groups(session):
-    next_token = None
-    security_groups = []
-
-    client = session.client(service_name="ec2")
+    def to_dict(self):
+        return {"key": self.key, "value": self.value}
+
+
+class RegionScanResult:
+    def __init__(self, region, security_groups=None, error=None, elapsed_seconds=None):
+        self.region = region
+        self.security_groups = security_groups
+        self.error = error
+        self.elapsed_seconds = elapsed_seconds
+
+
+# Group-by index over scan results (region name -> list of SecurityGroup). Groups are indexed region -> VPC id ->
+# groups and by group id, so reports and other consumers don't have to rescan a region's groups for every VPC. The
+# ordering is deterministic: regions keep the order of the results, VPCs are sorted by id with groups that aren't in a
+# VPC (None) last, and the groups in each VPC are sorted by name then id.
+class SecurityGroupIndex:
+    def __init__(self, sg_results):
+        self.regions = {}
+        self.groups_by_id = {}
+        self.group_regions = {}
+
+        for region, security_groups in sg_results.items():
+            vpcs = {}
+            for sg in security_groups:
+                vpcs.setdefault(sg.vpcId, []).append(sg)
+                self.groups_by_id[sg.groupId] = sg
+                self.group_regions[sg.groupId] = region
+
+            for groups in vpcs.values():
+                groups.sort(key=lambda group: (group.groupName or "", group.groupId or ""))
+
+            self.regions[region] = {vpc_id: vpcs[vpc_id]
+                                    for vpc_id in sorted(vpcs, key=lambda vpc_id: (vpc_id is None, vpc_id or ""))}
+
+    # Return the VPC ids in a region in index order
+    def get_vpc_ids(self, region):
+        return list(self.regions.get(region, {}))
+
+    # Return the security groups in a VPC of a region, use None for the groups that aren't in a VPC
+    def get_groups(self, region, vpc_id):
+        return self.regions.get(region, {}).get(vpc_id, [])
+
+    def get_group(self, group_id):
+        return self.groups_by_id.get(group_id)
+
+    def get_group_region(self, group_id):
+        return self.group_regions.get(group_id)
+
+    # Yield (region, vpc_id, security groups) for every VPC in index order
+    def iter_vpcs(self):
+        for region, vpcs in self.regions.items():
+            for vpc_id, groups in vpcs.items():
+                yield region, vpc_id, groups
+
+    def __len__(self):
+        return len(self.groups_by_id)
+
+
+# Return True if a rule's protocol and port range allow traffic for the protocol and port. A port of None matches any
+# port range, and protocol "-1" rules allow all traffic
+def rule_allows(rule_protocol, from_port, to_port, protocol="tcp", port=None):
+    if rule_protocol == "-1":
+        return True
+    if protocol is not None and rule_protocol != protocol:
+        return False
+    if port is None or from_port is None or from_port == -1:
+        return True
+    return from_port <= port <= to_port
+
+
+# Adjacency graph over the security group references in scan results (region name -> list of SecurityGroup).
+# An ingress rule on group A that references group B is an edge B -> A: members of B can reach members of A on the
+# rule's protocol and ports. Each edge keeps its (protocol, from port, to port) rules so port queries only look at the
+# edges of one group. Referenced groups that weren't scanned (other accounts, deleted groups) are still graph nodes.
+class SecurityGroupGraph:
+    def __init__(self, sg_results):
+        self.groups_by_id = {}
+
+        # target group id -> {source group id -> [(protocol, from port, to port)]} and the reverse
+        self.sources = {}
+        self.targets = {}
+
+        # group id -> ids of the other groups with an ingress or egress rule referencing it
+        self.referenced_by = {}
+
+        self._transitive_sources = {}
+        self._transitive_targets = {}
+
+        for security_groups in sg_results.values():
+            for sg in security_groups:
+                self.groups_by_id[sg.groupId] = sg
+
+                for permission in sg.ipPermissions:
+                    for group_pair in permission.userIdGroupPairs:
+                        self._add_edge(group_pair.groupId, sg.groupId, permission)
+
+                for permission in sg.ipPermissionsEgress:
+                    for group_pair in permission.userIdGroupPairs:
+                        if group_pair.groupId != sg.groupId:
+                            self.referenced_by.setdefault(group_pair.groupId, set()).add(sg.groupId)
+
+    def _add_edge(self, source_id, target_id, permission):
+        rule = (permission.ipProtocol, permission.fromPort, permission.toPort)
+        self.sources.setdefault(target_id, {}).setdefault(source_id, []).append(rule)
+        self.targets.setdefault(source_id, {}).setdefault(target_id, []).append(rule)
+
+        if source_id != target_id:
+            self.referenced_by.setdefault(source_id, set()).add(target_id)
+
+    @staticmethod
+    def _matching(edges, protocol, port):
+        return {group_id for group_id, rules in edges.items()
+                if any(rule_allows(rule[0], rule[1], rule[2], protocol, port) for rule in rules)}
+
+    # Return the ids of the groups whose members can reach group_id directly, optionally only on a protocol and port
+    # e.g. get_sources("sg-1234", 443) for "which groups can reach sg-1234 on port 443"
+    def get_sources(self, group_id, port=None, protocol="tcp"):
+        return self._matching(self.sources.get(group_id, {}), protocol, port)
+
+    # Return the ids of the groups that members of group_id can reach directly, optionally only on a protocol and port
+    def get_targets(self, group_id, port=None, protocol="tcp"):
+        return self._matching(self.targets.get(group_id, {}), protocol, port)
+
+    def can_reach(self, source_id, target_id, port=None, protocol="tcp"):
+        rules = self.sources.get(target_id, {}).get(source_id, ())
+        return any(rule_allows(rule[0], rule[1], rule[2], protocol, port) for rule in rules)
+
+    # Breadth first walk of the adjacency from group_id, returning every group reachable through one or more edges.
+    # Results are memoized per group and reused when the walk reaches a group that has already been expanded.
+    @staticmethod
+    def _closure(adjacency, group_id, memo):
+        if group_id in memo:
+            return memo[group_id]
+
+        seen = set()
+        queue = deque([group_id])
+        while queue:
+            current = queue.popleft()
+            for neighbour in adjacency.get(current, ()):
+                if neighbour in seen:
+                    continue
+                seen.add(neighbour)
+
+                cached = memo.get(neighbour)
+                if cached is None:
+                    queue.append(neighbour)
+                else:
+                    seen |= cached
+
+        seen.discard(group_id)
+        memo[group_id] = frozenset(seen)
+        return memo[group_id]
+
+    # Return every group that can reach group_id through a chain of group references, on any port
+    def get_transitive_sources(self, group_id):
+        return self._closure(self.sources, group_id, self._transitive_sources)
+
+    # Return every group that group_id can reach through a chain of group references, on any port
+    def get_transitive_targets(self, group_id):
+        return self._closure(self.targets, group_id, self._transitive_targets)
+
+    # Return the ids of the other groups with a rule referencing group_id
+    def get_referencing_groups(self, group_id):
+        return set(self.referenced_by.get(group_id, ()))
+
+    # Return the sorted ids of the scanned groups that no other group's rules reference. This only looks at group
+    # references, a group can still be attached to network interfaces
+    def get_unreferenced_groups(self):
+        return sorted(group_id for group_id in self.groups_by_id if not self.referenced_by.get(group_id))
+
+    # Return the sorted ids of referenced groups that weren't in the scan results
+    def get_external_groups(self):
+        referenced = set(self.referenced_by).union(self.sources, self.targets)
+        return sorted(group_id for group_id in referenced if group_id not in self.groups_by_id)
+
+    def __len__(self):
+        return len(self.groups_by_id)
+
+
+# Directions a rule can apply to
+INGRESS = "ingress"
+EGRESS = "egress"
+
+# Protocol numbers for the names describe_security_groups returns, "-1" means all protocols
+PROTOCOL_NUMBERS = {"-1": -1, "all": -1, "tcp": 6, "udp": 17, "icmp": 1, "icmpv6": 58}
+
+# Default prefix lengths at or below which a CIDR counts as overly broad
+DEFAULT_BROAD_IPV4_PREFIXLEN = 16
+DEFAULT_BROAD_IPV6_PREFIXLEN = 48
+
+
+def protocol_number(protocol):
+    if protocol is None:
+        return None
+    protocol = str(protocol).lower()
+    if protocol in PROTOCOL_NUMBERS:
+        return PROTOCOL_NUMBERS[protocol]
+    return int(protocol)
+
+
+# Parse an IPv4 or IPv6 CIDR into (version, first address, last address, prefix length) with the addresses as
+# integers. Raises ValueError if the CIDR isn't valid
+def parse_cidr(cidr):
+    address, _, prefix = cidr.partition("/")
+    if ":" in address:
+        family, bits, version = socket.AF_INET6, 128, 6
+    else:
+        family, bits, version = socket.AF_INET, 32, 4
+
+    try:
+        value = int.from_bytes(socket.inet_pton(family, address), "big")
+    except OSError:
+        raise ValueError(f"Invalid CIDR: {cidr}")
+
+    prefixlen = int(prefix) if prefix else bits
+    if not 0 <= prefixlen <= bits:
+        raise ValueError(f"Invalid CIDR: {cidr}")
+
+    host_mask = (1 << (bits - prefixlen)) - 1
+    start = value & ~host_mask
+    return version, start, start | host_mask, prefixlen
+
+
+# A rule CIDR matched by one of the CidrExposureIndex queries
+class ExposureFinding:
+    __slots__ = ("finding", "region", "groupId", "groupName", "direction", "ipProtocol", "fromPort", "toPort", "cidr",
+                 "description", "matchedCidr")
+
+    def __init__(self, finding, row, matched_cidr=None):
+        self.finding = finding
+        self.region, self.groupId, self.groupName, self.direction, self.ipProtocol, self.fromPort, self.toPort, \
+            self.cidr, self.description = row
+        self.matchedCidr = matched_cidr
+
+    def to_dict(self):
+        return {
+            "finding": self.finding,
+            "region": self.region,
+            "groupId": self.groupId,
+            "groupName": self.groupName,
+            "direction": self.direction,
+            "ipProtocol": self.ipProtocol,
+            "fromPort": self.fromPort,
+            "toPort": self.toPort,
+            "cidr": self.cidr,
+            "description": self.description,
+            "matchedCidr": self.matchedCidr,
+        }
+
+
+# Column store for the rule CIDRs of one address family. Each position is one CIDR of one rule, with the network
+# range, prefix length, port range, protocol number and direction packed into parallel arrays. IPv6 addresses are
+# 128 bits and don't fit an array typecode so their start and end columns are plain lists.
+class _CidrColumns:
+    def __init__(self, address_typecode=None):
+        if address_typecode:
+            self.starts = array(address_typecode)
+            self.ends = array(address_typecode)
+        else:
+            self.starts = []
+            self.ends = []
+        self.prefixlens = array("B")
+        self.from_ports = array("i")
+        self.to_ports = array("i")
+        self.protocols = array("h")
+        self.egress = array("b")
+        self.rows = array("I")
+
+        # Built by finalize: positions ordered by network start with the sorted starts alongside for bisect, and a
+        # hash of (prefix length, network start) -> positions for exact network lookups
+        self.sorted_positions = None
+        self.sorted_starts = None
+        self.networks = None
+
+    def append(self, start, end, prefixlen, from_port, to_port, protocol, egress, row):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.prefixlens.append(prefixlen)
+        self.from_ports.append(from_port)
+        self.to_ports.append(to_port)
+        self.protocols.append(protocol)
+        self.egress.append(egress)
+        self.rows.append(row)
+
+    def finalize(self):
+        order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+        self.sorted_positions = array("I", order)
+        self.sorted_starts = [self.starts[position] for position in order]
+
+        self.networks = {}
+        for position, (prefixlen, start) in enumerate(zip(self.prefixlens, self.starts)):
+            self.networks.setdefault((prefixlen, start), []).append(position)
+
+    def __len__(self):
+        return len(self.starts)
+
+
+# Exposure analysis over the IpRange and Ipv6Range CIDRs in scan results (region name -> list of SecurityGroup).
+# The rules are packed into integer columns once so exposure, overlap and port queries run over arrays and hash/bisect
+# indexes instead of parsing every CIDR with the ipaddress module per query. Every query can be limited to a
+# direction (INGRESS, EGRESS or None for both), a protocol (None for any) and a port or port range the rule must
+# cover, and returns ExposureFinding objects in scan order.
+class CidrExposureIndex:
+    def __init__(self, sg_results):
+        # region, group id, group name, direction, protocol, from port, to port, cidr, description for each CIDR
+        self.rows = []
+        # CIDRs that couldn't be parsed as (region, group id, cidr)
+        self.invalid_cidrs = []
+
+        self.ipv4 = _CidrColumns("I")
+        self.ipv6 = _CidrColumns()
+
+        for region, security_groups in sg_results.items():
+            for sg in security_groups:
+                for direction, permissions in ((INGRESS, sg.ipPermissions), (EGRESS, sg.ipPermissionsEgress)):
+                    for permission in permissions:
+                        self._add_permission(region, sg, direction, permission)
+
+        self.ipv4.finalize()
+        self.ipv6.finalize()
+
+    def _add_permission(self, region, sg, direction, permission):
+        protocol = protocol_number(permission.ipProtocol)
+
+        # All traffic rules and ICMP rules for every type have no port range or -1
+        from_port, to_port = permission.fromPort, permission.toPort
+        if protocol == -1 or from_port is None or from_port == -1:
+            from_port, to_port = 0, 65535
+
+        cidrs = [ip_range.cidrIp for ip_range in permission.ipRanges]
+        descriptions = [ip_range.description for ip_range in permission.ipRanges]
+        cidrs.extend(ip6_range.cidrIpv6 for ip6_range in permission.ipv6Ranges)
+        descriptions.extend(ip6_range.description for ip6_range in permission.ipv6Ranges)
+
+        for cidr, description in zip(cidrs, descriptions):
+            try:
+                version, start, end, prefixlen = parse_cidr(cidr)
+            except (ValueError, AttributeError):
+                self.invalid_cidrs.append((region, sg.groupId, cidr))
+                continue
+
+            columns = self.ipv4 if version == 4 else self.ipv6
+            columns.append(start, end, prefixlen, from_port, to_port, protocol, direction == EGRESS, len(self.rows))
+            self.rows.append((region, sg.groupId, sg.groupName, direction, permission.ipProtocol, permission.fromPort,
+                              permission.toPort, cidr, description))
+
+    @staticmethod
+    def _filter(columns, positions, direction, protocol, from_port, to_port):
+        egress = None if direction is None else direction == EGRESS
+        protocol = protocol_number(protocol)
+        if from_port is not None and to_port is None:
+            to_port = from_port
+
+        for position in positions:
+            if egress is not None and columns.egress[position] != egress:
+                continue
+            if protocol is not None and columns.protocols[position] not in (-1, protocol):
+                continue
+            if from_port is not None and not (columns.from_ports[position] <= from_port and
+                                              to_port <= columns.to_ports[position]):
+                continue
+            yield position
+
+    def _findings(self, finding, matches):
+        # matches is a list of (row, matched cidr), sorted by row so the findings come out in scan order
+        return [ExposureFinding(finding, self.rows[row], matched_cidr)
+                for row, matched_cidr in sorted(matches, key=lambda match: match[0])]
+
+    # Rules open to the whole internet (0.0.0.0/0 or ::/0)
+    def find_open_to_world(self, port=None, to_port=None, protocol=None, direction=INGRESS):
+        matches = []
+        for columns in (self.ipv4, self.ipv6):
+            positions = columns.networks.get((0, 0), ())
+            for position in self._filter(columns, positions, direction, protocol, port, to_port):
+                matches.append((columns.rows[position], None))
+        return self._findings("open-to-world", matches)
+
+    # Rules with a CIDR broader than the prefix length thresholds, not counting the open to world rules
+    def find_broad_cidrs(self, ipv4_prefixlen=DEFAULT_BROAD_IPV4_PREFIXLEN, ipv6_prefixlen=DEFAULT_BROAD_IPV6_PREFIXLEN,
+                         port=None, to_port=None, protocol=None, direction=INGRESS):
+        matches = []
+        for columns, threshold in ((self.ipv4, ipv4_prefixlen), (self.ipv6, ipv6_prefixlen)):
+            positions = [position for position, prefixlen in enumerate(columns.prefixlens) if 0 < prefixlen <= threshold]
+            for position in self._filter(columns, positions, direction, protocol, port, to_port):
+                matches.append((columns.rows[position], None))
+        return self._findings("broad-cidr", matches)
+
+    # Rules whose CIDR overlaps any of the sensitive CIDRs. Two CIDRs overlap when one contains the other, so for each
+    # sensitive range the rule networks inside it are found with a bisect over the sorted starts and the rule networks
+    # containing it with one hash lookup per shorter prefix length.
+    def find_overlaps(self, sensitive_cidrs, port=None, to_port=None, protocol=None, direction=INGRESS):
+        matches = []
+        for sensitive_cidr in sensitive_cidrs:
+            version, start, end, prefixlen = parse_cidr(sensitive_cidr)
+            columns, bits = (self.ipv4, 32) if version == 4 else (self.ipv6, 128)
+
+            positions = set(columns.sorted_positions[bisect_left(columns.sorted_starts, start):
+                                                     bisect_right(columns.sorted_starts, end)])
+            for supernet_prefixlen in range(prefixlen):
+                network = start & ~((1 << (bits - supernet_prefixlen)) - 1)
+                positions.update(columns.networks.get((supernet_prefixlen, network), ()))
+
+            for position in self._filter(columns, positions, direction, protocol, port, to_port):
+                matches.append((columns.rows[position], sensitive_cidr))
+        return self._findings("sensitive-overlap", matches)
+
+    # Rules whose port range covers port (or the whole port..to_port range), from any CIDR
+    def find_port_exposure(self, port, to_port=None, protocol="tcp", direction=INGRESS):
+        matches = []
+        for columns in (self.ipv4, self.ipv6):
+            for position in self._filter(columns, range(len(columns)), direction, protocol, port, to_port):
+                matches.append((columns.rows[position], None))
+        return self._findings("port-exposure", matches)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+# Parse a list of ingress or egress permissions from a describe_security_groups response. Ingress and egress rules
+# have the same shape so both are parsed here, permission_class decides which model the rules are built as
+def parse_permissions(permissions, permission_class=IpPermission):
+    parsed = []
+
+    for permission in permissions:
+        ipp = permission_class()
+        ipp.fromPort = permission.get("FromPort")
+        ipp.ipProtocol = permission.get("IpProtocol")
+        ipp.toPort = permission.get("ToPort")
+
+        # Parse IP Ranges
+        records = permission.get("IpRanges")
+        if records:
+            for record in records:
+                ipr = IpRange()
+                ipr.cidrIp = record.get("CidrIp")
+                ipr.description = record.get("Description")
+                ipp.ipRanges.append(ipr)
+
+        # Parse IPv6 Ranges
+        records = permission.get("Ipv6Ranges")
+        if records:
+            for record in records:
+                ip6r = Ipv6Range()
+                ip6r.cidrIpv6 = record.get("CidrIpv6")
+                ip6r.description = record.get("Description")
+                ipp.ipv6Ranges.append(ip6r)
+
+        # Parse PrefixList Ids
+        records = permission.get("PrefixListIds")
+        if records:
+            for record in records:
+                plid = PrefixListId()
+                plid.prefixListId = record.get("PrefixListId")
+                plid.description = record.get("Description")
+                ipp.prefixListIds.append(plid)
+
+        # Parse UserId Group Pairs
+        records = permission.get("UserIdGroupPairs")
+        if records:
+            for record in records:
+                uigp = UserIdGroupPair()
+                uigp.description = record.get("Description")
+                uigp.groupId = record.get("GroupId")
+                uigp.groupName = record.get("GroupName")
+                uigp.peeringStatus = record.get("PeeringStatus")
+                uigp.userId = record.get("UserId")
+                uigp.vpcId = record.get("VpcId")
+                uigp.vpcPeeringConnectionId = record.get("VpcPeeringConnectionId")
+                ipp.userIdGroupPairs.append(uigp)
+
+        parsed.append(ipp)
+
+    return parsed
+
+
+# Parse a single security group from a describe_security_groups response into a SecurityGroup
+def parse_security_group(group):
+    sg = SecurityGroup()
+    sg.description = group.get("Description")
+    sg.groupName = group.get("GroupName")
+    sg.ownerId = group.get("OwnerId")
+    sg.groupId = group.get("GroupId")
+    sg.vpcId = group.get("VpcId")
+
+    permissions = group.get("IpPermissions")
+    if permissions:
+        sg.ipPermissions = parse_permissions(permissions, IpPermission)
+
+    permissions = group.get("IpPermissionsEgress")
+    if permissions:
+        sg.ipPermissionsEgress = parse_permissions(permissions, IpPermissionsEgress)
+
+    # Parse the tags
+    tags = group.get("Tags")
+    if tags:
+        for tag in tags:
+            t = Tag()
+            t.key = tag.get("Key")
+            t.value = tag.get("Value")
+            sg.tags.append(t)
+
+    return sg
+
+
+# Return the unparsed security groups of the session's region as returned by describe_security_groups
+def describe_security_groups(session):
+    client = aws_utils.get_client(session, "ec2")
+    return list(aws_utils.paginate(client, "describe_security_groups", "SecurityGroups"))
 
-    while True:
 
-        # If there is a token to continue getting records use it, otherwise retrieve the first set of records
-        if next_token:
-            response = client.describe_security_groups(NextToken=next_token)
-        else:
-            response = client.describe_security_groups()
-
-        # Loop though each security group in the response
-        for group in response.get("SecurityGroups"):
-
-            # Create security group object and parse data from response
-            sg = SecurityGroup()
-            sg.description = group.get("Description")
-            sg.groupName = group.get("GroupName")
-            sg.ownerId = group.get("OwnerId")
-            sg.groupId = group.get("GroupId")
-            sg.vpcId = group.get("VpcId")
-
-            if group.get("IpPermissions"):
-                # Parse IpPermissions for the current item
-                for permission in group.get("IpPermissions"):
-                    ipp = IpPermission()
-                    ipp.fromPort = permission.get("FromPort")
-                    ipp.ipProtocol = permission.get("IpProtocol")
-                    ipp.toPort = permission.get("ToPort")
-
-                    # Parse IP Ranges
-                    if permission.get("IpRanges"):
-                        for ip_range in permission.get("IpRanges"):
-                            ipr = IpRange()
-                            ipr.cidrIp = ip_range.get("CidrIp")
-                            ipr.description = ip_range.get("Description")
-                            ipp.ipRanges.append(ipr)
-
-                    # Parse IPv6 Ranges
-                    if permission.get("Ipv6Ranges"):
-                        for ip6_range in permission.get("Ipv6Ranges"):
-                            ip6r = Ipv6Range()
-                            ip6r.cidrIpv6 = ip6_range.get("CidrIpv6")
-                            ip6r.description = ip6_range.get("Description")
-                            ipp.ipv6Ranges.append(ip6r)
-
-                    # Parse PrefixList Ids
-                    if permission.get("PrefixListIds"):
-                        for prefix_list in permission.get("PrefixListIds"):
-                            plid = PrefixListId()
-                            plid.prefixListId = prefix_list.get("PrefixListId")
-                            plid.description = prefix_list.get("Description")
-                            ipp.prefixListIds.append(plid)
-
-                    # Pares UserId Group Pairs
-                    if permission.get("UserIdGroupPairs"):
-                        for group_pair in permission.get("UserIdGroupPairs"):
-                            uigp = UserIdGroupPair()
-                            uigp.description = group_pair.get("Description")
-                            uigp.groupId = group_pair.get("GroupId")
-                            uigp.groupName = group_pair.get("GroupName")
-                            uigp.peeringStatus = group_pair.get("PeeringStatus")
-                            uigp.userId = group_pair.get("UserId")
-                            uigp.vpcId = group_pair.get("VpcId")
-                            uigp.vpcPeeringConnectionId = group_pair.get("VpcPeeringConnectionId")
-                            ipp.userIdGroupPairs.append(uigp)
-
-                    # Add to the security group
-                    sg.ipPermissions.append(ipp)
-
-            if group.get("IpPermissionsEgress"):
-                # Parse IpPermissionsEgress for the current item
-                for permission in group.get("IpPermissionsEgress"):
-                    ippe = IpPermissionsEgress()
-                    ippe.fromPort = permission.get("FromPort")
-                    ippe.ipProtocol = permission.get("IpProtocol")
-                    ippe.toPort = permission.get("ToPort")
-
-                    # Parse IP Ranges
-                    if permission.get("IpRanges"):
-                        for ip_range in permission.get("IpRanges"):
-                            ipr = IpRange()
-                            ipr.cidrIp = ip_range.get("CidrIp")
-                            ipr.description = ip_range.get("Description")
-                            ippe.ipRanges.append(ipr)
-
-                    # Parse IPv6 Ranges
-                    if permission.get("Ipv6Ranges"):
-                        for ip6_range in permission.get("Ipv6Ranges"):
-                            ip6r = Ipv6Range()
-                            ip6r.cidrIpv6 = ip6_range.get("CidrIpv6")
-                            ip6r.description = ip6_range.get("Description")
-                            ippe.ipv6Ranges.append(ip6r)
-
-                    # Parse PrefixList Ids
-                    if permission.get("PrefixListIds"):
-                        for prefix_list in permission.get("PrefixListIds"):
-                            plid = PrefixListId()
-                            plid.prefixListId = prefix_list.get("PrefixListId")
-                            plid.description = prefix_list.get("Description")
-                            ippe.prefixListIds.append(plid)
-
-                    # Pares UserId Group Pairs
-                    if permission.get("UserIdGroupPairs"):
-                        for group_pair in permission.get("UserIdGroupPairs"):
-                            uigp = UserIdGroupPair()
-                            uigp.description = group_pair.get("Description")
-                            uigp.groupId = group_pair.get("GroupId")
-                            uigp.groupName = group_pair.get("GroupName")
-                            uigp.peeringStatus = group_pair.get("PeeringStatus")
-                            uigp.userId = group_pair.get("UserId")
-                            uigp.vpcId = group_pair.get("VpcId")
-                            uigp.vpcPeeringConnectionId = group_pair.get("VpcPeeringConnectionId")
-                            ippe.userIdGroupPairs.append(uigp)
-
-                    sg.ipPermissionsEgress.append(ippe)
-
-            # Parse the tags
-            if group.get("Tags"):
-                for tag in group.get("Tags"):
-                    t = Tag()
-                    t.key = tag.get("Key")
-                    t.value = tag.get("Value")
-                    sg.tags.append(t)
-
-            # Add the parsed security group to the list
-            security_groups.append(sg)
-
-        # Check if the response contains a next token, if it does then use it to get the next page of results,
-        # if not exit the infinite loop
-        if response.get("NextToken"):
-            next_token = response.get("NextToken")
+def get_security_groups(session):
+    client = aws_utils.get_client(session, "ec2")
+
+    # Parse each security group as its page of results arrives
+    return [parse_security_group(group)
+            for group in aws_utils.paginate(client, "describe_security_groups", "SecurityGroups")]
+
+
+# Scan the provided regions in parallel and yield a RegionScanResult for each region as soon as it finishes.
+# session_factory is called with a region name and must return a session for that region (e.g.
+# aws_utils.change_session_region). A region that errors or runs past region_timeout is returned with the error set
+# instead of stopping the rest of the scan.
+def scan_regions_iter(session_factory, regions, max_workers=DEFAULT_SCAN_WORKERS,
+                      region_timeout=DEFAULT_REGION_TIMEOUT_SECONDS):
+    def scan_region(region):
+        return get_security_groups(session_factory(region))
+
+    for task in utils.run_concurrently(scan_region, regions, max_workers=max_workers, timeout=region_timeout):
+        yield RegionScanResult(task.item, security_groups=task.result, error=task.error,
+                               elapsed_seconds=task.elapsed_seconds)
+
+
+# Scan the provided regions in parallel and return the results as {region: [SecurityGroup]} in the same order as the
+# provided regions. Regions that failed are left out of the results and returned in a separate {region: error} dict.
+# on_region_complete is an optional callback that receives each RegionScanResult as it finishes.
+def scan_regions(session_factory, regions, max_workers=DEFAULT_SCAN_WORKERS,
+                 region_timeout=DEFAULT_REGION_TIMEOUT_SECONDS, on_region_complete=None):
+    regions = list(regions)
+    completed = {}
+    errors = {}
+
+    for region_result in scan_regions_iter(session_factory, regions, max_workers=max_workers,
+                                           region_timeout=region_timeout):
+        if region_result.error is None:
+            completed[region_result.region] = region_result.security_groups
         else:
-            break
+            errors[region_result.region] = region_result.error
+
+        if on_region_complete:
+            on_region_complete(region_result)
 
-    # Return the list of parsed security groups
-    return security_groups
+    # Rebuild the results in the requested region order so the reports are stable between runs
+    sg_results = {region: completed[region] for region in regions if region in completed}
 
+    return sg_results, errors
 
-def format_report(session,sg_results):
 
-    r = utils.ReportBuilder()
+# Build the report text, if a stream is provided the report is written to it as it's built and None is returned
+def format_report(session,sg_results, stream=None):
+
+    r = utils.ReportBuilder(stream)
     header_name = "AWS Security Group Report"
     header = menu_builder.build_header(header_name, 20)
     divider = menu_builder.build_divider(header_name,padding=20)
@@ -235,25 +718,17 @@ def format_report(session,sg_results):
     r.write(divider)
     r.newline()
 
-    for region, security_groups in sg_results.items():
-        r.write(f"{region} | {aws_utils.get_region_friendly_name(session,region)}", 0)
+    # Group the security groups by region and VPC once instead of rescanning each region for every VPC
+    index = SecurityGroupIndex(sg_results)
 
-        vpcs = []
-
-        for vpc_sg in security_groups:
-            vpcs.append(vpc_sg.vpcId)
-
-        # Remove duplicates
-        vpcs = list(set(vpcs))
+    for region, vpcs in index.regions.items():
+        r.write(f"{region} | {aws_utils.get_region_friendly_name(session,region)}", 0)
 
-        for vpc in vpcs:
+        for vpc, selected_sgs in vpcs.items():
             # Add the VPC ID to the report
             r.write(vpc, 1)
 
-            # Pull out security groups in the current VPCs
-            selected_sgs = [s for s in security_groups if s.vpcId == vpc]
-
-            # Loop though the selected security groups
+            # Loop though the security groups in the current VPC
             for sg in selected_sgs:
 
                 # Add Security group ID and Name to the report
@@ -367,6 +842,6 @@ def format_report(session,sg_results):
 
                 r.newline()
 
-    return str(r)
+    return None if stream else str(r)
 
 
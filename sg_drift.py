@@ -0,0 +1,335 @@
+import hashlib
+import json
+import os
+
+import menu_builder
+import security_group_scanner
+import utils
+
+# Where the security group snapshots are kept, one file per account
+SNAPSHOT_DIR = os.path.join(os.path.expanduser("~"), ".ttk", "sg_snapshots")
+
+# Bumped whenever the snapshot layout changes so old snapshots are treated as missing instead of misread
+SNAPSHOT_VERSION = 1
+
+# Group fields other than the rules that are compared when a group changes
+COMPARED_GROUP_FIELDS = ("groupName", "description", "vpcId", "ownerId", "tags")
+
+# Rule lists in a permission and the peer type each one is reported as
+PEER_FIELDS = (("ipRanges", "cidrIp", "cidr"), ("ipv6Ranges", "cidrIpv6", "cidr"),
+               ("prefixListIds", "prefixListId", "prefixList"), ("userIdGroupPairs", "groupId", "securityGroup"))
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+
+
+# Return a copy of a security group dict (SecurityGroup.to_dict) with every list sorted, so the same rules in a
+# different order hash the same
+def canonical_group(group):
+    group = dict(group)
+
+    for direction in ("ipPermissions", "ipPermissionsEgress"):
+        permissions = []
+        for permission in group.get(direction) or []:
+            permission = dict(permission)
+            for list_name, _, _ in PEER_FIELDS:
+                permission[list_name] = sorted(permission.get(list_name) or [], key=_dumps)
+            permissions.append(permission)
+        group[direction] = sorted(permissions, key=_dumps)
+
+    group["tags"] = sorted(group.get("tags") or [], key=_dumps)
+    return group
+
+
+def hash_group(group):
+    return hashlib.sha256(_dumps(group).encode()).hexdigest()
+
+
+# Hash of the unparsed describe_security_groups results for a region. When it matches the snapshot the region
+# hasn't changed and parsing and diffing its groups is skipped
+def fingerprint_groups(raw_groups):
+    return hashlib.sha256(_dumps(raw_groups).encode()).hexdigest()
+
+
+# Break a canonical group's permissions into one (direction, protocol, from port, to port, peer type, peer,
+# description) tuple per peer so two versions of a group can be compared rule by rule
+def flatten_rules(group):
+    rules = set()
+
+    for direction, permissions in (("ingress", group.get("ipPermissions")),
+                                   ("egress", group.get("ipPermissionsEgress"))):
+        for permission in permissions or []:
+            for list_name, peer_field, peer_type in PEER_FIELDS:
+                for peer in permission.get(list_name) or []:
+                    rules.add((direction, permission.get("ipProtocol"), permission.get("fromPort"),
+                               permission.get("toPort"), peer_type, peer.get(peer_field), peer.get("description")))
+
+    return rules
+
+
+def rule_to_dict(rule):
+    direction, ip_protocol, from_port, to_port, peer_type, peer, description = rule
+    return {"direction": direction, "ipProtocol": ip_protocol, "fromPort": from_port, "toPort": to_port,
+            "peerType": peer_type, "peer": peer, "description": description}
+
+
+def _sorted_rules(rules):
+    return [rule_to_dict(rule) for rule in sorted(rules, key=lambda rule: tuple(str(value) for value in rule))]
+
+
+class SecurityGroupSnapshot:
+    def __init__(self, account_id, snapshot_dir=SNAPSHOT_DIR):
+        self.account_id = account_id
+        self.path = os.path.join(snapshot_dir, f"{account_id}.json")
+        self.scanned_at = None
+
+        # region -> {"fingerprint": region fingerprint, "groups": {group id -> {"hash": hash, "group": group dict}}}
+        self.regions = {}
+
+    def load(self):
+        if os.path.isfile(self.path):
+            try:
+                snapshot = json.loads(utils.read_file(self.path))
+            except ValueError:
+                snapshot = {}
+
+            if snapshot.get("version") == SNAPSHOT_VERSION and snapshot.get("account_id") == self.account_id:
+                self.scanned_at = snapshot.get("scanned_at")
+                self.regions = snapshot.get("regions", {})
+
+        return self
+
+    @property
+    def exists(self):
+        return bool(self.regions)
+
+    def get_region(self, region):
+        return self.regions.get(region)
+
+    def set_region(self, region, entry):
+        self.regions[region] = entry
+
+    # Write the snapshot to a temporary file and swap it in so an interrupted save never leaves a partial snapshot
+    def save(self, scanned_at=None):
+        self.scanned_at = scanned_at or utils.datetime_now_string()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        temp_path = self.path + ".tmp"
+        utils.write_file(temp_path, json.dumps({"version": SNAPSHOT_VERSION, "account_id": self.account_id,
+                                                "scanned_at": self.scanned_at, "regions": self.regions},
+                                               default=str))
+        os.replace(temp_path, self.path)
+
+
+class GroupChange:
+    def __init__(self, change, group_id, group_name=None, added_rules=None, removed_rules=None, changed_fields=None):
+        self.change = change
+        self.group_id = group_id
+        self.group_name = group_name
+        self.added_rules = added_rules or []
+        self.removed_rules = removed_rules or []
+        self.changed_fields = changed_fields or {}
+
+    def to_dict(self):
+        return {
+            "change": self.change,
+            "groupId": self.group_id,
+            "groupName": self.group_name,
+            "addedRules": self.added_rules,
+            "removedRules": self.removed_rules,
+            "changedFields": self.changed_fields,
+        }
+
+
+class RegionDrift:
+    def __init__(self, region, changes=None, unchanged=False, group_count=0, error=None, elapsed_seconds=None):
+        self.region = region
+        self.changes = changes or []
+        self.unchanged = unchanged
+        self.group_count = group_count
+        self.error = error
+        self.elapsed_seconds = elapsed_seconds
+
+    def to_dict(self):
+        return {
+            "region": self.region,
+            "unchanged": self.unchanged,
+            "groupCount": self.group_count,
+            "error": None if self.error is None else str(self.error),
+            "elapsedSeconds": self.elapsed_seconds,
+            "changes": [change.to_dict() for change in self.changes],
+        }
+
+
+class DriftReport:
+    def __init__(self, account_id, previous_scanned_at=None, baseline=False):
+        self.account_id = account_id
+        self.previous_scanned_at = previous_scanned_at
+        self.baseline = baseline
+        self.regions = []
+
+    def count(self, change):
+        return sum(1 for region in self.regions for group_change in region.changes if group_change.change == change)
+
+    # A baseline scan has nothing to compare with, every group it finds is reported as added but none of it is drift
+    @property
+    def has_drift(self):
+        return not self.baseline and any(region.changes for region in self.regions)
+
+    def to_dict(self):
+        return {
+            "accountId": self.account_id,
+            "previousScannedAt": self.previous_scanned_at,
+            "baseline": self.baseline,
+            "added": self.count("added"),
+            "removed": self.count("removed"),
+            "modified": self.count("modified"),
+            "regions": [region.to_dict() for region in self.regions],
+        }
+
+
+# Compare the groups of a region in the snapshot with the newly scanned ones, both as {group id -> snapshot entry}
+def diff_groups(previous_groups, current_groups):
+    changes = []
+
+    for group_id, entry in current_groups.items():
+        group = entry["group"]
+        previous_entry = previous_groups.get(group_id)
+
+        if previous_entry is None:
+            changes.append(GroupChange("added", group_id, group.get("groupName"),
+                                       added_rules=_sorted_rules(flatten_rules(group))))
+        elif previous_entry["hash"] != entry["hash"]:
+            previous_group = previous_entry["group"]
+            current_rules = flatten_rules(group)
+            previous_rules = flatten_rules(previous_group)
+
+            changed_fields = {field: {"previous": previous_group.get(field), "current": group.get(field)}
+                              for field in COMPARED_GROUP_FIELDS if previous_group.get(field) != group.get(field)}
+
+            changes.append(GroupChange("modified", group_id, group.get("groupName"),
+                                       added_rules=_sorted_rules(current_rules - previous_rules),
+                                       removed_rules=_sorted_rules(previous_rules - current_rules),
+                                       changed_fields=changed_fields))
+
+    for group_id, previous_entry in previous_groups.items():
+        if group_id not in current_groups:
+            previous_group = previous_entry["group"]
+            changes.append(GroupChange("removed", group_id, previous_group.get("groupName"),
+                                       removed_rules=_sorted_rules(flatten_rules(previous_group))))
+
+    changes.sort(key=lambda change: (change.group_name or "", change.group_id))
+    return changes
+
+
+# Build the snapshot entry for a region from its unparsed describe_security_groups results
+def build_region_entry(raw_groups, fingerprint=None):
+    groups = {}
+
+    for raw_group in raw_groups:
+        group = canonical_group(security_group_scanner.parse_security_group(raw_group).to_dict())
+        groups[group["groupId"]] = {"hash": hash_group(group), "group": group}
+
+    return {"fingerprint": fingerprint or fingerprint_groups(raw_groups), "groups": groups}
+
+
+# Scan the regions in parallel and compare them with the snapshot. Every region is still described (EC2 has no
+# cheaper change feed), but a region whose unparsed results fingerprint the same as last time is reported unchanged
+# without parsing or diffing its groups. The snapshot is updated in place with the new results so the caller can save
+# it, regions that failed keep their previous entry so a transient error doesn't show up as drift on the next run.
+def scan_drift(session_factory, regions, snapshot, max_workers=security_group_scanner.DEFAULT_SCAN_WORKERS,
+               region_timeout=security_group_scanner.DEFAULT_REGION_TIMEOUT_SECONDS, on_region_complete=None):
+    regions = list(regions)
+    drift = DriftReport(snapshot.account_id, previous_scanned_at=snapshot.scanned_at, baseline=not snapshot.exists)
+
+    def scan_region(region):
+        raw_groups = security_group_scanner.describe_security_groups(session_factory(region))
+        fingerprint = fingerprint_groups(raw_groups)
+        previous_entry = snapshot.get_region(region)
+
+        if previous_entry is not None and previous_entry.get("fingerprint") == fingerprint:
+            return None, len(previous_entry["groups"])
+
+        entry = build_region_entry(raw_groups, fingerprint)
+        previous_groups = previous_entry["groups"] if previous_entry else {}
+        return entry, diff_groups(previous_groups, entry["groups"])
+
+    completed = {}
+    for task in utils.run_concurrently(scan_region, regions, max_workers=max_workers, timeout=region_timeout):
+        if task.error is not None:
+            region_drift = RegionDrift(task.item, error=task.error, elapsed_seconds=task.elapsed_seconds)
+        else:
+            entry, result = task.result
+            if entry is None:
+                region_drift = RegionDrift(task.item, unchanged=True, group_count=result,
+                                           elapsed_seconds=task.elapsed_seconds)
+            else:
+                snapshot.set_region(task.item, entry)
+                region_drift = RegionDrift(task.item, changes=result, unchanged=not result,
+                                           group_count=len(entry["groups"]), elapsed_seconds=task.elapsed_seconds)
+
+        completed[task.item] = region_drift
+        if on_region_complete:
+            on_region_complete(region_drift)
+
+    # Report the regions in the requested order so drift reports are stable between runs
+    drift.regions = [completed[region] for region in regions if region in completed]
+
+    return drift
+
+
+def _format_rule(rule):
+    if rule["ipProtocol"] == "-1":
+        ports = "All Ports"
+    elif rule["fromPort"] == rule["toPort"]:
+        ports = f"{rule['fromPort']}"
+    else:
+        ports = f"{rule['fromPort']} - {rule['toPort']}"
+
+    text = f"{rule['direction']} [{rule['ipProtocol']}] {ports}: {rule['peer']}"
+    if rule["description"]:
+        text += f" ({rule['description']})"
+    return text
+
+
+# Build the drift report text, if a stream is provided the report is written to it as it's built and None is returned
+def format_drift_report(drift, stream=None):
+    r = utils.ReportBuilder(stream)
+    header_name = "AWS Security Group Drift Report"
+    r.write(menu_builder.build_header(header_name, 20))
+    r.write("Account ID: " + str(drift.account_id))
+    if drift.baseline:
+        r.write("No previous snapshot, this scan is the new baseline")
+    else:
+        r.write(f"Compared With Scan From: {drift.previous_scanned_at}")
+    r.write(f"Added: {drift.count('added')} | Removed: {drift.count('removed')} | Modified: {drift.count('modified')}")
+    r.write(menu_builder.build_divider(header_name, padding=20))
+    r.newline()
+
+    for region in drift.regions:
+        if region.error is not None:
+            r.write(f"{region.region} | Scan Failed: {region.error}", 0)
+            continue
+
+        if not region.changes:
+            r.write(f"{region.region} | No Changes ({region.group_count} groups)", 0)
+            continue
+
+        r.write(f"{region.region} | {len(region.changes)} Changed ({region.group_count} groups)", 0)
+        for change in region.changes:
+            if change.group_name is None:
+                r.write(f"{change.change.upper()} {change.group_id}", 1)
+            else:
+                r.write(f"{change.change.upper()} {change.group_name}({change.group_id})", 1)
+
+            for field, values in change.changed_fields.items():
+                r.write(f"~ {field}: {values['previous']} -> {values['current']}", 2)
+            for rule in change.added_rules:
+                r.write(f"+ {_format_rule(rule)}", 2)
+            for rule in change.removed_rules:
+                r.write(f"- {_format_rule(rule)}", 2)
+
+        r.newline()
+
+    return None if stream else str(r)
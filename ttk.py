@@ -1,10 +1,15 @@
+import sys
+
 import aws_utils
+import batch_key_rotator
+import cli
 import iam_key_rotator
 import s3_explorer
 import utils
 import menu_builder
 import subprocess
 import security_group_scanner
+import sg_drift
 import regex_patterns
 
 
@@ -37,6 +42,9 @@ class Config:
         self.aws_account_id = None
         self.assumed_account_id = None
 
+        # Drop any clients and account metadata cached for the credentials that are being cleared
+        aws_utils.clear_session_caches()
+
     def build_config_info(self):
         config_info = {}
 
@@ -64,6 +72,10 @@ class Config:
 
 if __name__ == "__main__":
 
+    # Run a single command without the menus when arguments are given, e.g. python ttk.py sg-scan --profile prod
+    if len(sys.argv) > 1:
+        sys.exit(cli.main(sys.argv[1:]))
+
     # Build config object
     config = Config("AWS Tinkerer's Toolkit")
 
@@ -74,6 +86,7 @@ if __name__ == "__main__":
         if config.session:
             menu_items.append(menu_builder.MenuItem("Show Regions", "REGIONS"))
             menu_items.append(menu_builder.MenuItem("Security Group Scanner", "SG_SCANNER"))
+            menu_items.append(menu_builder.MenuItem("Security Group Drift Scan", "SG_DRIFT"))
             menu_items.append(menu_builder.MenuItem("IAM Tools", "IAM_TOOLS"))
             menu_items.append(menu_builder.MenuItem("S3 Explorer", "S3_EXPLORER"))
 
@@ -195,6 +208,7 @@ if __name__ == "__main__":
                 # Reset Global Variables
                 config.aws_assume_rolename = None
                 config.assumed_account_id = None
+                aws_utils.clear_session_caches()
 
                 if form_data.get("session_name").response == "" or form_data.get("session_name").response is None:
                     form_data["session_name"].response = "AWSTinkererToolkit"
@@ -219,6 +233,7 @@ if __name__ == "__main__":
                 config.base_session = None
                 config.aws_assume_rolename = None
                 config.assumed_account_id = None
+                aws_utils.clear_session_caches()
 
             elif auth_choice == "AWS_SSO":
                 sso_menu = menu_builder.build_menu(config.header_name, "AWS SSO Configuration",
@@ -299,7 +314,6 @@ if __name__ == "__main__":
 
         elif choice == "SG_SCANNER":
 
-            sg_results = {}
             filename_account_id = config.aws_account_id
 
             regions_header_menu = menu_builder.build_menu(config.header_name, "Security Group Scanner",
@@ -310,30 +324,22 @@ if __name__ == "__main__":
             menu_builder.clear_screen()
             print(regions_header_menu)
 
-            # Loop though all the regions and get the security groups
-            for region in aws_utils.get_regions(config.session,
-                                                region_status_filter=aws_utils.AccountStatusFilters.ENABLED):
-                # Check for a profile name and reuse it to create a new session for the region change otherwise use
-                # the key information
-                if config.aws_profile_name:
-                    temp_session = aws_utils.create_aws_session(region_name=region,
-                                                                profile_name=config.aws_profile_name)
+            # Print the status of each region as soon as its scan finishes
+            def print_region_status(region_result):
+                if region_result.error is None:
+                    print(f"{region_result.region} Scan Complete ({region_result.elapsed_seconds:.1f}s)")
                 else:
-                    temp_session = aws_utils.create_aws_session(region_name=region,
-                                                                aws_credentials=aws_utils.AwsCredentials(
-                                                                    access_key_id=config.aws_access_key_id,
-                                                                    secret_access_key=config.aws_access_key_id,
-                                                                    session_token=config.aws_session_token))
-
-                # If you are using an assumed role then re-assume the role in the new region
-                if config.aws_assume_rolename:
-                    temp_session = aws_utils.assume_role(temp_session, role_arn=config.aws_assume_rolename,
-                                                         session_name="AWSTinkererToolkit",
-                                                         region_name=region)
-                    filename_account_id = config.assumed_account_id
-
-                sg_results[region] = security_group_scanner.get_security_groups(temp_session)
-                print(f"{region} Scan Complete")
+                    print(f"{region_result.region} Scan Failed: {region_result.error}")
+
+            if config.aws_assume_rolename:
+                filename_account_id = config.assumed_account_id
+
+            # Scan all the enabled regions in parallel. Each region gets a copy of the current session so an assumed
+            # role is only assumed once for the whole scan
+            sg_results, sg_errors = security_group_scanner.scan_regions(
+                lambda region: aws_utils.change_session_region(config.session, region),
+                aws_utils.get_regions(config.session, region_status_filter=aws_utils.AccountStatusFilters.ENABLED),
+                on_region_complete=print_region_status)
 
             # Generate a timestamp for the filename (This will allow for both files to have the same timestamp for
             # easy comparison between the json and txt files
@@ -343,9 +349,9 @@ if __name__ == "__main__":
             utils.write_json_file(f"{sg_report_filename}.json",
                                   sg_results)
 
-            # Generate the formatted txt report and print it
-            sg_report = security_group_scanner.format_report(config.session, sg_results)
-            utils.write_file(f"{sg_report_filename}.txt", sg_report)
+            # Generate the formatted txt report, writing it straight to the file as it's built
+            with open(f"{sg_report_filename}.txt", 'w') as sg_report_file:
+                security_group_scanner.format_report(config.session, sg_results, stream=sg_report_file)
 
             print("\nSecurity Group Report Generated...")
 
@@ -361,10 +367,67 @@ if __name__ == "__main__":
                 menu_builder.wait_for_input()
                 continue
 
+        elif choice == "SG_DRIFT":
+
+            filename_account_id = config.aws_account_id
+            if config.aws_assume_rolename:
+                filename_account_id = config.assumed_account_id
+
+            drift_header_menu = menu_builder.build_menu(config.header_name, "Security Group Drift Scan",
+                                                        description=None, padding=20, center_section=True,
+                                                        config_section=config_info)
+
+            # Clear the screen and display the menu
+            menu_builder.clear_screen()
+            print(drift_header_menu)
+
+            # Print the drift status of each region as soon as it finishes
+            def print_region_drift(region_drift):
+                if region_drift.error is not None:
+                    print(f"{region_drift.region} Scan Failed: {region_drift.error}")
+                elif region_drift.unchanged:
+                    print(f"{region_drift.region} No Changes ({region_drift.elapsed_seconds:.1f}s)")
+                else:
+                    print(f"{region_drift.region} {len(region_drift.changes)} Changed "
+                          f"({region_drift.elapsed_seconds:.1f}s)")
+
+            # Compare the enabled regions with the last snapshot for the account, then save the new snapshot
+            snapshot = sg_drift.SecurityGroupSnapshot(filename_account_id).load()
+            drift = sg_drift.scan_drift(
+                lambda region: aws_utils.change_session_region(config.session, region),
+                aws_utils.get_regions(config.session, region_status_filter=aws_utils.AccountStatusFilters.ENABLED),
+                snapshot, on_region_complete=print_region_drift)
+            snapshot.save()
+
+            filename_timestamp = utils.datetime_now_string("%Y-%m-%dT%H-%M-%S")
+            drift_report_filename = f"{filename_timestamp}--"f"{filename_account_id}--SecurityGroupDrift"
+            utils.write_json_file(f"{drift_report_filename}.json", drift.to_dict())
+            with open(f"{drift_report_filename}.txt", 'w') as drift_report_file:
+                sg_drift.format_drift_report(drift, stream=drift_report_file)
+
+            if drift.baseline:
+                print("\nNo previous snapshot found, baseline snapshot saved...")
+            else:
+                print(f"\nAdded: {drift.count('added')} | Removed: {drift.count('removed')} | "
+                      f"Modified: {drift.count('modified')}")
+
+            # Ask the user if they would like to view the report, if yes then open the file with the default program
+            confirm_prompt = input("Would you like to view the report? (y/n): ")
+            if menu_builder.regex_validator(confirm_prompt, regex_patterns.REGEX_BOOL_YES):
+                utils.open_file(f"{drift_report_filename}.txt")
+                continue
+            elif menu_builder.regex_validator(confirm_prompt, regex_patterns.REGEX_BOOL_NO):
+                continue
+            else:
+                print("\nInvalid input provided. Please provide a valid value y/n")
+                menu_builder.wait_for_input()
+                continue
+
         elif choice == "IAM_TOOLS":
             while True:
                 iam_tool_menu = [menu_builder.MenuItem("Search IAM Users", "SEARCH_IAM_USERS"),
-                                 menu_builder.MenuItem("Generate IAM Users Report", "IAM_USERS_REPORT"), ]
+                                 menu_builder.MenuItem("Generate IAM Users Report", "IAM_USERS_REPORT"),
+                                 menu_builder.MenuItem("Batch Rotate Access Keys", "BATCH_ROTATE_KEYS"), ]
 
                 iam_tool_choice = menu_builder.create_menu(config.header_name, section_name="IAM Tools",
                                                            description="What would you like to do?",
@@ -492,7 +555,8 @@ if __name__ == "__main__":
                                                 padding=20,
                                                 center_section=False, config_section=config_info))
                     filename_account_id = config.aws_account_id
-                    users = iam_key_rotator.get_iam_users(config.session, get_details=True)
+                    # Build the users from the bulk authorization details and credential report
+                    users = iam_key_rotator.get_iam_users_inventory(config.session)
 
                     # Write the results to a json file
                     if config.assumed_account_id:
@@ -504,16 +568,15 @@ if __name__ == "__main__":
                             f"{utils.datetime_now_string("%Y-%m-%dT%H-%M-%S")}--"f"{config.aws_account_id}--IAMUsersReport.json",
                             users)
 
-                    # Generate the formatted txt report and print it
-                    iam_report = iam_key_rotator.format_users_report(config.session, users)
                     iam_users_report_filename = None
                     if config.assumed_account_id:
                         iam_users_report_filename = f"{utils.datetime_now_string("%Y-%m-%dT%H-%M-%S")}--"f"{config.assumed_account_id}--IAMUsersReport.txt"
                     else:
                         iam_users_report_filename = f"{utils.datetime_now_string("%Y-%m-%dT%H-%M-%S")}--"f"{config.aws_account_id}--IAMUsersReport.txt"
 
-                    # Write the report to a file
-                    utils.write_file(iam_users_report_filename, iam_report)
+                    # Generate the formatted txt report, writing it straight to the file as it's built
+                    with open(iam_users_report_filename, 'w') as iam_report_file:
+                        iam_key_rotator.format_users_report(config.session, users, stream=iam_report_file)
                     print("IAM Users Report Generated...")
 
                     # Ask the user if they would like to view the report, if yes then open the file with the default program
@@ -527,6 +590,82 @@ if __name__ == "__main__":
                         print("\nInvalid input provided. Please provide a valid value y/n")
                         menu_builder.wait_for_input()
                         continue
+
+                elif iam_tool_choice == "BATCH_ROTATE_KEYS":
+                    selection_menu = [menu_builder.MenuItem("All Users With Access Keys", "ALL_USERS"),
+                                      menu_builder.MenuItem("Users In Group", "BY_GROUP"),
+                                      menu_builder.MenuItem("Users With Tag", "BY_TAG"),
+                                      menu_builder.MenuItem("Users With Keys Older Than", "BY_KEY_AGE")]
+
+                    selection_choice = menu_builder.create_menu(config.header_name,
+                                                                section_name="IAM: Batch Rotate Access Keys",
+                                                                description="Which users should be rotated?",
+                                                                menu_items=selection_menu, config_section=config_info)
+
+                    # If None was returned then treat it like a canceled and return to the parent menu
+                    if not selection_choice or selection_choice == "back":
+                        continue
+
+                    selection = {}
+                    if selection_choice == "BY_GROUP":
+                        selection["group"] = input("IAM Group Name: ").strip()
+                    elif selection_choice == "BY_TAG":
+                        selection["tag"] = input("Tag (Key or Key=Value): ").strip()
+                    elif selection_choice == "BY_KEY_AGE":
+                        key_age = input("Minimum Key Age In Days: ").strip()
+                        if not key_age.isdigit():
+                            print("\nInvalid input provided. Please provide a number of days")
+                            menu_builder.wait_for_input()
+                            continue
+                        selection["min_key_age_days"] = int(key_age)
+
+                    print("Building Rotation Plan...")
+                    rotation_plan = batch_key_rotator.build_rotation_plan(config.session, **selection)
+
+                    menu_builder.clear_screen()
+                    print(menu_builder.build_menu(config.header_name, "IAM: Batch Rotation Plan", description=None,
+                                                  padding=20, center_section=False, config_section=config_info,
+                                                  content_section=batch_key_rotator.format_rotation_plan(
+                                                      rotation_plan)))
+
+                    if len(rotation_plan.rotations) == 0:
+                        print("No users to rotate...")
+                        menu_builder.wait_for_input()
+                        continue
+
+                    confirm_prompt = input("Are you sure you want to continue? (y/n): ")
+                    if menu_builder.regex_validator(confirm_prompt, regex_patterns.REGEX_BOOL_YES):
+                        # Print the result of each user as soon as its rotation finishes
+                        def print_user_rotation(rotation):
+                            if rotation.Status == "rotated":
+                                print(f"{rotation.UserName} Rotated ({rotation.ElapsedSeconds:.1f}s, key accepted "
+                                      f"after {rotation.Verification.PropagationSeconds:.1f}s)")
+                            else:
+                                print(f"{rotation.UserName} Failed ({rotation.Status}): {rotation.Error}")
+
+                        key_log = batch_key_rotator.RotationKeyLog(
+                            batch_key_rotator.rotation_output_filename(rotation_plan))
+                        print(f"Rotating Access Keys, new keys are saved to {key_log.filename} as each user "
+                              f"finishes...")
+                        batch_key_rotator.run_rotation_plan(config.session, rotation_plan,
+                                                            on_user_complete=print_user_rotation, key_log=key_log)
+                        rotation_filename = batch_key_rotator.write_rotation_output(rotation_plan, key_log)
+
+                        print(f"\nRotated: {rotation_plan.count('rotated')} | Failed: {len(rotation_plan.failed)}")
+                        propagation = rotation_plan.propagation_summary()
+                        if propagation["verified"]:
+                            print(f"New keys accepted after {propagation['meanSeconds']:.1f}s on average "
+                                  f"(max {propagation['maxSeconds']:.1f}s)")
+                        print(f"New access keys written to {rotation_filename}")
+                        menu_builder.wait_for_input()
+                    elif menu_builder.regex_validator(confirm_prompt, regex_patterns.REGEX_BOOL_NO):
+                        print("Access Key Rotation Cancelled...")
+                        menu_builder.wait_for_input()
+                    else:
+                        print("\nInvalid input provided. Please try again...")
+                        menu_builder.wait_for_input()
+                        continue
+
                 elif iam_tool_choice == "back":
                     break
 
@@ -549,36 +688,23 @@ if __name__ == "__main__":
                 if not bucket_search_selection:
                     continue
                 else:
-                    file_items, folder_items = s3_explorer.list_objects_and_folders(config.session,
-                                                                                    bucket_search_selection,
-                                                                                    prefix=selected_path)
-
-                    # Combine the lists for the search results
-                    folder_objects = [*file_items, *folder_items]
-
-                    # Sort the objects
-                    folder_objects.sort()
-
                     addl_folder_search_options = []
                     if selected_path is not None and selected_path != "":
                         addl_folder_search_options.append(menu_builder.MenuItem("Parent Folder", "PARENT_FOLDER"))
                     addl_folder_search_options.append(menu_builder.MenuItem("Download Folder", "DOWNLOAD_FOLDER"))
+                    addl_folder_search_options.append(menu_builder.MenuItem("Sync Folder", "SYNC_FOLDER"))
                     addl_folder_search_options.append(menu_builder.MenuItem("Upload File to Folder", "UPLOAD_FILE"))
+                    addl_folder_search_options.append(menu_builder.MenuItem("Upload Local Folder to Folder",
+                                                                            "UPLOAD_FOLDER"))
                     addl_folder_search_options.append(
                         menu_builder.MenuItem("Generate Upload Presigned URL", "UPLOAD_URL"))
 
-                    # Convert the search result list to Menu items
-                    folder_obj_items = []
-                    for obj in folder_objects:
-                        # Todo: Fix the obj here
-                        if obj.endswith('/'):
-                            display_name = str(obj).split('/')[-2] + "/"
-                        else:
-                            if "/" in obj:
-                                display_name = str(obj).split('/')[-1]
-                            else:
-                                display_name = obj
-                        folder_obj_items.append(menu_builder.MenuItem(display_name, obj))
+                    # Convert the listing to Menu items as it streams in so the first page can be shown before the
+                    # rest of the folder has been listed
+                    folder_obj_items = menu_builder.LazyList(
+                        menu_builder.MenuItem(s3_explorer.object_display_name(obj), obj)
+                        for obj in s3_explorer.iter_sorted_objects_and_folders(config.session, bucket_search_selection,
+                                                                               prefix=selected_path))
 
                     folder_search_selection = menu_builder.search_builder(config.header_name, section_name="Search",
                                                                           search_list=folder_obj_items,
@@ -617,6 +743,35 @@ if __name__ == "__main__":
                                 menu_builder.wait_for_input()
                                 continue
 
+                        elif folder_search_selection == "UPLOAD_FOLDER":
+                            upload_folder_form_items = {"local_folder_path": menu_builder.FormItem("What is the absolute "
+                                                                                                   "path of the local folder you want to upload?"),
+                                                        "checksum_algorithm": menu_builder.FormItem(
+                                                            "What checksum algorithm should S3 verify? (CRC32, CRC32C, "
+                                                            "SHA1, SHA256 or leave blank for none)")}
+
+                            form_data = menu_builder.form_builder(config.header_name, "S3 Explorer: Upload Folder",
+                                                                  "Please provide the "
+                                                                  "following information",
+                                                                  upload_folder_form_items, config_section=config_info)
+
+                            # If None was returned then treat it like a canceled and return to the parent menu
+                            if not form_data:
+                                continue
+
+                            if form_data.get("local_folder_path").response == "" or form_data.get(
+                                    "local_folder_path").response is None:
+                                raise Exception("You must provide a valid folder path to upload.")
+                            else:
+                                upload_progress = s3_explorer.upload_directory(
+                                    config.session, bucket_search_selection,
+                                    form_data.get("local_folder_path").response, selected_path,
+                                    checksum_algorithm=form_data.get("checksum_algorithm").response or None)
+                                print(upload_progress.summary())
+                                print("Folder Uploaded...")
+                                menu_builder.wait_for_input()
+                                continue
+
                         elif folder_search_selection == "UPLOAD_URL":
                             upload_url_form_items = {"file_name": menu_builder.FormItem("What is the file name "
                                                                                         "you want to upload "
@@ -713,6 +868,45 @@ if __name__ == "__main__":
                                 menu_builder.wait_for_input()
                                 continue
 
+                        elif folder_search_selection == "SYNC_FOLDER":
+                            sync_folder_form_items = {
+                                "local_folder_path": menu_builder.FormItem("What is the absolute "
+                                                                           "path of the local folder you want to sync to?")}
+
+                            form_data = menu_builder.form_builder(config.header_name, "S3 Explorer: Sync Folder",
+                                                                  "Please provide the "
+                                                                  "following information",
+                                                                  sync_folder_form_items,
+                                                                  config_section=config_info)
+
+                            # If None was returned then treat it like a canceled and return to the parent menu
+                            if not form_data:
+                                continue
+
+                            local_path = form_data.get("local_folder_path").response
+
+                            folder_sync_menu = menu_builder.build_menu(config.header_name,
+                                                                       "S3 Explorer: Sync Folder",
+                                                                       description=None,
+                                                                       padding=20,
+                                                                       center_section=False,
+                                                                       config_section=config_info)
+
+                            # Clear the screen and display the menu
+                            menu_builder.clear_screen()
+                            print(folder_sync_menu)
+
+                            if local_path == "" or local_path is None:
+                                raise Exception("You must provide a valid folder path to sync to.")
+                            else:
+                                sync_progress = s3_explorer.sync_s3_folder(config.session, bucket_search_selection,
+                                                                           selected_path, local_path)
+
+                                print(sync_progress.summary())
+                                print("\nSync Complete...")
+                                menu_builder.wait_for_input()
+                                continue
+
                     # Results from search menu that were not from the additional search options
                     else:
                         # If ends in / then it's a folder, otherwise assume a file
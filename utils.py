@@ -1,5 +1,8 @@
+import io
 import os
 import json
+import threading
+import time
 import uuid
 
 import requests
@@ -8,20 +11,110 @@ import subprocess
 import platform
 import re
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 
+# Size of the chunks used when streaming files to and from URLs
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Shared HTTP session so connections to the same host are pooled and reused between calls
+_http_session = None
+_http_session_lock = threading.Lock()
+
+# Builds a text report line by line. The lines are buffered in a list and joined once when the report is read, or if
+# a stream (e.g. an open file) is provided they're written straight to it so the report is never held in memory.
 class ReportBuilder:
-    def __init__(self):
-        self.text = ""
+    def __init__(self, stream=None):
+        self.stream = stream
+        self._lines = []
+
+    def _append(self, line):
+        if self.stream is None:
+            self._lines.append(line)
+        else:
+            self.stream.write(line)
 
     def write(self, text,indent=0,left_padding=0):
-        self.text += f'{'\t' * indent}{' ' * left_padding}{text}\n'
+        self._append(f'{'\t' * indent}{' ' * left_padding}{text}\n')
 
     def newline(self):
-        self.text += '\n'
+        self._append('\n')
+
+    @property
+    def text(self):
+        # Collapse the buffered lines so repeated reads don't join them again
+        if len(self._lines) > 1:
+            self._lines = [''.join(self._lines)]
+        return self._lines[0] if self._lines else ""
 
     def __str__(self):
         return self.text
 
+
+class TaskResult:
+    def __init__(self, item, result=None, error=None, elapsed_seconds=None):
+        self.item = item
+        self.result = result
+        self.error = error
+        self.elapsed_seconds = elapsed_seconds
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+# Run func against each item on a bounded thread pool and yield a TaskResult for each item as it finishes. If a
+# timeout is provided then any task that has been running longer than the timeout is reported as a TimeoutError
+# (the worker thread can't be killed, but its result is discarded and it no longer holds up the caller)
+def run_concurrently(func, items, max_workers=10, timeout=None):
+    if max_workers is None or max_workers < 1:
+        raise ValueError("max_workers must be a positive integer")
+
+    started = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def run_task(task_item, task_id):
+        # Record when the task actually started so queued tasks aren't charged for time spent waiting on a worker
+        started[task_id] = time.monotonic()
+        return func(task_item)
+
+    pending = {}
+    try:
+        for index, item in enumerate(items):
+            pending[executor.submit(run_task, item, index)] = (index, item)
+
+        while pending:
+            # Wake up at least often enough to enforce the timeout on the longest running task
+            wait_timeout = None
+            if timeout is not None:
+                now = time.monotonic()
+                running = [started[task_id] for task_id, _ in pending.values() if task_id in started]
+                wait_timeout = max(0.0, min(running) + timeout - now) if running else timeout
+
+            done, _ = wait(pending.keys(), timeout=wait_timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                task_id, item = pending.pop(future)
+                elapsed = time.monotonic() - started.get(task_id, time.monotonic())
+                try:
+                    yield TaskResult(item, result=future.result(), elapsed_seconds=elapsed)
+                except Exception as e:
+                    yield TaskResult(item, error=e, elapsed_seconds=elapsed)
+
+            # Abandon any task that has gone past the timeout
+            if timeout is not None:
+                now = time.monotonic()
+                for future, (task_id, item) in list(pending.items()):
+                    if task_id in started and now - started[task_id] >= timeout and not future.done():
+                        future.cancel()
+                        del pending[future]
+                        yield TaskResult(item, error=TimeoutError(f"Task timed out after {timeout} seconds"),
+                                         elapsed_seconds=now - started[task_id])
+    finally:
+        # Don't block on abandoned (timed out) tasks or on work the caller no longer wants
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 def regex_contains(base_string, search_string):
     # Normalize the items by removing special characters,spaces and converting to lowercase
     norm_base = re.sub(r'[^a-zA-Z0-9]', '', base_string).lower()
@@ -74,11 +167,19 @@ def print_yaml(obj):
 def print_json(obj,indent=4):
     print(stringify_json(obj, indent=indent))
 
+# Convert objects json can't serialize on its own, objects with a to_dict method are serialized with it
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return str(obj)
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    return obj.__dict__
+
 def stringify_json(obj, indent=4):
     if indent == 0:
-        return json.dumps(obj, default=lambda obj: str(obj) if isinstance(obj, datetime) else obj.__dict__)
+        return json.dumps(obj, default=_json_default)
     else:
-        return json.dumps(obj, indent=indent, default=lambda obj: str(obj) if isinstance(obj, datetime) else obj.__dict__)
+        return json.dumps(obj, indent=indent, default=_json_default)
 
 # Helper function to check if a file exists and if it does make sure that it's not 0 bytes
 def valid_file_exists(path):
@@ -96,7 +197,9 @@ def valid_file_exists(path):
 # Write json file
 def write_json_file(path, content):
     if path.endswith(".json"):
-        write_file(path, stringify_json(content))
+        # Stream the json to the file as it's encoded instead of building the whole string in memory first
+        with open(path, 'w') as file:
+            json.dump(content, file, indent=4, default=_json_default)
     else:
         raise Exception("The filename for this file must end in the json extension")
 
@@ -130,18 +233,85 @@ def open_file(file_path):
     except Exception as e:
         print(f"Failed to open file: {e}")
 
-# Todo: Need to test this function
-def download_file_from_url(url, download_path):
-    r = requests.get(url, allow_redirects=True)
-    open(download_path, 'wb').write(r.content)
-
-# Todo: Need to test this function
+# Get the shared requests session, connections are kept alive and reused across calls and threads
+def get_http_session():
+    global _http_session
+
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50)
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+
+    return _http_session
+
+
+# Streams a multipart/form-data body made up of the form fields followed by a file. The file is read in chunks as the
+# body is sent so it's never loaded into memory, and the total length is known up front so S3 gets a Content-Length.
+class MultipartFileStream:
+    def __init__(self, fields, file_path, file_field_name="file", chunk_size=STREAM_CHUNK_SIZE):
+        boundary = generate_uuid(remove_hyphens=True)
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.chunk_size = chunk_size
+
+        preamble = b""
+        for key, value in (fields or {}).items():
+            preamble += (f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'
+                         f'{value}\r\n').encode("utf-8")
+        preamble += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field_name}"; '
+                     f'filename="{os.path.basename(file_path)}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n').encode("utf-8")
+        epilogue = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+        self.len = len(preamble) + os.path.getsize(file_path) + len(epilogue)
+        self._file = open(file_path, 'rb')
+        self._parts = [io.BytesIO(preamble), self._file, io.BytesIO(epilogue)]
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and (size is None or size < 0 or size > 0):
+            chunk = self._parts[0].read(size if size is not None and size >= 0 else -1)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size is not None and size >= 0:
+                size -= len(chunk)
+
+        return b"".join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Download a file from a url, the response is streamed to disk in chunks so memory use stays bounded
+def download_file_from_url(url, download_path, chunk_size=STREAM_CHUNK_SIZE):
+    with get_http_session().get(url, allow_redirects=True, stream=True) as r:
+        r.raise_for_status()
+        with open(download_path, 'wb') as file:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                file.write(chunk)
+
+
+# Upload a file to a presigned POST url, the file is streamed as the request body instead of being read into memory
 def upload_to_url(url, fields, file):
-    # Open a read binary to the file you want to upload to the presigned upload url
-    file_stream = {'file': open(file, 'rb')}
-
-    # Submit a post request adding both the fields and file to the post body to the presigned url
-    r = requests.post(url, data=fields, files=file_stream)
+    with MultipartFileStream(fields, file) as body:
+        # Submit a post request adding both the fields and file to the post body to the presigned url
+        r = get_http_session().post(url, data=body, headers={"Content-Type": body.content_type})
 
     # Check to see if the post request returns a status code of 204, if so then return success otherwise return failure
     if r.status_code == 204: